@@ -5,17 +5,264 @@ from scipy.interpolate import interp1d
 from pycbc.conversions import mchirp_from_mass1_mass2, spin1z_from_mass1_mass2_chi_eff_chi_a, spin2z_from_mass1_mass2_chi_eff_chi_a
 from pycbc.conversions import mass1_from_mchirp_q, mass2_from_mchirp_q
 from constants import *
-from template import waveform
+from template import waveform, get_template
 from matched_filter import *
+import os
 import pickle
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from signal_processing import *
+from psd import as_psd
+from event_store import load_event, store_path
+from simulate import simulate_event
+
+
+class _DetectorData:
+    # the series of one detector of an EventData, indexed like the dict of an
+    # event dictionary
+    __slots__ = ('event', 'index')
+
+    def __init__(self, event, index):
+        self.event = event
+        self.index = index
+
+    def __getitem__(self, name):
+        if name == 'strain':
+            return self.event.strain[self.index]
+        return self.event.derived(name)[self.index]
+
+    def keys(self):
+        return ('strain',) + tuple(self.event.derived_series)
+
+
+def _stacked(rows):
+    # rows as one array: the array they are the rows of (as loaded by load_event),
+    # so memory-mapped data is not copied, or else a stacked copy
+    base = rows[0].base
+    if isinstance(base, np.ndarray) and base.ndim == 2 and len(base) == len(rows) and \
+            all(row.base is base and row.ctypes.data == base[i].ctypes.data and
+                row.shape == base[i].shape and row.strides == base[i].strides
+                for i, row in enumerate(rows)):
+        return base
+    return np.stack(rows)
+
+
+class EventData:
+    """Data of an event, stored compactly: strain of every detector stacked in
+    one array, with the time axis implied by t0 and dt, and the whitened and
+    bandpassed series derived (for all detectors at once) when first used,
+    through the product cache, unless given. Can be indexed like an event
+    dictionary.
+
+    Args:
+        t0 (float): time of the first sample
+        dt (float): sample time interval of data
+        strain (ndarray): strain data, one detector per row
+        time_center (float): time of the event
+        psds (dict): psd of each detector
+        dets (list): detectors of the rows of strain
+        fs (float, optional): sample rate of data, defaults to 1 / dt
+        fband (list): low and high-pass filter values used for the bandpassed data
+        decimation (int): factor the data has been decimated by
+        dtype (dtype): precision to store the strain in
+        derived (dict, optional): whitened ('strain_whiten') or whitened and
+            bandpassed ('strain_whitenbp') strain already derived, one detector
+            per row
+    """
+
+    __slots__ = ('t0', 'dt', 'fs', 'strain', 'time_center', 'psds', 'dets', 'fband',
+                 'decimation', '_derived', '_keys')
+
+    derived_series = ('strain_whiten', 'strain_whitenbp')
+
+    def __init__(self, t0, dt, strain, time_center, psds, dets=('H1', 'L1'), fs=None,
+                 fband=(35.0, 350.0), decimation=1, dtype=event_dtype, derived=None):
+        self.t0 = float(t0)
+        self.dt = dt
+        self.fs = int(round(1. / dt)) if fs is None else fs
+        self.strain = np.asarray(strain, dtype=dtype)
+        self.time_center = time_center
+        self.psds = {det: as_psd(psds[det]) for det in dets}
+        self.dets = tuple(dets)
+        self.fband = tuple(fband)
+        self.decimation = decimation
+        self._derived = {name: np.asarray(series, dtype=dtype)
+                         for name, series in (derived or {}).items()}
+        self._keys = {}
+
+    @classmethod
+    def from_dict(cls, total_data, fband=(35.0, 350.0), dtype=event_dtype):
+        """Converts an event dictionary, using the strain of an event loaded by
+        load_event as it is mapped (without copying it). The whitened series
+        stored in the dictionary are used too, and the bandpassed ones if they
+        were bandpassed with fband (dictionaries which do not record their
+        fband, such as the pickled ones, are taken to have been)."""
+        dets = [det for det in ('H1', 'L1') if det in total_data]
+        names = ['strain_whiten']
+        if tuple(total_data.get('fband', fband)) == tuple(fband):
+            names.append('strain_whitenbp')
+        derived = {name: _stacked([total_data[det][name] for det in dets]) for name in names
+                   if all(name in total_data[det] for det in dets)}
+        return cls(total_data['time'][0], total_data['dt'],
+                   _stacked([total_data[det]['strain'] for det in dets]),
+                   total_data['time_center'], total_data['large_data_psds'], dets,
+                   fs=total_data['fs'], fband=fband,
+                   decimation=total_data.get('decimation', 1), dtype=dtype, derived=derived)
+
+    @property
+    def time(self):
+        return self.t0 + self.dt * np.arange(self.strain.shape[-1])
+
+    def derived(self, name):
+        """Whitened ('strain_whiten') or whitened and bandpassed
+        ('strain_whitenbp') strain, one detector per row."""
+        if name not in self._derived:
+            if name == 'strain_whiten':
+                series, key = cached_whiten(self.strain, [self.psds[det] for det in self.dets],
+                                            self.dt)
+            elif name == 'strain_whitenbp':
+                series, key = cached_bandpass(self.derived('strain_whiten'), self.fband, self.fs,
+                                              key=self._keys.get('strain_whiten'))
+            else:
+                raise KeyError(name)
+            self._keys[name] = key
+            self._derived[name] = series.astype(self.strain.dtype, copy=False)
+        return self._derived[name]
+
+    def clear_derived(self):
+        self._derived = {}
+        self._keys = {}
+
+    @property
+    def nbytes(self):
+        """Memory (bytes) held by the strain and the derived series."""
+        return self.strain.nbytes + sum(series.nbytes for series in self._derived.values())
+
+    # read access as an event dictionary
+    def keys(self):
+        keys = self.dets + ('time', 'time_center', 'dt', 'fs', 'large_data_psds')
+        return keys + ('decimation',) if self.decimation != 1 else keys
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def __getitem__(self, key):
+        if key in self.dets:
+            return _DetectorData(self, self.dets.index(key))
+        if key == 'large_data_psds':
+            return self.psds
+        if key in ('time', 'time_center', 'dt', 'fs') or (key == 'decimation' and key in self):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+
+class EventRegistry:
+    """Loads the data of events on first access, keeping at most max_resident of
+    them in memory and unloading the least recently used first. Loads run on
+    background threads, so the next event of the catalog can be prefetched
+    while the current one is in use (prefetched events count towards
+    max_resident, and a failed load is retried on the next access).
+
+    Args:
+        max_resident (int): number of events kept in memory
+        prefetch_next (bool): if True, prefetch the event registered after each
+            event which is loaded
+    """
+
+    def __init__(self, max_resident=max_resident_events, prefetch_next=prefetch_events):
+        self.max_resident = max_resident
+        self.prefetch_next = prefetch_next
+        self.order = []
+        self.resident = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        # forked processes (e.g. pool workers) keep the events already in memory,
+        # but need their own lock and loading threads
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=2)
+        self.pending = {}
+
+    def register(self, signal):
+        self.order.append(signal)
+
+    def _load(self, signal):
+        # with the lock held: start loading signal unless it already is
+        if signal not in self.pending:
+            self.pending[signal] = self.executor.submit(signal.load_data)
+        return self.pending[signal]
+
+    def get(self, signal):
+        """Data of an event, loading it (or waiting for its prefetch) if needed."""
+        with self.lock:
+            if signal in self.resident:
+                self.resident.move_to_end(signal)
+                return self.resident[signal]
+            future = self._load(signal)
+        try:
+            data = future.result()
+        finally:
+            # a failed load is forgotten too, so that it is retried
+            with self.lock:
+                if self.pending.get(signal) is future:
+                    del self.pending[signal]
+        with self.lock:
+            self.resident[signal] = data
+            self.resident.move_to_end(signal)
+            self._evict(keep=1)
+        if self.prefetch_next and signal in self.order:
+            self.prefetch(self.order[(self.order.index(signal) + 1) % len(self.order)])
+        return data
+
+    def _evict(self, keep, room=0):
+        # with the lock held: unload the least recently used events until room
+        # more events (resident or loading) fit, keeping the keep most recent
+        while len(self.resident) + len(self.pending) + room > self.max_resident and \
+                len(self.resident) > keep:
+            self.resident.popitem(last=False)
+
+    def prefetch(self, signal):
+        """Starts loading an event in the background, if it is not in memory
+        and there is room for it without unloading the event most recently
+        used."""
+        with self.lock:
+            if signal in self.resident or signal in self.pending:
+                return
+            self._evict(keep=1, room=1)
+            if len(self.resident) + len(self.pending) < self.max_resident:
+                self._load(signal)
+
+    def unload(self, signal):
+        with self.lock:
+            self.resident.pop(signal, None)
+            self.pending.pop(signal, None)
+
+
+# registry of the events whose data is loaded on demand
+event_registry = EventRegistry()
 
 
 class GWSignals:
 
-    def __init__(self, ref_params, dictionary):
-        # dictionary which contains data for event
-        self.dictionary = dictionary
+    def __init__(self, ref_params, dictionary, fs_analysis=analysis_fs, registry=event_registry):
+        # dictionary which contains data for event, or a function which loads it,
+        # in which case it is only loaded (through the registry) when first used
+        self.fs_analysis = fs_analysis
+        self.registry = registry
+        if callable(dictionary):
+            self.loader = dictionary
+            self.data = None
+            registry.register(self)
+        else:
+            self.loader = None
+            self.data = self.prepare_data(dictionary)
 
         # reference parameters
         #add amplitude into reference params 
@@ -35,56 +282,135 @@ class GWSignals:
         self.min_chirp = mchirp_from_mass1_mass2(self.min_mass1, self.min_mass2)
         self.max_chirp = mchirp_from_mass1_mass2(self.max_mass1, self.max_mass2)
 
+    def prepare_data(self, dictionary):
+        # data for event (as an EventData, with its psds as uniform-grid PSDs),
+        # the (possibly decimated) data used for matched filtering and display,
+        # and caches of data transforms, keyed by (det, t_amount, lag_window), of
+        # segment lengths picked for each detector and of inverse psds
+        dictionary = EventData.from_dict(dictionary)
+        if self.fs_analysis is None:
+            analysis_dictionary = dictionary
+        else:
+            analysis_dictionary = EventData.from_dict(decimate_event(dictionary, self.fs_analysis))
+        return {'full_dictionary': dictionary, 'dictionary': analysis_dictionary,
+                'segments': {}, 't_amounts': {}, 'inverse_psds': {}}
+
+    def load_data(self):
+        return self.prepare_data(self.loader())
+
+    # data of the event, loaded through the registry if it is not held directly
+    def get_data(self):
+        return self.data if self.data is not None else self.registry.get(self)
+
+    @property
+    def full_dictionary(self):
+        return self.get_data()['full_dictionary']
+
+    @property
+    def dictionary(self):
+        return self.get_data()['dictionary']
+
+    @property
+    def segments(self):
+        return self.get_data()['segments']
 
+    @property
+    def t_amounts(self):
+        return self.get_data()['t_amounts']
 
+    @property
+    def inverse_psds(self):
+        return self.get_data()['inverse_psds']
 
-# load data 
-with open('data/GW150914_data_dict.pkl', 'rb') as f:
-    GW150914_data = pickle.load(f)
+    # get (and cache) the inverse psd on the frequency grid of the frequency-domain
+    # waveforms, zeroed outside the band the waveforms are generated in
+    def get_inverse_psd(self, det):
+        if det not in self.inverse_psds:
+            band = freqs_full >= f_min
+            inverse_psd = np.zeros(freqs_full.size)
+            inverse_psd[band] = 1. / self.dictionary['large_data_psds'][det](freqs_full[band])
+            self.inverse_psds[det] = inverse_psd
+        return self.inverse_psds[det]
 
-with open('data/GW190521_data_dict.pkl', 'rb') as f:
-    GW190521_data = pickle.load(f)
+    # get (and cache) the segment length to filter for a detector, picked from the
+    # reference template and the psd
+    def auto_t_amount(self, det):
+        if det not in self.t_amounts:
+            time = self.dictionary['time']
+            fs = self.dictionary['fs']
+            self.t_amounts[det] = auto_segment_length(get_template(self.comp_params, self.dictionary),
+                                                      self.dictionary['large_data_psds'][det], fs,
+                                                      center=np.searchsorted(time, self.dictionary['time_center']),
+                                                      max_length=len(time) / fs)
+        return self.t_amounts[det]
 
-with open('data/GW200129_data_dict.pkl', 'rb') as f:
-    GW200129_data = pickle.load(f)
+    # get (and cache) the data transform used to filter templates against this event
+    def get_segment(self, det, t_amount=4, lag_window=None):
+        if t_amount == 'auto':
+            t_amount = self.auto_t_amount(det)
+        key = (det, t_amount, lag_window)
+        if key not in self.segments:
+            self.segments[key] = DataSegment(self.dictionary, det, t_amount, lag_window)
+        return self.segments[key]
 
-with open('data/GW200224_data_dict.pkl', 'rb') as f:
-    GW200224_data = pickle.load(f)
 
-with open('data/GW200311_data_dict.pkl', 'rb') as f:
-    GW200311_data = pickle.load(f)
 
-with open('data/GW191109_data_dict.pkl', 'rb') as f:
-    GW191109_data= pickle.load(f)
 
-with open('data/GW190828_data_dict.pkl', 'rb') as f:
-    GW190828_data= pickle.load(f)
+# data files of the bundled events, loaded when an event is first used (from
+# the memory-mapped copy written by event_store.py if there is one)
+event_files = {'GW150914': 'data/GW150914_data_dict.pkl',
+               'GW190521': 'data/GW190521_data_dict.pkl',
+               'GW200129': 'data/GW200129_data_dict.pkl',
+               'GW200224': 'data/GW200224_data_dict.pkl',
+               'GW200311': 'data/GW200311_data_dict.pkl',
+               'GW191109': 'data/GW191109_data_dict.pkl',
+               'GW190828': 'data/GW190828_data_dict.pkl',
+               'GW190519': 'data/GW190519_data_dict.pkl'}
 
-with open('data/GW190519_data_dict.pkl', 'rb') as f:
-    GW190519_data= pickle.load(f)
 
-with open('data/simulated_GW.pkl', 'rb') as f:
-    simulated_data = pickle.load(f)
-    simulated_data['H1']['strain'] *= 10
-    simulated_data['H1']['strain_whiten'] *= 10
-    simulated_data['H1']['strain_whitenbp'] *= 10
-    simulated_data['L1']['strain'] *= 10
-    simulated_data['L1']['strain_whiten'] *= 10
-    simulated_data['L1']['strain_whitenbp'] *= 10
+def read_event(filename, event_name):
+    # data dictionary of an event, memory-mapped read-only if it has been converted
+    path = store_path(event_name)
+    if os.path.exists(os.path.join(path, 'meta.json')):
+        return load_event(path)
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+def event_loader(filename, event_name):
+    # function which loads the data dictionary of an event
+    def load():
+        return read_event(filename, event_name)
+    return load
+
+
+def load_simulated():
+    # noise colored by the GW150914 psds, with a signal injected at params_inj
+    # (read directly rather than through the registry, whose loading threads
+    # this runs on)
+    reference = read_event(event_files['GW150914'], 'GW150914')
+    return simulate_event(params_inj, reference['large_data_psds'], snr=snr_inj,
+                          fs=reference['fs'], time_center=reference['time_center'],
+                          seed=seed_inj)
 
 # class instantiation for real GW events
-GW150914 = GWSignals(signal_ref_params['GW150914'][1], GW150914_data)
-GW190521 = GWSignals(signal_ref_params['GW190521'][1], GW190521_data)
-GW200129 = GWSignals(signal_ref_params['GW200129'][1], GW200129_data)
-GW200224 = GWSignals(signal_ref_params['GW200224'][1], GW200224_data)
-GW200311 = GWSignals(signal_ref_params['GW200311'][1], GW200311_data)
-GW191109 = GWSignals(signal_ref_params['GW191109'][1], GW191109_data)
-GW190828= GWSignals(signal_ref_params['GW190828'][1], GW190828_data)
-GW190519= GWSignals(signal_ref_params['GW190519'][1], GW190519_data)
+GW150914 = GWSignals(signal_ref_params['GW150914'][1], event_loader(event_files['GW150914'], 'GW150914'))
+GW190521 = GWSignals(signal_ref_params['GW190521'][1], event_loader(event_files['GW190521'], 'GW190521'))
+GW200129 = GWSignals(signal_ref_params['GW200129'][1], event_loader(event_files['GW200129'], 'GW200129'))
+GW200224 = GWSignals(signal_ref_params['GW200224'][1], event_loader(event_files['GW200224'], 'GW200224'))
+GW200311 = GWSignals(signal_ref_params['GW200311'][1], event_loader(event_files['GW200311'], 'GW200311'))
+GW191109 = GWSignals(signal_ref_params['GW191109'][1], event_loader(event_files['GW191109'], 'GW191109'))
+GW190828= GWSignals(signal_ref_params['GW190828'][1], event_loader(event_files['GW190828'], 'GW190828'))
+GW190519= GWSignals(signal_ref_params['GW190519'][1], event_loader(event_files['GW190519'], 'GW190519'))
+
+# real GW events by name, for scripts which loop over the bundled events
+GW_events = {'GW150914': GW150914, 'GW190521': GW190521, 'GW200129': GW200129,
+             'GW200224': GW200224, 'GW200311': GW200311, 'GW191109': GW191109,
+             'GW190828': GW190828, 'GW190519': GW190519}
 
 # GW_simulated = GWSignals(signal_ref_params['GW150914'][1], GW150914_data)
 
-GW_simulated = GWSignals(np.array([30., 20., 0., 0.]), simulated_data)
+GW_simulated = GWSignals(np.array([30., 20., 0., 0.]), load_simulated)
 
 
 
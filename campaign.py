@@ -0,0 +1,332 @@
+'''Injection-recovery campaign: simulate many events with signals drawn over the
+(m1, m2, chi1, chi2) domain, recover each with the matched filter (a coarse
+pass over random templates, then a Nelder-Mead refinement of the network SNR)
+and report the bias of the recovered parameters and the SNR recovered.
+
+A campaign lives in a directory of work units, so it can be run by a process
+pool on one machine or by several machines sharing the directory, and resumes
+where it stopped.'''
+
+
+import argparse
+import json
+import os
+import time as timer
+from multiprocessing import Pool
+
+import numpy as np
+from pycbc.conversions import mchirp_from_mass1_mass2, chi_eff, chi_a
+from scipy.optimize import minimize
+import constants as c
+
+
+# parameters of the injections, in the order of the component parameters
+param_names = ['m1', 'm2', 'chi1', 'chi2']
+
+# default domain the injections are drawn over
+default_domain = [[c.m1_min, c.m1_max], [c.m2_min, c.m2_max],
+                  [c.chi1_min, c.chi1_max], [c.chi2_min, c.chi2_max]]
+
+
+def draw_injections(num, domain=default_domain, seed=None):
+    """Component parameters drawn uniformly over the domain, with m1 >= m2."""
+    domain = np.asarray(domain, dtype=float)
+    rng = np.random.default_rng(seed)
+    params = domain[:, 0] + (domain[:, 1] - domain[:, 0]) * rng.random((num, len(domain)))
+    swap = params[:, 1] > params[:, 0]
+    params[swap, :2] = params[swap, 1::-1]
+    params[swap, 2:] = params[swap, :1:-1]
+    return params
+
+
+def create_campaign(directory, num_injections, unit_size=8, snr=20., seed=0,
+                    domain=default_domain, psd_event='GW150914', num_coarse=128, t_amount=4,
+                    lag_window=0.1, maxiter=200):
+    """Writes the settings and injections of a campaign to a directory, unless
+    it already holds a campaign (which is then resumed as it was created).
+
+    Args:
+        directory (str): directory of the campaign (shared by every worker)
+        num_injections (int): number of injections
+        unit_size (int): number of injections in each work unit
+        snr (float): optimal network SNR of the injected signals
+        seed (int): seed of the injected parameters and of the noise
+        domain (list): range of m1, m2, chi1 and chi2
+        psd_event (str): bundled event whose psds color the noise
+        num_coarse (int): number of random templates of the coarse pass
+        t_amount (float): amount of time (s) around event filtered
+        lag_window (float): only search for the SNR peak within lag_window
+            (s) of the injection time (see DataSegment)
+        maxiter (int): largest number of iterations of the refinement
+
+    Returns:
+        dict: settings of the campaign
+    """
+    settings_filename = os.path.join(directory, 'campaign.json')
+    if os.path.exists(settings_filename):
+        with open(settings_filename) as f:
+            return json.load(f)
+    os.makedirs(os.path.join(directory, 'units'), exist_ok=True)
+    np.save(os.path.join(directory, 'injections.npy'),
+            draw_injections(num_injections, domain, seed))
+    settings = {'num_injections': num_injections, 'unit_size': unit_size, 'snr': snr,
+                'seed': seed, 'domain': np.asarray(domain, dtype=float).tolist(),
+                'psd_event': psd_event, 'num_coarse': num_coarse, 't_amount': t_amount,
+                'lag_window': lag_window, 'maxiter': maxiter}
+    tmp_filename = settings_filename + '.tmp'
+    with open(tmp_filename, 'w') as f:
+        json.dump(settings, f, indent=2)
+    os.replace(tmp_filename, settings_filename)
+    return settings
+
+
+def unit_filename(directory, unit, suffix='.npz'):
+    return os.path.join(directory, 'units', f'unit_{unit:05d}{suffix}')
+
+
+def unit_claims(directory, unit):
+    """Numbers of the claim files of a work unit, in order."""
+    prefix = os.path.basename(unit_filename(directory, unit, '.claim.'))
+    return sorted(int(name[len(prefix):]) for name in os.listdir(os.path.join(directory, 'units'))
+                  if name.startswith(prefix) and name[len(prefix):].isdigit())
+
+
+def claim_unit(directory, unit, claim_timeout):
+    """Claims a work unit for this process. Every claim is a new file, numbered
+    one past the latest claim and created exclusively, so that of the workers
+    claiming a unit at once only one gets each number. A claim is only made if
+    the unit has none, or if the latest is older than claim_timeout (s) (its
+    worker has presumably died). The unit belongs to the latest claim, which is
+    checked again once the claim file is written.
+
+    Returns:
+        str: the claim file, or None if another worker holds the unit
+    """
+    claims = unit_claims(directory, unit)
+    if claims:
+        try:
+            if timer.time() - os.path.getmtime(unit_filename(
+                    directory, unit, f'.claim.{claims[-1]}')) <= claim_timeout:
+                return None
+        except FileNotFoundError:
+            # released since it was listed, and possibly claimed again
+            return None
+    number = claims[-1] + 1 if claims else 0
+    claim = unit_filename(directory, unit, f'.claim.{number}')
+    try:
+        fd = os.open(claim, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return None
+    with os.fdopen(fd, 'w') as f:
+        f.write(f'{os.uname().nodename} {os.getpid()}\n')
+    if unit_claims(directory, unit)[-1] != number:
+        # a later claim was made in the meantime
+        os.remove(claim)
+        return None
+    return claim
+
+
+def pending_units(directory, settings):
+    """Work units without results."""
+    num_units = -(-settings['num_injections'] // settings['unit_size'])
+    return [unit for unit in range(num_units) if not os.path.exists(unit_filename(directory, unit))]
+
+
+def network_snr_of(params, GW_signal, settings):
+    from matched_filter import batch_matched_filter
+    SNRmax = batch_matched_filter(np.atleast_2d(params), GW_signal, t_amount=settings['t_amount'],
+                                  lag_window=settings['lag_window'])[0]
+    return np.sqrt(np.sum(SNRmax**2, axis=-1))
+
+
+def recover(GW_signal, settings, rng):
+    """Component parameters of the template with the largest network SNR: the
+    loudest of num_coarse random templates, refined with Nelder-Mead.
+
+    Returns:
+        ndarray: recovered component parameters
+        float: their network SNR
+    """
+    domain = np.asarray(settings['domain'])
+    coarse = draw_injections(settings['num_coarse'], domain, rng.integers(2**32))
+    coarse_snr = network_snr_of(coarse, GW_signal, settings)
+    start = coarse[np.argmax(coarse_snr)]
+
+    def negative_snr(params):
+        if np.any(params < domain[:, 0]) or np.any(params > domain[:, 1]) or params[1] > params[0]:
+            return 0.
+        return -network_snr_of(params, GW_signal, settings)[0]
+
+    # initial simplex: a tenth of the domain along each parameter
+    simplex = start + np.vstack([np.zeros(len(start)),
+                                 np.diag(0.1 * (domain[:, 1] - domain[:, 0]))])
+    simplex = np.clip(simplex, domain[:, 0], domain[:, 1])
+    result = minimize(negative_snr, start, method='Nelder-Mead',
+                      options={'initial_simplex': simplex, 'maxiter': settings['maxiter'],
+                               'xatol': 1e-3, 'fatol': 1e-3})
+    if -result.fun < coarse_snr.max():
+        return start, coarse_snr.max()
+    return result.x, -result.fun
+
+
+def run_unit(directory, settings, unit, psds):
+    """Simulates and recovers the injections of one work unit and saves the
+    results (through a temporary file, so a unit either has results or not).
+
+    Returns:
+        int: the unit
+        int: number of injections in it
+        float: time taken (s)
+    """
+    from GW_class import GWSignals
+    from simulate import simulate_event
+    from template import merger_time
+    injections = np.load(os.path.join(directory, 'injections.npy'))
+    indexes = np.arange(unit * settings['unit_size'],
+                        min((unit + 1) * settings['unit_size'], settings['num_injections']))
+    results = {name: [] for name in ('snr_true', 'snr_recovered', 'recovered', 'time')}
+    for index in indexes:
+        t0 = timer.perf_counter()
+        params = injections[index]
+        # every injection has its own seeds, so results do not depend on the units
+        rng = np.random.default_rng([settings['seed'], index])
+        dictionary = simulate_event(params, psds, snr=settings['snr'], seed=rng.integers(2**32))
+        # time_center on the merger of the injection, as for the bundled events,
+        # so that the lag window is centred on it
+        dictionary['time_center'] = merger_time(dictionary)
+        m1, m2, chi1, chi2 = params
+        GW_signal = GWSignals(np.array([m1, m2, chi_eff(m1, m2, chi1, chi2),
+                                        chi_a(m1, m2, chi1, chi2)]), dictionary)
+        recovered, snr_recovered = recover(GW_signal, settings, rng)
+        results['snr_true'].append(network_snr_of(params, GW_signal, settings)[0])
+        results['snr_recovered'].append(snr_recovered)
+        results['recovered'].append(recovered)
+        results['time'].append(timer.perf_counter() - t0)
+
+    filename = unit_filename(directory, unit)
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        np.savez(f, index=indexes, injected=injections[indexes],
+                 **{name: np.array(values) for name, values in results.items()})
+    os.replace(tmp_filename, filename)
+    return unit, len(indexes), sum(results['time'])
+
+
+def _init_worker(directory, settings):
+    global _directory, _settings, _psds
+    from GW_class import read_event, event_files
+    _directory, _settings = directory, settings
+    _psds = read_event(event_files[settings['psd_event']],
+                       settings['psd_event'])['large_data_psds']
+
+
+def _run_unit(task):
+    # units are claimed by the worker about to run them, so that workers on
+    # other machines share what is left
+    unit, claim_timeout = task
+    if os.path.exists(unit_filename(_directory, unit)):
+        return unit, 0, 0.
+    claim = claim_unit(_directory, unit, claim_timeout)
+    if claim is None:
+        return unit, 0, 0.
+    try:
+        return run_unit(_directory, _settings, unit, _psds)
+    finally:
+        os.remove(claim)
+
+
+def run_campaign(directory, processes=None, claim_timeout=3600.):
+    """Runs the pending work units of a campaign over a pool of processes.
+    Several machines can run the same campaign directory at once.
+
+    Yields:
+        tuple: result of run_unit for each unit run here, as units finish
+    """
+    with open(os.path.join(directory, 'campaign.json')) as f:
+        settings = json.load(f)
+    tasks = [(unit, claim_timeout) for unit in pending_units(directory, settings)]
+    with Pool(processes, initializer=_init_worker, initargs=(directory, settings)) as pool:
+        for unit, num, elapsed in pool.imap_unordered(_run_unit, tasks):
+            if num:
+                yield unit, num, elapsed
+
+
+def load_results(directory):
+    """Results of every finished work unit, concatenated."""
+    units = sorted(name for name in os.listdir(os.path.join(directory, 'units'))
+                   if name.endswith('.npz'))
+    results = {}
+    for name in units:
+        with np.load(os.path.join(directory, 'units', name)) as unit:
+            for key in unit.files:
+                results.setdefault(key, []).append(unit[key])
+    return {key: np.concatenate(values) for key, values in results.items()}
+
+
+def summarize(results, snr):
+    """Bias of the recovered parameters (and chirp mass) and SNR recovered.
+
+    Args:
+        results (dict): results of the campaign (see load_results)
+        snr (float): optimal network SNR of the injected signals
+
+    Returns:
+        dict: for each parameter, the mean, median, standard deviation and 90%
+            range of the recovered minus injected value; the fraction of the
+            injected SNR recovered by the injected and by the recovered
+            templates; and the mean time (s) per injection
+    """
+    injected, recovered = results['injected'], results['recovered']
+    errors = {name: recovered[:, i] - injected[:, i] for i, name in enumerate(param_names)}
+    errors['chirp'] = (mchirp_from_mass1_mass2(recovered[:, 0], recovered[:, 1]) -
+                       mchirp_from_mass1_mass2(injected[:, 0], injected[:, 1]))
+    bias = {name: {'mean': error.mean(), 'median': np.median(error), 'std': error.std(),
+                   'p05': np.percentile(error, 5), 'p95': np.percentile(error, 95)}
+            for name, error in errors.items()}
+    return {'num_injections': len(injected), 'bias': bias,
+            'snr_true_fraction': results['snr_true'] / snr,
+            'snr_recovered_fraction': results['snr_recovered'] / snr,
+            'fitting_factor': np.minimum(results['snr_recovered'] / results['snr_true'], 1.),
+            'time_per_injection': results['time'].mean()}
+
+
+def print_report(summary):
+    print(f"{summary['num_injections']} injections "
+          f"({summary['time_per_injection']:.1f} s each)")
+    for name, bias in summary['bias'].items():
+        print(f"    {name:>6}: bias {bias['mean']:+.3f} (median {bias['median']:+.3f}), "
+              f"std {bias['std']:.3f}, 90% in [{bias['p05']:+.3f}, {bias['p95']:+.3f}]")
+    for key, label in (('snr_true_fraction', 'SNR of injected template / injected SNR'),
+                       ('snr_recovered_fraction', 'SNR recovered / injected SNR'),
+                       ('fitting_factor', 'SNR recovered / SNR of injected template')):
+        values = summary[key]
+        print(f"    {label}: median {np.median(values):.3f}, "
+              f"5th percentile {np.percentile(values, 5):.3f}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('directory', help='campaign directory (created if it does not exist)')
+    parser.add_argument('--num-injections', type=int, default=256)
+    parser.add_argument('--unit-size', type=int, default=8)
+    parser.add_argument('--snr', type=float, default=20.)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--psd-event', default='GW150914')
+    parser.add_argument('--num-coarse', type=int, default=128)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--report-only', action='store_true',
+                        help='only report the results of the units finished so far')
+    args = parser.parse_args()
+
+    settings = create_campaign(args.directory, args.num_injections, args.unit_size, args.snr,
+                               args.seed, psd_event=args.psd_event, num_coarse=args.num_coarse)
+    if not args.report_only:
+        t0 = timer.perf_counter()
+        for unit, num, elapsed in run_campaign(args.directory, args.processes):
+            print(f'unit {unit}: {num} injections in {elapsed:.1f} s')
+        print(f'{timer.perf_counter() - t0:.1f} s')
+    pending = pending_units(args.directory, settings)
+    if pending:
+        print(f'{len(pending)} units still pending')
+    if len(pending) < -(-settings['num_injections'] // settings['unit_size']):
+        print_report(summarize(load_results(args.directory), settings['snr']))
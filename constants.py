@@ -20,6 +20,8 @@ chirp_inj = mchirp_from_mass1_mass2(m1_inj, m2_inj)
 ratio_inj = m2_inj / m1_inj
 spin_plus_inj = chi_eff(m1_inj, m2_inj, chi1_inj, chi2_inj)
 spin_minus_inj = chi_a(m1_inj, m2_inj, chi1_inj, chi2_inj)
+snr_inj = 20.  # network SNR of the injected signal
+seed_inj = 0  # seed of the simulated noise
 params_inj = np.array([m1_inj, m2_inj, chi1_inj, chi2_inj])
 num_params = len(params_inj)
 
@@ -73,6 +75,32 @@ DL = 100.
 DL_SI = DL * (1.e6) * pc_SI
 
 
+# sample rate (Hz) to decimate event data to for matched filtering and display
+# (None keeps the sample rate of the data files)
+analysis_fs = None
+
+# number of events whose data is kept in memory at once (least recently used
+# events are unloaded first), and whether to load the next event of the
+# catalog in the background once one is loaded
+max_resident_events = 3
+prefetch_events = True
+
+# directory of the cache of products derived from the data (None disables it),
+# the size (bytes) it is kept under by removing the least recently used
+# products, and whether templates are cached too (worthwhile for fixed banks,
+# but every slider position would add a file)
+product_cache_dir = 'data/cache'
+product_cache_max_bytes = 1 << 30
+cache_templates = False
+
+# precision the strain of loaded events is stored in (the whitened and
+# bandpassed series are derived from it when first used). Single precision
+# holds a 32 s, 4096 Hz event with both derived series in 3.1 MB, against
+# 7.3 MB for the pickled dictionaries, and its rounding error is thousands of
+# times below the detector noise in band
+event_dtype = np.float32
+
+
 # set window size for plotting and generating waveforms
 window_min = -0.22  # plot beginning 0.2 sec before merger
 window_max = 0.03  # plot ending 0.05 sec after merger
@@ -0,0 +1,165 @@
+'''On-disk format for event data: a directory per event holding a json header
+and a data directory with one .npy file per series (every detector stacked,
+one per row), which are memory-mapped read-only when loaded, so processes using the same event share its pages.
+Also converts the pickled event dictionaries to this format.
+
+Series are never rewritten in place (other processes may have them mapped):
+an event is rewritten into a new data directory, and replacing the header,
+which names its data directory, swaps it in.'''
+
+
+import argparse
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import uuid
+
+import numpy as np
+from constants import event_dtype
+from psd import PSD, as_psd
+
+
+# version of the format written by save_event
+format_version = 3
+
+# directory the converted bundled events are stored in
+store_dir = 'data/events'
+
+# series stored for every detector
+series_names = ('strain', 'strain_whiten', 'strain_whitenbp')
+
+
+def store_path(event_name, directory=store_dir):
+    """Directory an event is stored in."""
+    return os.path.join(directory, event_name)
+
+
+def save_event(total_data, path, dtype=event_dtype):
+    """Writes an event dictionary to a directory, as contiguous uncompressed
+    .npy files (with the series of every detector stacked) in a new data directory and a header (meta.json) naming it,
+    replaced last, so that readers see either the previous or the new event,
+    never a mix. The data directories of previous versions are then removed
+    (processes which have their files mapped keep reading them).
+
+    Args:
+        total_data (dict): dict containing original and whitenbp strain data
+        path (str): directory to write to
+        dtype (dtype): precision to store the strain series in (the one events
+            are held in, so that they are mapped without a copy)
+    """
+    os.makedirs(path, exist_ok=True)
+    # written under a temporary name, so that a data directory is complete
+    tmp_dir = tempfile.mkdtemp(prefix='.tmp-', dir=path)
+    try:
+        dets = [det for det in ('H1', 'L1') if det in total_data]
+        np.save(os.path.join(tmp_dir, 'time.npy'),
+                np.ascontiguousarray(total_data['time'], dtype=float))
+        for name in series_names:
+            np.save(os.path.join(tmp_dir, f'{name}.npy'),
+                    np.stack([np.asarray(total_data[det][name], dtype=dtype) for det in dets]))
+        psds = {}
+        for det in dets:
+            psd = as_psd(total_data['large_data_psds'][det])
+            np.save(os.path.join(tmp_dir, f'{det}_psd.npy'), psd.values)
+            psds[det] = {'f0': psd.f0, 'df': psd.df}
+        data_dir = f'data-{uuid.uuid4().hex[:16]}'
+        os.replace(tmp_dir, os.path.join(path, data_dir))
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    meta = {'format_version': format_version, 'data_dir': data_dir, 'dets': dets,
+            'time_center': float(total_data['time_center']), 'dt': float(total_data['dt']),
+            'fs': float(total_data['fs']), 'psds': psds}
+    if 'decimation' in total_data:
+        meta['decimation'] = int(total_data['decimation'])
+    if 'fband' in total_data:
+        meta['fband'] = [float(f) for f in total_data['fband']]
+    fd, tmp_filename = tempfile.mkstemp(prefix='.meta-', suffix='.tmp', dir=path)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(tmp_filename, os.path.join(path, 'meta.json'))
+    remove_stale(path, data_dir)
+
+
+def remove_stale(path, data_dir):
+    """Removes the data directories of an event other than data_dir (on systems
+    which cannot remove files still mapped, those are left for a later call)."""
+    for name in os.listdir(path):
+        if name.startswith('data-') and name != data_dir:
+            shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+
+def load_event(path, mmap_mode='r'):
+    """Loads an event written by save_event, memory-mapping its series.
+
+    Args:
+        path (str): directory of the event
+        mmap_mode (str, optional): mode to memory-map the series with (None
+            reads them into memory)
+
+    Returns:
+        dict: event dictionary of the same shape as the pickled ones, with
+            PSD objects for the psds (the series of each detector are rows of
+            the stacked arrays, which EventData uses without copying)
+    """
+    try:
+        return _load_event(path, mmap_mode)
+    except FileNotFoundError:
+        # the event was rewritten (and its previous data removed) between
+        # reading the header and the series
+        return _load_event(path, mmap_mode)
+
+
+def _load_event(path, mmap_mode):
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    if meta['format_version'] != format_version:
+        raise ValueError(f"unsupported event format version {meta['format_version']} in {path} "
+                         "(convert or prepare it again)")
+
+    data_dir = os.path.join(path, meta['data_dir'])
+    fs = meta['fs']
+    total_data = {'time': np.load(os.path.join(data_dir, 'time.npy'), mmap_mode=mmap_mode),
+                  'time_center': meta['time_center'], 'dt': meta['dt'],
+                  'fs': int(fs) if float(fs).is_integer() else fs,
+                  'large_data_psds': {}}
+    if 'decimation' in meta:
+        total_data['decimation'] = meta['decimation']
+    if 'fband' in meta:
+        total_data['fband'] = tuple(meta['fband'])
+    series = {name: np.load(os.path.join(data_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+              for name in series_names}
+    for i, det in enumerate(meta['dets']):
+        total_data[det] = {name: series[name][i] for name in series_names}
+        values = np.load(os.path.join(data_dir, f'{det}_psd.npy'), mmap_mode=mmap_mode)
+        total_data['large_data_psds'][det] = PSD(meta['psds'][det]['f0'], meta['psds'][det]['df'],
+                                                 values)
+    return total_data
+
+
+def convert_pickle(pickle_filename, path):
+    """Converts a pickled event dictionary to the on-disk format."""
+    with open(pickle_filename, 'rb') as f:
+        total_data = pickle.load(f)
+    save_event(total_data, path)
+
+
+def event_name(pickle_filename):
+    """Name of an event from the filename of its pickle
+    (e.g. data/GW150914_data_dict.pkl -> GW150914)."""
+    return os.path.basename(pickle_filename).replace('_data_dict', '').replace('.pkl', '')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('pickles', nargs='+', help='pickled event dictionaries (e.g. data/*.pkl)')
+    parser.add_argument('--outdir', default=store_dir)
+    args = parser.parse_args()
+
+    for pickle_filename in args.pickles:
+        path = store_path(event_name(pickle_filename), args.outdir)
+        convert_pickle(pickle_filename, path)
+        print(f'{pickle_filename} -> {path}')
@@ -0,0 +1,149 @@
+'''Internal FFT layer used by the matched filter, whitening and templates.
+
+Transforms go through pyFFTW when it is installed (with the most recently used
+plans cached per transform, shape and dtype) and through scipy.fft otherwise.
+The number of threads used by either backend is a global setting.'''
+
+
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import scipy.fft as scipy_fft
+
+try:
+    import pyfftw
+    import pyfftw.builders
+except ImportError:
+    pyfftw = None
+
+
+# global settings, changed through set_backend / set_num_threads
+_backend = 'pyfftw' if pyfftw is not None else 'scipy'
+_num_threads = 1
+
+# pyFFTW plans and the lock each is called under (a plan owns its input and
+# output arrays, so one plan cannot run in two threads at once), keyed by
+# (kind, shape, dtype, n, axis, threads), most recently used last
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+# largest number of plans kept, each holding its input and output arrays
+max_plans = 16
+
+# lowest precision input each transform accepts, so float32 data stays in
+# single precision and everything else is promoted as numpy would
+_min_dtypes = {'fft': np.complex64, 'ifft': np.complex64,
+               'rfft': np.float32, 'irfft': np.complex64}
+
+
+def set_backend(name):
+    """Selects the FFT backend ('pyfftw', 'scipy' or 'numpy')."""
+    global _backend
+    if name not in ('pyfftw', 'scipy', 'numpy'):
+        raise ValueError(f'unknown FFT backend {name!r}')
+    if name == 'pyfftw' and pyfftw is None:
+        raise ImportError('pyFFTW is not installed')
+    _backend = name
+
+
+def get_backend():
+    """Name of the FFT backend in use."""
+    return _backend
+
+
+def set_num_threads(num_threads):
+    """Sets the number of threads used by every transform (-1 for all cores)."""
+    global _num_threads
+    if num_threads == 0 or num_threads < -1:
+        raise ValueError('num_threads must be positive or -1')
+    _num_threads = num_threads
+
+
+def get_num_threads():
+    """Number of threads used by every transform."""
+    return _num_threads
+
+
+def clear_plans():
+    """Forgets every cached pyFFTW plan."""
+    with _plans_lock:
+        _plans.clear()
+
+
+def next_fast_len(n, real=False):
+    """Smallest length >= n which the backends transform quickly."""
+    return scipy_fft.next_fast_len(n, real=real)
+
+
+def _plan(kind, x, n, axis):
+    # plan of a transform and its lock, planned and cached if not seen recently.
+    # A plan runs on the caller's array when it is aligned (and on a copy
+    # otherwise), so it is planned never to overwrite its input: overwrite_x
+    # is only passed on to scipy.fft
+    threads = _num_threads if _num_threads > 0 else os.cpu_count()
+    key = (kind, x.shape, x.dtype, n, axis, threads)
+    with _plans_lock:
+        entry = _plans.get(key)
+        if entry is not None:
+            _plans.move_to_end(key)
+            return entry
+    builder = getattr(pyfftw.builders, kind)
+    # single transforms are measured, batches (whose shapes vary from call to
+    # call, e.g. the neighbours of a template) are only estimated
+    plan = builder(pyfftw.empty_aligned(x.shape, dtype=x.dtype), n=n, axis=axis,
+                   overwrite_input=False, threads=threads,
+                   planner_effort='FFTW_MEASURE' if x.ndim == 1 else 'FFTW_ESTIMATE')
+    with _plans_lock:
+        # another thread may have planned the same transform meanwhile
+        entry = _plans.setdefault(key, (plan, threading.Lock()))
+        _plans.move_to_end(key)
+        while len(_plans) > max_plans:
+            _plans.popitem(last=False)
+    return entry
+
+
+def _transform(kind, x, n, axis, overwrite_x):
+    x = np.asarray(x)
+    x = x.astype(np.result_type(x.dtype, _min_dtypes[kind]), copy=False)
+    if _backend == 'pyfftw':
+        plan, lock = _plan(kind, x, n, axis)
+        with lock:
+            # the plan owns its output array, so hand back a copy of it
+            return plan(x).copy()
+    if _backend == 'scipy':
+        return getattr(scipy_fft, kind)(x, n=n, axis=axis, overwrite_x=overwrite_x,
+                                        workers=_num_threads)
+    return getattr(np.fft, kind)(x, n=n, axis=axis)
+
+
+def fft(x, n=None, axis=-1, overwrite_x=False):
+    """Complex forward transform (same conventions as np.fft.fft).
+
+    Args:
+        x (ndarray): array to transform
+        n (int, optional): length of the transform along axis
+        axis (int): axis to transform over
+        overwrite_x (bool): allow the backend to overwrite x in place (only
+            scipy.fft does, pyFFTW plans always leave x as it is)
+
+    Returns:
+        ndarray: transformed array
+    """
+    return _transform('fft', x, n, axis, overwrite_x)
+
+
+def ifft(x, n=None, axis=-1, overwrite_x=False):
+    """Complex inverse transform (same conventions as np.fft.ifft)."""
+    return _transform('ifft', x, n, axis, overwrite_x)
+
+
+def rfft(x, n=None, axis=-1, overwrite_x=False):
+    """Real forward transform (same conventions as np.fft.rfft)."""
+    return _transform('rfft', x, n, axis, overwrite_x)
+
+
+def irfft(x, n=None, axis=-1, overwrite_x=False):
+    """Real inverse transform (same conventions as np.fft.irfft)."""
+    return _transform('irfft', x, n, axis, overwrite_x)
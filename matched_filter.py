@@ -2,11 +2,15 @@
 
 
 import numpy as np
+from numba import njit
 from scipy.signal.windows import tukey
-from signal_processing import whiten, bandpass
+from scipy.special import logsumexp
+from signal_processing import whiten_bandpass, inverse_spectrum_length
 import matplotlib.pyplot as plt
 from widgets import *
-from template import get_template
+from template import get_template, merger_time, waveform
+from fft_backend import fft, ifft, rfft, next_fast_len
+from psd import as_psd
 
 
 def matched_filter(template, data, time, data_psd, fs):
@@ -36,12 +40,12 @@ def matched_filter(template, data, time, data_psd, fs):
     # for taking the fft of our template and data
     dwindow = tukey(template.size, alpha=1./4)
     # compute the template and data ffts.
-    template_fft = np.fft.fft(template*dwindow) / fs
-    data_fft = np.fft.fft(data*dwindow) / fs
+    template_fft = fft(template*dwindow) / fs
+    data_fft = fft(data*dwindow) / fs
 
     # use the larger psd of the data calculated earlier for a better calculation
     # power_vec = list(map(data_psd, np.abs(datafreq)))
-    power_vec = data_psd(np.abs(datafreq))
+    power_vec = as_psd(data_psd).fft_grid(template.size, 1. / fs)
 
     # -- Zero out negative frequencies
     negindx = np.where(datafreq<0)
@@ -54,7 +58,7 @@ def matched_filter(template, data, time, data_psd, fs):
     # be plotted as a function of time off-set between the template and the
     # data:
     optimal = data_fft * template_fft.conjugate() / power_vec
-    optimal_time = 4 * np.fft.ifft(optimal) * fs
+    optimal_time = 4 * ifft(optimal) * fs
 
     # -- Normalize the matched filter output: Normalize the matched filter
     # output so that we expect an average value of 1 at times of just noise.  Then,
@@ -88,8 +92,253 @@ def matched_filter(template, data, time, data_psd, fs):
 
 
 
+def distance_table(d_min=1e-3, d_max=1., num=500):
+    """Tabulates the distances used to marginalize the likelihood over distance,
+    with a prior uniform in volume. Distances are effective distances in the
+    units of the matched filter's d_eff: a template as get_template returns it
+    is at distance 1, and a distance D enters the likelihood only as the
+    amplitude scale 1 / D (the amp slider). The default range covers amplitudes
+    from 1 to 1000, around the 200-260 fitted to the bundled events.
 
-def get_shifted_data(template_p, fband, filter_data, data_psd, dt):
+    Args:
+        d_min (float): smallest effective distance
+        d_max (float): largest effective distance
+        num (int): number of distances in the table (spaced geometrically)
+
+    Returns:
+        ndarray: amplitude scale for each distance
+        ndarray: normalized log prior weight for each distance
+    """
+    distances = np.geomspace(d_min, d_max, num)
+    # p(D) dD ~ D^2 dD, and dD ~ D on a geometric grid
+    log_weights = 3 * np.log(distances)
+    log_weights -= logsumexp(log_weights)
+    return 1. / distances, log_weights
+
+
+@njit()
+def log_i0(x):
+    """log of the modified Bessel function I0, from the polynomial
+    approximations 9.8.1 and 9.8.2 of Abramowitz & Stegun (x >= 0).
+    """
+    if x < 3.75:
+        t = (x / 3.75)**2
+        return np.log(1. + t*(3.5156229 + t*(3.0899424 + t*(1.2067492 + t*(0.2659732
+                      + t*(0.0360768 + t*0.0045813))))))
+    t = 3.75 / x
+    return x - 0.5 * np.log(x) + np.log(0.39894228 + t*(0.01328592 + t*(0.00225319
+                                        + t*(-0.00157565 + t*(0.00916281 + t*(-0.02057706
+                                        + t*(0.02635537 + t*(-0.01647633 + t*0.00392377))))))))
+
+
+@njit()
+def marginalized_loglike(overlap, sigmasq, scales, log_weights, num_interp=128):
+    """Log likelihood ratio of a template, marginalized analytically over phase,
+    over time by a sum of the inner-product series over lags, and over distance
+    with the tabulated distances. The phase- and distance-marginalized value
+    depends on the data only through |<d|h>|, so it is tabulated on num_interp
+    points of |<d|h>| and interpolated at every lag.
+
+    Args:
+        overlap (ndarray): complex <d|h> at each allowed lag
+        sigmasq (float): <h|h>
+        scales (ndarray): amplitude scale for each tabulated distance
+        log_weights (ndarray): log prior weight for each tabulated distance
+        num_interp (int, optional): number of points in the |<d|h>| table
+
+    Returns:
+        float: marginalized log likelihood ratio
+    """
+    abs_overlap = np.abs(overlap)
+    grid = np.linspace(0., abs_overlap.max(), num_interp)
+    terms = np.empty(scales.size)
+    table = np.empty(num_interp)
+    for i in range(num_interp):
+        for k in range(scales.size):
+            terms[k] = (log_weights[k] + log_i0(scales[k] * grid[i])
+                        - 0.5 * scales[k]**2 * sigmasq)
+        term_max = terms.max()
+        table[i] = term_max + np.log(np.sum(np.exp(terms - term_max)))
+
+    values = np.interp(abs_overlap, grid, table)
+    value_max = values.max()
+    return value_max + np.log(np.sum(np.exp(values - value_max)) / values.size)
+
+
+def segment_window(time, time_center, t_amount, fs):
+    """Indexes of the t_amount (s) of data centred on time_center, in the same
+    form as np.where returns them.
+
+    Args:
+        time (ndarray): time of the full stretch of data
+        time_center (float): time to centre the segment on
+        t_amount (float): length of the segment (s), up to the whole of time
+        fs (float): sample rate of data
+
+    Returns:
+        tuple: index array of the segment
+    """
+    size = min(int(round(t_amount * fs)), len(time))
+    start = np.searchsorted(time, time_center) - size // 2
+    start = min(max(start, 0), len(time) - size)
+    return (np.arange(start, start + size),)
+
+
+def auto_segment_length(template_p, data_psd, fs, center=None, max_length=None, min_length=1.,
+                        alpha=1./4):
+    """Picks the length of data to matched filter from the in-band duration of
+    the template, its offset from time_center and the length of the inverse psd
+    kernel. Both the template (which ends at the middle of the data, up to
+    ~0.8 s from time_center for the bundled events) and the signal (which ends
+    near time_center) have to fit, with half the kernel, in the untapered part
+    of the Tukey window either side of the peak sample, and the length is
+    rounded up to a fast fft size. It is kept to at least min_length so that
+    the plotted window (up to ~0.5 s either side of time_center) stays covered.
+
+    Args:
+        template_p (ndarray): plus polarization of template
+        data_psd (interpolating function): psd of strain data around event
+        fs (float): sample rate of data
+        center (int, optional): sample of template_p at time_center, defaults
+            to the middle one
+        max_length (float, optional): longest segment allowed (s)
+        min_length (float, optional): shortest segment allowed (s)
+        alpha (float, optional): shape parameter of the Tukey window
+
+    Returns:
+        float: segment length (s), to use as t_amount
+    """
+    nonzero = np.flatnonzero(template_p)
+    start, end = nonzero[0], nonzero[-1] + 1
+    center = len(template_p) // 2 if center is None else center
+    # furthest the template or the signal reaches from time_center
+    reach = max(end - center, center - start, end - start) / fs
+    length = (reach + 0.5 * inverse_spectrum_length(data_psd)) / (0.5 - 0.5 * alpha)
+    length = next_fast_len(int(np.ceil(max(length, min_length) * fs))) / fs
+    return length if max_length is None else min(length, max_length)
+
+
+class DataSegment:
+    """Caches the data-side quantities of the matched filter for one event and
+    detector, so that many templates can be filtered against the same stretch
+    of data without recomputing the data FFT and psd each time.
+
+    Args:
+        total_data (dict): dict containing original and whitenbp strain data
+        det (str): detector to use ('H1' or 'L1')
+        t_amount (float): amount of time (s) around event to calculate the
+            matched filter
+        lag_window (float, optional): if given, the complex SNR is only
+            computed at lags that put the template merger within lag_window (s)
+            of the event time
+    """
+
+    def __init__(self, total_data, det, t_amount=4, lag_window=None):
+        time = total_data['time']
+        self.time_center = total_data['time_center']
+        self.dt = total_data['dt']
+        self.fs = total_data['fs']
+        self.det = det
+
+        self.time_filter_window = segment_window(time, self.time_center, t_amount, self.fs)
+        self.time = time[self.time_filter_window]
+        self.size = self.time.size
+        self.peaksample = int(self.size / 2)
+
+        # fourier frequencies, window and psd on the fft grid
+        self.datafreq = np.fft.fftfreq(self.size) * self.fs
+        self.df = np.abs(self.datafreq[1] - self.datafreq[0])
+        self.dwindow = tukey(self.size, alpha=1./4)
+        self.data_psd = as_psd(total_data['large_data_psds'][det])
+        self.power_vec = self.data_psd.fft_grid(self.size, 1. / self.fs)
+
+        # data fft with the negative frequencies zeroed out
+        strain = total_data[det]['strain'][self.time_filter_window]
+        self.data_fft = fft(strain * self.dwindow) / self.fs
+        self.data_fft[self.datafreq < 0] = 0
+
+        # lags (indexes into self.time) at which the complex SNR is computed. A lag
+        # shifts the template by (lag - peaksample) samples, and the template merger
+        # sits at merger_time (near the middle of the data, not at time_center), so
+        # the window is centred on the lag that moves the merger onto time_center
+        self.lag_window = lag_window
+        if lag_window is None:
+            self.lags = np.arange(self.size)
+        else:
+            lag_center = self.peaksample + (self.time_center - merger_time(total_data)) * self.fs
+            self.lags = np.flatnonzero(np.abs(np.arange(self.size) - lag_center) <= lag_window * self.fs)
+            if self.lags.size == 0:
+                raise ValueError(f'lag window of {lag_window} s around the event lies outside the '
+                                 f'{t_amount} s segment, use a longer t_amount')
+        # ifft sample index of each lag, before the roll by peaksample
+        self._lag_index = (self.lags - self.peaksample) % self.size
+
+    def _lag_overlap(self, optimal):
+        # 4 * fs * ifft(optimal), rolled by peaksample, at self.lags only. A full
+        # inverse fft is quicker than a direct sum or a pruned fft over the lags
+        # for every segment length and lag window in use
+        return (4 * self.fs) * ifft(optimal)[..., self._lag_index]
+
+    def template_fft(self, template_p):
+        """Windows and transforms a full-length template (as returned by
+        get_template) over this segment.
+
+        Args:
+            template_p (ndarray): plus polarization of template, or a 2D array
+                with one template per row
+
+        Returns:
+            ndarray: fft of the windowed template(s)
+        """
+        template = template_p[..., self.time_filter_window[0]]
+        return fft(template * self.dwindow) / self.fs
+
+    def inner_products(self, template_fft):
+        """Computes the complex overlap of the data with the template at every
+        lag, and the template normalization.
+
+        Args:
+            template_fft (ndarray): fft of the windowed template, or a 2D array
+                with one template fft per row
+
+        Returns:
+            ndarray: complex <d|h> at each lag in self.lags (per row)
+            float or ndarray: <h|h> (per row)
+        """
+        optimal = self.data_fft * template_fft.conjugate() / self.power_vec
+        overlap = self._lag_overlap(optimal)
+        sigmasq = np.abs(2 * (template_fft * template_fft.conjugate() /
+                              self.power_vec).sum(axis=-1) * self.df)
+        return overlap, sigmasq
+
+    def peak(self, template_fft):
+        """Runs the matched filter for the given template fft(s), returning the
+        same values as matched_filter (one per row for a 2D template_fft).
+
+        Args:
+            template_fft (ndarray): fft of the windowed template(s)
+
+        Returns:
+            float: maximum SNR value obtained
+            float: time of maximum SNR value
+            float: effective distance found
+            float: horizon found
+            float: template phase which maximizes SNR
+            int: template offset which maximizes SNR
+        """
+        overlap, sigmasq = self.inner_products(template_fft)
+        sigma = np.sqrt(sigmasq)
+        indmax = np.argmax(np.abs(overlap), axis=-1)
+        peak = np.take_along_axis(overlap, np.expand_dims(indmax, -1), axis=-1)[..., 0]
+        SNRmax = np.abs(peak) / sigma
+        lagmax = self.lags[indmax]
+        return (SNRmax, self.time[lagmax], sigma / SNRmax, sigma / 8,
+                -np.angle(peak), lagmax - self.peaksample)
+
+
+
+
+def get_shifted_data(template_p, fband, filter_data, data_psd, dt, template_fft=None):
     """Obtains data shifts of templates and residual data after having found the
     best fit phase and offsets for the template.
 
@@ -104,6 +353,7 @@ def get_shifted_data(template_p, fband, filter_data, data_psd, dt):
             for given matched filter calculation
         data_psd (interpolating function): function which outputs a power value
             for a given data frequency
+        template_fft (ndarray, optional): rfft of template_p, if already known
 
     Returns:
         ndarray: whitened, bandpassed, phaseshifted and offset template
@@ -116,17 +366,19 @@ def get_shifted_data(template_p, fband, filter_data, data_psd, dt):
     offset = filter_data['offset']
 
     # whiten and bandpass template_p for plotting- also applying phase shift,
-    # amplitude scale
-    template_whitened = whiten(template_p / d_eff, data_psd, dt,
-                               phase_shift=phase, time_shift=(offset * dt))
-    template_match = bandpass(template_whitened, fband, 1. / dt)
+    # amplitude scale- as one operator on the template fft
+    if template_fft is None:
+        template_fft = rfft(template_p)
+    template_match = whiten_bandpass(template_fft / d_eff, data_psd, dt, fband, len(template_p),
+                                     phase_shift=phase, time_shift=(offset * dt))
 
     return template_match
 
 
 
 # calculate matched filter between actual template
-def calculate_matched_filter(template_p, total_data, det, t_amount=4):
+def calculate_matched_filter(template_p, total_data, det, t_amount=4, lag_window=None,
+                             segment=None):
     """Calculates the best-fit template phase, offset, d_eff, horizon, and SNRmax
     values for both detectors on a given stretch of data given the desires
     template. Also can plot template shifts/residual data and print the
@@ -135,12 +387,16 @@ def calculate_matched_filter(template_p, total_data, det, t_amount=4):
     Args:
         template_p (ndarray): plus polarization of template
         event (dict): subdictionary of BBH-events containing event parameters
-        t_amount (float): amount of time (s) around event to calcualate the
-            matched filter
+        t_amount (float or str): amount of time (s) around event to calcualate the
+            matched filter, or 'auto' to pick it with auto_segment_length
         total_data (dict): dict containing original and whitenbp strain data
         make_plots (bool, optional): if True, plot template shifts,
             whitened data, and residuals for each det.
         print_vals (bool, optional): if True, output params found
+        lag_window (float, optional): if given, only search for the SNR peak
+            within lag_window (s) of the event time
+        segment (DataSegment, optional): cached data transform for this event
+            and detector to filter against instead of the raw strain
 
     Returns:
         dict: dictionary of parameters found and residual data for each detector
@@ -160,30 +416,33 @@ def calculate_matched_filter(template_p, total_data, det, t_amount=4):
     # residuals
     filter_data = {'H1': {}, 'L1': {}}
 
-    # amount of data we want to calculate matched filter SNR over- up to 32s
-    data_time_window = time[len(time) - 1] - time[0] - (32 - t_amount)
-
-    time_filter_window = np.where((time <= time_center + data_time_window * .5) &
-                                  (time >= time_center - data_time_window * .5))
+    # amount of data we want to calculate matched filter SNR over- up to all of it
+    if t_amount == 'auto':
+        t_amount = auto_segment_length(template_p, large_data_psds[det], fs,
+                                       center=np.searchsorted(time, time_center),
+                                       max_length=len(time) / fs)
+    time_filter_window = segment_window(time, time_center, t_amount, fs)
     time_filtered = time[time_filter_window]
+    # the matched filter itself is a DataSegment's, so that the template fft it
+    # takes is reused for the display fit instead of transforming the template again
+    if segment is None:
+        segment = DataSegment(total_data, det, t_amount, lag_window)
+    template_fft = segment.template_fft(template_p)
+    SNRmax, timemax, d_eff, horizon, phase, offset = segment.peak(template_fft)
+    # the template lies in the flat part of the tukey window for segments at
+    # least as long as auto_segment_length picks, so the positive frequencies
+    # of its fft are the rfft of the template (for shorter segments they are
+    # those of the tapered template the SNR was computed with)
+    template_fft = template_fft[:segment.size // 2 + 1] * fs
     template_p = template_p[time_filter_window]
 
-    # define the template using only the plus polarization
-    template = template_p
-
     # loop over the detectors'
-    strain = total_data[det]['strain'][time_filter_window]
-    strain_whiten = total_data[det]['strain_whiten'][time_filter_window]
     strain_whitenbp = total_data[det]['strain_whitenbp'][time_filter_window]
     data_psd = large_data_psds[det]
 
     # save the time for later
     filter_data[det]['time'] = time_filtered
 
-    # find the best fit phase, offset, d_eff, horizon
-    SNRmax, timemax, d_eff, horizon, phase, offset = matched_filter(
-        template, strain, time_filtered, data_psd, fs)
-
     # save these vals for later
     filter_data[det]['SNR'] = SNRmax
     filter_data[det]['d_eff'] = d_eff
@@ -192,14 +451,225 @@ def calculate_matched_filter(template_p, total_data, det, t_amount=4):
 
     # get residuals and whitened data/template
     template_wbp = get_shifted_data(
-        template_p, fband, filter_data[det], data_psd, dt)
+        template_p, fband, filter_data[det], data_psd, dt, template_fft=template_fft)
     
     return template_wbp, strain_whitenbp, time_filtered - time_center, SNRmax, 1 / d_eff, phase
 
 
-# wrapper function for matched filter
-def wrapped_matched_filter(params, GW_signal, det):
-    return calculate_matched_filter(get_template(params, GW_signal.dictionary), GW_signal.dictionary, det)
+# wrapper function for matched filter (t_amount='auto' uses the segment length
+# picked for the event)
+def wrapped_matched_filter(params, GW_signal, det, t_amount=4, lag_window=None):
+    if t_amount == 'auto':
+        t_amount = GW_signal.auto_t_amount(det)
+    segment = None if lag_window is None else GW_signal.get_segment(det, t_amount, lag_window)
+    return calculate_matched_filter(get_template(params, GW_signal.dictionary), GW_signal.dictionary, det,
+                                    t_amount=t_amount, segment=segment)
+
+def match_waveforms(param_array, GW_signal, det, dtype=np.complex128):
+    """Frequency-domain waveforms of many parameter sets as batch_match uses them:
+    whitened by the psd of an event, normalized and kept only over the band
+    where the inverse psd is nonzero (so that those of a bank can be computed
+    once and matched against many times).
+
+    Args:
+        param_array (ndarray): component parameters (m1, m2, chi1, chi2), one
+            set per row
+        GW_signal (GWSignals): event whose psd weights the waveforms
+        det (str): detector whose psd is used
+        dtype (dtype): complex128, or complex64 to halve their memory
+
+    Returns:
+        ndarray: whitened waveforms, one per row
+    """
+    inverse_psd = GW_signal.get_inverse_psd(det)
+    band = inverse_psd > 0
+    waveforms = np.array([waveform.get_FD_waveform(params, 0.)[band]
+                          for params in np.atleast_2d(param_array)]) * np.sqrt(inverse_psd[band])
+    waveforms /= np.linalg.norm(waveforms, axis=-1, keepdims=True)
+    return waveforms.astype(dtype, copy=False)
+
+
+def batch_match(params_a, param_array, GW_signal, det, chunk_size=64, oversample=1, interpolate=False,
+                waveforms=None):
+    """Match of one parameter point against many: the overlap of the frequency-
+    domain waveforms weighted by the psd of an event, maximized over time and
+    phase and normalized, with no transforms to the time domain of either
+    template. The time maximization is one batched inverse fft of the weighted
+    product per chunk.
+
+    Args:
+        params_a (ndarray): component parameters (m1, m2, chi1, chi2)
+        param_array (ndarray): component parameters to match against, one set
+            per row
+        GW_signal (GWSignals): event whose psd weights the overlap
+        det (str): detector whose psd is used
+        chunk_size (int): number of waveforms matched together
+        oversample (int): factor to zero-pad the inverse fft by, for a finer
+            time maximization
+        interpolate (bool): if True, maximize over time between samples too,
+            with a parabola through the peak and its neighbours
+        waveforms (ndarray, optional): waveforms of param_array from
+            match_waveforms, computed here if not given
+
+    Returns:
+        ndarray: match (between 0 and 1) of params_a with each row of param_array
+    """
+    inverse_psd = GW_signal.get_inverse_psd(det)
+    band = inverse_psd > 0
+    n_fft = 2 * (inverse_psd.size - 1) * oversample
+    whitened_a = match_waveforms(params_a, GW_signal, det)[0].conjugate()
+    if waveforms is None:
+        param_array = np.atleast_2d(param_array)
+        num = len(param_array)
+    else:
+        num = len(waveforms)
+
+    matches = np.zeros(num)
+    for start in range(0, num, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        whitened_b = match_waveforms(param_array[chunk], GW_signal, det) if waveforms is None \
+            else waveforms[chunk]
+        product = np.zeros((len(whitened_b), inverse_psd.size), dtype=complex)
+        product[:, band] = whitened_b * whitened_a
+        # only positive frequencies are present, so |ifft| is maximized over phase
+        overlap = np.abs(ifft(product, n=n_fft, axis=-1)) * n_fft
+        peak = np.argmax(overlap, axis=-1)
+        rows = np.arange(len(overlap))
+        matches[chunk] = overlap[rows, peak]
+        if interpolate:
+            before, after = overlap[rows, peak - 1], overlap[rows, (peak + 1) % n_fft]
+            curvature = 2 * matches[chunk] - before - after
+            vertex = (after - before)**2 / (8 * np.where(curvature > 0, curvature, 1.))
+            matches[chunk] += np.where(curvature > 0, vertex, 0.)
+    return np.minimum(matches, 1.)
+
+
+def match(params_a, params_b, GW_signal, det, oversample=1):
+    """Match between two parameter points, weighted by the psd of an event and
+    maximized over time and phase (see batch_match).
+
+    Args:
+        params_a (ndarray): component parameters (m1, m2, chi1, chi2)
+        params_b (ndarray): component parameters (m1, m2, chi1, chi2)
+        GW_signal (GWSignals): event whose psd weights the overlap
+        det (str): detector whose psd is used
+        oversample (int): factor to zero-pad the inverse fft by
+
+    Returns:
+        float: match between 0 and 1
+    """
+    return batch_match(params_a, params_b, GW_signal, det, oversample=oversample)[0]
+
+
+def compare_decimated(params, GW_signal, det, t_amount=4):
+    """Checks the matched filter of an event analysed at a decimated sample rate
+    against the full-rate path, for one set of parameters.
+
+    Args:
+        params (ndarray): component parameters (m1, m2, chi1, chi2)
+        GW_signal (GWSignals): event, built with fs_analysis set
+        det (str): detector to compare
+        t_amount (float): amount of time (s) around event to filter
+
+    Returns:
+        dict: relative differences in SNR and amplitude, and absolute
+            differences in phase (rad) and peak time (s)
+    """
+    results = {}
+    for key, dictionary in (('full', GW_signal.full_dictionary), ('decimated', GW_signal.dictionary)):
+        segment = DataSegment(dictionary, det, t_amount)
+        results[key] = segment.peak(segment.template_fft(get_template(params, dictionary)))
+    SNR_full, time_full, d_eff_full, _, phase_full, _ = results['full']
+    SNR_dec, time_dec, d_eff_dec, _, phase_dec, _ = results['decimated']
+    return {'SNR': SNR_dec / SNR_full - 1, 'amp': d_eff_full / d_eff_dec - 1,
+            'phase': np.angle(np.exp(1.j * (phase_dec - phase_full))),
+            'time': time_dec - time_full}
+
+
+def compare_segment_length(params, GW_signal, det, t_amount='auto'):
+    """Checks the matched filter over a shorter segment against the result over
+    the whole stretch of data (32 s for the bundled events).
+
+    Args:
+        params (ndarray): component parameters (m1, m2, chi1, chi2)
+        GW_signal (GWSignals): event to filter
+        det (str): detector to compare
+        t_amount (float or str): segment length (s) to check, or 'auto'
+
+    Returns:
+        dict: segment length (s) used, relative differences in SNR and
+            amplitude, and absolute differences in phase (rad) and template
+            shift (s)
+    """
+    dictionary = GW_signal.dictionary
+    template_p = get_template(params, dictionary)
+    if t_amount == 'auto':
+        t_amount = GW_signal.auto_t_amount(det)
+    results = {}
+    for key, length in (('full', len(dictionary['time']) / dictionary['fs']), ('short', t_amount)):
+        segment = DataSegment(dictionary, det, length)
+        results[key] = segment.peak(segment.template_fft(template_p))
+    # the peak times are relative to where each segment is centred (the whole
+    # stretch cannot be centred on time_center), so the template shifts are compared
+    SNR_full, _, d_eff_full, _, phase_full, offset_full = results['full']
+    SNR_short, _, d_eff_short, _, phase_short, offset_short = results['short']
+    return {'t_amount': t_amount, 'SNR': SNR_short / SNR_full - 1,
+            'amp': d_eff_full / d_eff_short - 1,
+            'phase': np.angle(np.exp(1.j * (phase_short - phase_full))),
+            'time': (offset_short - offset_full) / dictionary['fs']}
+
 
 def residual_func(data, fit):
-    return data-fit
\ No newline at end of file
+    return data-fit
+
+
+def batch_matched_filter(param_array, GW_signal, dets=('H1', 'L1'), t_amount=4,
+                         chunk_size=64, segments=None, lag_window=None, dictionary=None,
+                         generator=waveform):
+    """Runs the matched filter for many parameter sets against one event without
+    building any plot outputs. The data transform is shared by every template,
+    and templates are filtered in chunks with one batched fft per chunk.
+
+    Args:
+        param_array (ndarray): component parameters (m1, m2, chi1, chi2), one
+            set per row
+        GW_signal (GWSignals): event to filter
+        dets (list): detectors to filter
+        t_amount (float): amount of time (s) around event to calculate the
+            matched filter
+        chunk_size (int): number of templates transformed together
+        segments (dict, optional): DataSegment per detector to reuse between
+            calls, built from GW_signal if not given
+        lag_window (float, optional): if given (and segments is not), only
+            search for the SNR peak within lag_window (s) of the event time
+        dictionary (dict, optional): event dict the segments were built from,
+            defaults to GW_signal.dictionary
+        generator (Waveform, optional): waveform generator of the templates,
+            such as a template.coarse_waveform for approximate ones
+
+    Returns:
+        ndarray: maximum SNR, shape (number of parameter sets, number of dets)
+        ndarray: template phase which maximizes SNR
+        ndarray: template offset (samples) which maximizes SNR
+        ndarray: effective distance found
+    """
+    param_array = np.atleast_2d(param_array)
+    if dictionary is None:
+        dictionary = GW_signal.dictionary
+    if segments is None:
+        segments = {det: GW_signal.get_segment(det, t_amount, lag_window) for det in dets}
+
+    shape = (len(param_array), len(dets))
+    SNRmax, phase, d_eff = np.zeros(shape), np.zeros(shape), np.zeros(shape)
+    offset = np.zeros(shape, dtype=int)
+
+    for start in range(0, len(param_array), chunk_size):
+        chunk = slice(start, start + chunk_size)
+        templates = np.array([get_template(params, dictionary, generator)
+                              for params in param_array[chunk]])
+        for j, det in enumerate(dets):
+            segment = segments[det]
+            (SNRmax[chunk, j], _, d_eff[chunk, j], _,
+             phase[chunk, j], offset[chunk, j]) = segment.peak(segment.template_fft(templates))
+
+    return SNRmax, phase, offset, d_eff
@@ -0,0 +1,130 @@
+'''Prepare the data of the events listed in a manifest, in parallel: psds from
+the 4096 s files, whitened and bandpassed strain from the 32 s files, written
+in the format of event_store.py. Events whose inputs have not changed since
+they were last prepared are skipped.'''
+
+
+import argparse
+import hashlib
+import json
+import os
+import time as timer
+from multiprocessing import Pool
+
+from event_store import format_version, save_event, store_dir, store_path
+from product_cache import product_versions
+
+
+# name of the file recording the inputs an event was prepared from
+source_filename = 'source.json'
+
+
+def read_manifest(filename):
+    """Events listed in a manifest: a json list with, for each event, its name,
+    time_center (GPS), data_files (the 32 s file of each detector),
+    large_data_filename (the 4096 s files, without the added 'H-<det>_'),
+    fband and ref_params (m1, m2, chi_eff, chi_a).
+    """
+    with open(filename) as f:
+        return json.load(f)
+
+
+def input_filenames(entry, data_dir='.'):
+    """Data files an event is prepared from."""
+    large_data_filename = os.path.join(data_dir, entry['large_data_filename'])
+    head, tail = os.path.split(large_data_filename)
+    return [os.path.join(data_dir, entry['data_files']['H1']),
+            os.path.join(data_dir, entry['data_files']['L1']),
+            os.path.join(head, 'H-H1_' + tail),
+            os.path.join(head, 'L-L1_' + tail)]
+
+
+def content_hash(entry, data_dir='.', block_size=1 << 20):
+    """Hash of everything an event's prepared data depends on: the contents of
+    its data files, its time_center and fband, the format version and the
+    versions of the code computing its psds, whitened and bandpassed data.
+    """
+    digest = hashlib.sha256()
+    digest.update(json.dumps({'format_version': format_version,
+                              'product_versions': {kind: product_versions[kind] for kind in
+                                                   ('welch_psd', 'whiten', 'bandpass')},
+                              'time_center': entry['time_center'],
+                              'fband': entry['fband']}, sort_keys=True).encode())
+    for filename in input_filenames(entry, data_dir):
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def is_prepared(path, digest):
+    """Whether an event directory holds data prepared from inputs with this hash."""
+    try:
+        with open(os.path.join(path, source_filename)) as f:
+            source = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return source.get('hash') == digest and os.path.exists(os.path.join(path, 'meta.json'))
+
+
+def prepare_event(entry, data_dir='.', outdir=store_dir, force=False):
+    """Prepares one event of a manifest, unless it is already up to date.
+
+    Returns:
+        str: name of the event
+        str: 'prepared', 'skipped' or the error which stopped it (any error is
+            reported, so that one event cannot stop the others)
+        float: time taken (s)
+    """
+    t0 = timer.perf_counter()
+    path = store_path(entry['name'], outdir)
+    try:
+        digest = content_hash(entry, data_dir)
+        if not force and is_prepared(path, digest):
+            return entry['name'], 'skipped', timer.perf_counter() - t0
+        from get_data import get_strain_whitenbp_data
+        fn_H1, fn_L1, _, _ = input_filenames(entry, data_dir)
+        total_data = get_strain_whitenbp_data(fn_H1, fn_L1, entry['fband'],
+                                              os.path.join(data_dir, entry['large_data_filename']),
+                                              entry['time_center'])
+        save_event(total_data, path)
+        with open(os.path.join(path, source_filename), 'w') as f:
+            json.dump({'hash': digest, **entry}, f, indent=2)
+    except Exception as error:
+        return entry['name'], f'failed: {type(error).__name__}: {error}', timer.perf_counter() - t0
+    return entry['name'], 'prepared', timer.perf_counter() - t0
+
+
+def _prepare_task(task):
+    return prepare_event(*task)
+
+
+def prepare_events(entries, data_dir='.', outdir=store_dir, force=False, processes=None):
+    """Prepares the events of a manifest over a pool of processes.
+
+    Yields:
+        tuple: result of prepare_event for each event, as they finish
+    """
+    tasks = [(entry, data_dir, outdir, force) for entry in entries]
+    with Pool(processes) as pool:
+        yield from pool.imap_unordered(_prepare_task, tasks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('manifest', nargs='?', default='data/events_manifest.json')
+    parser.add_argument('events', nargs='*', help='events of the manifest to prepare (default: all)')
+    parser.add_argument('--data-dir', default='.', help='directory the data files are in')
+    parser.add_argument('--outdir', default=store_dir)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help='prepare events even if up to date')
+    args = parser.parse_args()
+
+    entries = read_manifest(args.manifest)
+    if args.events:
+        entries = [entry for entry in entries if entry['name'] in args.events]
+    t0 = timer.perf_counter()
+    for name, status, elapsed in prepare_events(entries, args.data_dir, args.outdir, args.force,
+                                                args.processes):
+        print(f'{name}: {status} ({elapsed:.1f} s)')
+    print(f'{len(entries)} events in {timer.perf_counter() - t0:.1f} s')
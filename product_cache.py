@@ -0,0 +1,219 @@
+'''Cache of products derived from the data (psds, whitened and bandpassed
+series, templates): a directory of .npy files named by a hash of everything
+each product is computed from, with an index listing what each file holds.
+Products are looked up before they are computed, so changing one setting only
+recomputes the products which depend on it. The cache is kept under a size by
+removing the least recently used products, and is only an optimization: if
+it cannot be written to, products are computed without it.'''
+
+
+import hashlib
+import json
+import os
+import tempfile
+import time as timer
+import warnings
+
+import numpy as np
+from constants import product_cache_dir, product_cache_max_bytes
+from psd import PSD
+
+
+# changed whenever the layout of the cache changes, invalidating every product
+cache_version = 1
+
+# version of the code computing each kind of product, part of its keys: bumped
+# whenever that computation changes, so that only the products of that kind
+# (and those derived from them) are computed again
+product_versions = {
+    'welch_psd': 2,  # mlab.psd replaced by welch_psd
+    'whiten': 1,
+    'bandpass': 1,
+    'template': 1,
+}
+
+index_filename = 'index.jsonl'
+
+
+def _canonical(value):
+    # json-serializable form of a processing parameter
+    if isinstance(value, (np.ndarray, np.generic, list, tuple)):
+        return np.asarray(value).tolist()
+    return value
+
+
+class ProductKey(str):
+    """Key of a cached product, which can stand in for the product as an input
+    of the products derived from it (so their keys are found without hashing
+    the product itself)."""
+
+
+def _update(digest, value):
+    if isinstance(value, ProductKey):
+        digest.update(b'key' + value.encode())
+    elif isinstance(value, PSD):
+        digest.update(b'psd' + np.float64([value.f0, value.df]).tobytes())
+        _update(digest, value.values)
+    elif isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        digest.update(f'array{value.dtype.str}{value.shape}'.encode())
+        digest.update(value.data)
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'sequence{len(value)}'.encode())
+        for item in value:
+            _update(digest, item)
+    else:
+        digest.update(repr(value).encode())
+
+
+def product_key(kind, inputs=(), params=None):
+    """Key of a product: hash of its kind and the version of its code, its inputs
+    (arrays, psds or keys of other products) and its processing parameters."""
+    digest = hashlib.sha256()
+    digest.update(f'{cache_version}:{kind}:{product_versions.get(kind, 1)}:'.encode())
+    _update(digest, list(inputs))
+    digest.update(json.dumps({name: _canonical(value) for name, value in (params or {}).items()},
+                             sort_keys=True).encode())
+    return ProductKey(f'{kind}-{digest.hexdigest()[:32]}')
+
+
+class ProductCache:
+    """Directory of cached products.
+
+    Args:
+        directory (str, optional): directory to keep the products in (None
+            disables the cache, so products are always computed)
+        max_bytes (int, optional): size the products are kept under (None for
+            no limit)
+    """
+
+    def __init__(self, directory=product_cache_dir, max_bytes=product_cache_max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.write_errors = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def get(self, key):
+        """Cached product (memory-mapped read-only), or None."""
+        try:
+            product = np.load(self.path(key), mmap_mode='r')
+        except (OSError, ValueError):
+            return None
+        self.hits += 1
+        try:
+            # the modification time marks when a product was last used
+            os.utime(self.path(key))
+        except OSError:
+            pass
+        return product
+
+    def put(self, key, product, params=None):
+        """Stores a product, written under a temporary name (unique to the
+        thread) and then renamed so that other processes never see a partial
+        file, then removes the least recently used products above max_bytes."""
+        os.makedirs(self.directory, exist_ok=True)
+        product = np.asarray(product)
+        fd, tmp_filename = tempfile.mkstemp(prefix=f'{key}.', suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, product)
+            os.replace(tmp_filename, self.path(key))
+        except BaseException:
+            try:
+                os.remove(tmp_filename)
+            except OSError:
+                pass
+            raise
+        kind = key.rsplit('-', 1)[0]
+        entry = {'key': key, 'kind': kind, 'version': product_versions.get(kind, 1),
+                 'shape': list(product.shape), 'dtype': product.dtype.str,
+                 'params': {name: _canonical(value) for name, value in (params or {}).items()},
+                 'created': timer.time()}
+        # single appends of a line, so processes can add to the index together
+        with open(os.path.join(self.directory, index_filename), 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+        if self.max_bytes is not None:
+            self.evict(self.max_bytes)
+
+    def evict(self, max_bytes):
+        """Removes the least recently used products until the cache holds at
+        most max_bytes."""
+        products = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.npy'):
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    products.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in products)
+        for _, size, path in sorted(products):
+            if total <= max_bytes:
+                break
+            try:
+                # processes which have the product mapped keep reading it
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def fetch(self, kind, compute, inputs=(), params=None):
+        """Product of a kind for given inputs and parameters, computed with
+        compute() and stored if it is not in the cache.
+
+        Returns:
+            ndarray: the product
+            ProductKey: its key (None if the cache is disabled)
+        """
+        if self.directory is None:
+            return compute(), None
+        key = product_key(kind, inputs, params)
+        product = self.get(key)
+        if product is None:
+            self.misses += 1
+            product = compute()
+            try:
+                self.put(key, product, params)
+            except OSError as error:
+                # e.g. a read-only checkout: the product is used uncached
+                if not self.write_errors:
+                    warnings.warn(f'products cannot be cached in {self.directory} ({error}), '
+                                  'so they are computed each time')
+                self.write_errors += 1
+        return product, key
+
+    def index(self):
+        """Entries of the products in the cache, by key."""
+        entries = {}
+        if self.directory is None:
+            return entries
+        try:
+            with open(os.path.join(self.directory, index_filename)) as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if os.path.exists(self.path(entry['key'])):
+                        entries[entry['key']] = entry
+        except OSError:
+            pass
+        return entries
+
+    def clear(self, kind=None):
+        """Removes every product (or those of one kind) from the cache."""
+        entries = self.index()
+        for key, entry in list(entries.items()):
+            if kind is None or entry['kind'] == kind:
+                os.remove(self.path(key))
+                del entries[key]
+        if self.directory is not None and os.path.isdir(self.directory):
+            with open(os.path.join(self.directory, index_filename), 'w') as f:
+                for entry in entries.values():
+                    f.write(json.dumps(entry) + '\n')
+
+
+# cache used by get_data, signal_processing and template
+product_cache = ProductCache()
@@ -0,0 +1,115 @@
+'''Power spectral density sampled on a uniform frequency grid.'''
+
+
+import numpy as np
+from numba import njit
+
+
+@njit()
+def _interp_uniform(freqs, f0, df, values):
+    # linear interpolation on a uniform grid, by index arithmetic
+    last = len(values) - 1
+    out = np.empty(freqs.size)
+    for i, freq in enumerate(freqs):
+        position = (freq - f0) / df
+        if position < -1e-9 or position > last + 1e-9:
+            raise ValueError('frequencies outside the range of the psd')
+        index = min(max(int(position), 0), last - 1)
+        out[i] = values[index] + (position - index) * (values[index + 1] - values[index])
+    return out
+
+
+class PSD:
+    """Psd sampled at frequencies f0 + k * df, evaluated by linear interpolation
+    (like the scipy interp1d it replaces) with index arithmetic instead of a
+    search. The psd, asd and inverse psd on the fft grids the data is
+    transformed on are cached, and the object pickles as its three fields only.
+
+    Args:
+        f0 (float): first frequency (Hz)
+        df (float): frequency spacing (Hz)
+        values (ndarray): psd at each frequency
+    """
+
+    # number of grids kept in the cache of each psd
+    max_cached = 16
+
+    def __init__(self, f0, df, values):
+        self.f0 = float(f0)
+        self.df = float(df)
+        self.values = np.asarray(values, dtype=float)
+        self._cache = {}
+
+    @classmethod
+    def from_interp(cls, interp_psd):
+        """Converts an interpolated psd (with .x and .y, e.g. scipy interp1d),
+        resampling it onto a uniform grid if its frequencies are not."""
+        freqs, values = np.asarray(interp_psd.x), np.asarray(interp_psd.y)
+        spacing = np.diff(freqs)
+        if np.allclose(spacing, spacing[0]):
+            return cls(freqs[0], spacing[0], values)
+        df = spacing.min()
+        uniform = np.arange(freqs[0], freqs[-1] + 0.5 * df, df)
+        return cls(freqs[0], df, np.interp(uniform, freqs, values))
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """Builds a psd from the arrays returned by to_arrays."""
+        return cls(float(arrays['f0']), float(arrays['df']), arrays['values'])
+
+    def to_arrays(self):
+        """Plain arrays describing the psd, e.g. for np.savez."""
+        return {'f0': np.float64(self.f0), 'df': np.float64(self.df), 'values': self.values}
+
+    def __getstate__(self):
+        return {'f0': self.f0, 'df': self.df, 'values': self.values}
+
+    def __setstate__(self, state):
+        self.__init__(state['f0'], state['df'], state['values'])
+
+    @property
+    def x(self):
+        """Frequencies the psd is sampled at."""
+        return self.f0 + self.df * np.arange(len(self.values))
+
+    @property
+    def y(self):
+        """Psd at each frequency of x."""
+        return self.values
+
+    def __call__(self, freqs):
+        freqs = np.asarray(freqs, dtype=float)
+        return _interp_uniform(freqs.ravel(), self.f0, self.df, self.values).reshape(freqs.shape)
+
+    def _cached(self, key, compute):
+        # cached vectors are shared between callers, so they are made read-only
+        if key not in self._cache:
+            if len(self._cache) >= self.max_cached:
+                self._cache.pop(next(iter(self._cache)))
+            vector = compute()
+            vector.flags.writeable = False
+            self._cache[key] = vector
+        return self._cache[key]
+
+    def rfft_grid(self, n, dt):
+        """Psd at the frequencies of np.fft.rfftfreq(n, dt)."""
+        return self._cached(('psd', n, dt), lambda: self(np.fft.rfftfreq(n, dt)))
+
+    def fft_grid(self, n, dt):
+        """Psd at the absolute frequencies of np.fft.fftfreq(n, dt)."""
+        return self._cached(('fft', n, dt), lambda: self(np.abs(np.fft.fftfreq(n, dt))))
+
+    def asd(self, n, dt):
+        """Amplitude spectral density at the frequencies of np.fft.rfftfreq(n, dt)."""
+        return self._cached(('asd', n, dt), lambda: np.sqrt(self.rfft_grid(n, dt)))
+
+    def inverse(self, n, dt):
+        """Inverse psd at the frequencies of np.fft.rfftfreq(n, dt)."""
+        return self._cached(('inverse', n, dt), lambda: 1. / self.rfft_grid(n, dt))
+
+
+def as_psd(interp_psd):
+    """Returns interp_psd as a PSD, converting an interpolated psd if needed."""
+    if isinstance(interp_psd, PSD):
+        return interp_psd
+    return PSD.from_interp(interp_psd)
@@ -0,0 +1,269 @@
+'''Replay a strain file as if it were a live detector stream: chunks arrive one
+at a time, the psd is tracked as they do, and each chunk is whitened,
+bandpassed and matched filtered against a few templates, with the latency of
+every chunk measured.'''
+
+
+import argparse
+import time as timer
+
+import numpy as np
+from scipy.signal import sosfilt
+from scipy.signal.windows import tukey
+from fft_backend import rfft, irfft, next_fast_len
+from signal_processing import butter_bandpass
+from streaming import RollingPSD, StreamingFilter, read_blocks
+
+
+class ExponentialPSD(RollingPSD):
+    """Psd estimate which is an exponentially weighted average of the
+    periodograms of the stream, forgetting old data over decay_time (s). Until
+    decay_time of data has been seen it is a plain average.
+    """
+
+    def __init__(self, fs, segment_duration=4., decay_time=64.):
+        super().__init__(fs, segment_duration, psd_duration=segment_duration)
+        self.weight = min(self.hop / (decay_time * fs), 1.)
+        self.average = None
+        self.num_added = 0
+
+    def add(self, periodogram):
+        self.num_added += 1
+        if self.average is None:
+            self.average = periodogram
+        else:
+            weight = max(self.weight, 1. / self.num_added)
+            self.average = self.average + weight * (periodogram - self.average)
+
+    @property
+    def duration(self):
+        """Length (s) of data averaged so far."""
+        return (self.num_added + 1) * self.hop / self.fs if self.num_added else 0.
+
+    def estimate(self):
+        return self.average
+
+
+class RingBuffer:
+    """Fixed-length buffer holding the most recent samples of a stream."""
+
+    def __init__(self, length):
+        self.data = np.zeros(length)
+        self.index = 0
+        self.count = 0
+
+    def extend(self, samples):
+        length = len(self.data)
+        # of a chunk longer than the buffer, only the last length samples stay
+        num = len(samples)
+        samples = samples[-length:]
+        start = self.index + num - len(samples)
+        self.data[(start + np.arange(len(samples))) % length] = samples
+        self.index = (self.index + num) % length
+        self.count = min(self.count + num, length)
+
+    def latest(self, num):
+        """Most recent num samples, oldest first."""
+        return self.data[(self.index - num + np.arange(num)) % len(self.data)]
+
+    def clear(self):
+        self.count = 0
+
+    @property
+    def full(self):
+        return self.count == len(self.data)
+
+
+class OnlineWhitener:
+    """Whitens and bandpasses a stream chunk by chunk: whitening is a linear-
+    phase FIR filter built from the current psd (so its output lags the input
+    by half the kernel), and bandpassing is the causal form of
+    signal_processing.bandpass, carrying the filter state between chunks.
+
+    Args:
+        psd (RollingPSD): psd estimate of the stream
+        fs (float): sample rate of the data
+        chunk_length (int): samples per chunk
+        kernel_duration (float): length (s) of the whitening filter
+        fband (list): low and high-pass filter values used for the bandpass
+    """
+
+    def __init__(self, psd, fs, chunk_length, kernel_duration=2., fband=(35.0, 350.0)):
+        self.psd = psd
+        self.fs = fs
+        self.chunk_length = chunk_length
+        self.kernel_length = 2 * int(kernel_duration * fs / 2)
+        self.taper = tukey(self.kernel_length, alpha=1./4)
+        self.fft_length = next_fast_len(self.kernel_length + chunk_length, real=True)
+        self.sos = butter_bandpass(fband, fs)
+        self.normalization = np.sqrt((fband[1]-fband[0])/(fs/2))
+        self.reset()
+
+    def reset(self):
+        self.state = np.zeros((self.sos.shape[0], 2))
+
+    def kernel_fft(self):
+        # whitening filter of whiten() (1 / asd, with the same normalization),
+        # truncated to kernel_length and delayed to be causal
+        freqs = np.fft.rfftfreq(self.kernel_length, 1. / self.fs)
+        norm = 1./np.sqrt(self.fs/2)
+        kernel = np.roll(irfft(norm / np.sqrt(self.psd(freqs)), n=self.kernel_length),
+                         self.kernel_length // 2) * self.taper
+        return rfft(kernel, n=self.fft_length)
+
+    def process(self, history):
+        """Whitened and bandpassed data for the newest chunk of a stream.
+
+        Args:
+            history (ndarray): the last kernel_length + chunk_length samples of
+                raw strain
+
+        Returns:
+            ndarray: whitened data, ending kernel_length / 2 samples before the
+                newest sample
+            ndarray: whitened and bandpassed data
+        """
+        whitened = irfft(rfft(history, n=self.fft_length) * self.kernel_fft(), n=self.fft_length)
+        whitened = whitened[self.kernel_length:self.kernel_length + self.chunk_length]
+        whitenbp, self.state = sosfilt(self.sos, whitened, zi=self.state)
+        return whitened, whitenbp / self.normalization
+
+
+class RealtimeReplay:
+    """Stateful pipeline run on each chunk of a live stream: ring buffer, psd
+    tracking, whitening, bandpass and matched filter.
+
+    Args:
+        param_array (ndarray): component parameters (m1, m2, chi1, chi2) of the
+            templates, one set per row
+        fs (float): sample rate of the data
+        chunk_duration (float): length (s) of each chunk
+        kernel_duration (float): length (s) of the whitening filter and of the
+            truncated inverse psd of the matched filter
+        decay_time (float): time (s) over which the psd forgets old data
+        fband (list): low and high-pass filter values used for the bandpass
+        threshold (float): smallest SNR of a trigger
+        cluster_window (float): length (s) of the windows triggers are
+            clustered over
+        warmup (float): length (s) of data the psd averages before chunks are
+            whitened and filtered
+    """
+
+    def __init__(self, param_array, fs, chunk_duration=1., kernel_duration=2., decay_time=64.,
+                 fband=(35.0, 350.0), threshold=6., cluster_window=1., warmup=16.):
+        self.fs = fs
+        self.warmup = warmup
+        self.chunk_length = int(chunk_duration * fs)
+        self.threshold = threshold
+        self.cluster_length = min(int(cluster_window * fs), self.chunk_length)
+
+        self.psd = ExponentialPSD(fs, decay_time=decay_time)
+        self.whitener = OnlineWhitener(self.psd, fs, self.chunk_length, kernel_duration, fband)
+        # the filter block is just long enough to give one chunk of new lags
+        self.filter = StreamingFilter(param_array, fs, kernel_duration=kernel_duration,
+                                      psd=self.psd, step_duration=chunk_duration)
+        self.buffer = RingBuffer(max(self.filter.block_length,
+                                     self.whitener.kernel_length + self.chunk_length))
+        self.latencies = []
+
+    def reset(self):
+        """Starts over after a gap in the stream (keeping the psd)."""
+        self.buffer.clear()
+        self.psd.reset()
+        self.whitener.reset()
+
+    def process(self, chunk, chunk_time, arrival=None):
+        """Runs the pipeline on the next chunk of the stream.
+
+        Args:
+            chunk (ndarray): chunk_length samples of raw strain
+            chunk_time (float): time of the first sample of the chunk
+            arrival (float, optional): wall-clock time (timer.perf_counter) at
+                which the chunk arrived, defaults to now
+
+        Returns:
+            dict: time of the chunk, whitened and bandpassed data (lagging the
+                chunk by kernel_duration / 2, empty during the warmup),
+                triggers found and latency (s) of the chunk
+        """
+        arrival = timer.perf_counter() if arrival is None else arrival
+        result = {'time': chunk_time, 'strain_whiten': np.zeros(0),
+                  'strain_whitenbp': np.zeros(0), 'triggers': []}
+        if not np.all(np.isfinite(chunk)):
+            self.reset()
+        else:
+            self.buffer.extend(chunk)
+            self.psd.update(chunk)
+            history_length = self.whitener.kernel_length + self.chunk_length
+            ready = self.psd.duration >= self.warmup
+            if ready and self.buffer.count >= history_length:
+                result['strain_whiten'], result['strain_whitenbp'] = \
+                    self.whitener.process(self.buffer.latest(history_length))
+            if ready and self.buffer.full:
+                block = self.buffer.latest(self.filter.block_length)
+                snr = self.filter.filter_block(block)[:, -self.chunk_length:]
+                block_time = chunk_time + (self.chunk_length - self.filter.block_length) / self.fs
+                lag_time = block_time + (self.filter.lag_start + self.filter.step -
+                                         self.chunk_length) / self.fs
+                result['triggers'] = self.filter.cluster(snr, lag_time, self.threshold,
+                                                         self.cluster_length)
+        result['latency'] = timer.perf_counter() - arrival
+        self.latencies.append(result['latency'])
+        return result
+
+    def replay(self, filename, realtime=False):
+        """Replays a strain file chunk by chunk.
+
+        Args:
+            filename (str): strain file (with a strain/Strain dataset)
+            realtime (bool): if True, deliver chunks at the rate they would
+                arrive from the detector, otherwise as fast as they are processed
+
+        Yields:
+            dict: result of process() for each chunk
+        """
+        start = timer.perf_counter()
+        # a last partial chunk is left out (with a warning), as a live stream
+        # would not deliver it until it is complete
+        for i, (chunk_time, chunk) in enumerate(read_blocks(filename, self.chunk_length,
+                                                            self.chunk_length, align_last=False)):
+            arrival = timer.perf_counter()
+            if realtime:
+                # the chunk is complete once its last sample has been recorded
+                arrival = start + (i + 1) * self.chunk_length / self.fs
+                timer.sleep(max(arrival - timer.perf_counter(), 0.))
+            yield self.process(chunk, chunk_time, arrival)
+
+
+def latency_summary(latencies):
+    """Mean, median, 99th percentile and maximum of per-chunk latencies (s)."""
+    latencies = np.asarray(latencies)
+    return {'mean': latencies.mean(), 'median': np.median(latencies),
+            'p99': np.percentile(latencies, 99), 'max': latencies.max()}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('filename', help='strain file (e.g. H-H1_LOSC_4_V2-1126257414-4096.hdf5)')
+    parser.add_argument('--event', default='GW150914',
+                        help='bundled event whose reference parameters give the template')
+    parser.add_argument('--chunk-duration', type=float, default=1.)
+    parser.add_argument('--threshold', type=float, default=8.)
+    parser.add_argument('--realtime', action='store_true',
+                        help='deliver chunks at the rate of the detector')
+    args = parser.parse_args()
+
+    import h5py
+    from GW_class import GW_events
+    with h5py.File(args.filename, 'r') as hdf_file:
+        fs = 1. / hdf_file['strain/Strain'].attrs['Xspacing']
+    pipeline = RealtimeReplay(GW_events[args.event].comp_params, fs,
+                              chunk_duration=args.chunk_duration, threshold=args.threshold)
+    for result in pipeline.replay(args.filename, realtime=args.realtime):
+        for trigger in result['triggers']:
+            print(f"{trigger['time']:.4f}: SNR {trigger['SNR']:.2f} "
+                  f"(latency {result['latency'] * 1e3:.1f} ms)")
+    summary = latency_summary(pipeline.latencies)
+    print(f"{len(pipeline.latencies)} chunks: latency {summary['mean'] * 1e3:.1f} ms mean, "
+          f"{summary['median'] * 1e3:.1f} ms median, {summary['p99'] * 1e3:.1f} ms 99th percentile, "
+          f"{summary['max'] * 1e3:.1f} ms max")
@@ -0,0 +1,270 @@
+'''Sample the posterior of the slider parameters (Mc, q, chi+, chi-) for the
+bundled events with an ensemble of walkers run across a process pool.'''
+
+
+import argparse
+import json
+import os
+import time as timer
+from multiprocessing import Pool
+
+import numpy as np
+from pycbc.conversions import mass1_from_mchirp_q, mass2_from_mchirp_q
+from pycbc.conversions import spin1z_from_mass1_mass2_chi_eff_chi_a, spin2z_from_mass1_mass2_chi_eff_chi_a
+import constants as c
+from matched_filter import distance_table, marginalized_loglike
+from template import get_template
+
+
+# names of the sampled parameters, in order
+param_names = ['chirp', 'ratio', 'spin_plus', 'spin_minus']
+num_sampled = len(param_names)
+
+
+def get_comp_params(sample):
+    """Converts a sample in (Mc, q, chi+, chi-) to component parameters, the same
+    way widgets.get_comp_params does for the sliders.
+    """
+    chirp, ratio, spin_plus, spin_minus = sample
+    m1 = mass1_from_mchirp_q(chirp, 1. / ratio)
+    m2 = mass2_from_mchirp_q(chirp, 1. / ratio)
+    chi1 = spin1z_from_mass1_mass2_chi_eff_chi_a(m1, m2, spin_plus, spin_minus)
+    chi2 = spin2z_from_mass1_mass2_chi_eff_chi_a(m1, m2, spin_plus, spin_minus)
+    return np.array([m1, m2, chi1, chi2])
+
+
+class MarginalizedLikelihood:
+    """Posterior over (Mc, q, chi+, chi-) for one event, with phase, time and
+    distance marginalized independently in each detector (the slider works with
+    effective distances, so there is no antenna pattern to tie them together).
+
+    Args:
+        GW_signal (GWSignals): event to sample
+        dets (list): detectors to include
+        t_amount (float): amount of time (s) around event to filter
+        time_window (float): half width (s) of the time prior around the event
+    """
+
+    def __init__(self, GW_signal, dets=('H1', 'L1'), t_amount=4, time_window=0.1):
+        self.dictionary = GW_signal.dictionary
+        self.segments = [GW_signal.get_segment(det, t_amount, lag_window=time_window)
+                         for det in dets]
+        self.scales, self.log_weights = distance_table()
+
+        # prior ranges follow the slider ranges around the reference parameters
+        self.bounds = np.array([[max(GW_signal.chirp - 10., 1.), GW_signal.chirp + 10.],
+                                [c.ratio_min, c.ratio_max],
+                                [c.spin_plus_min, c.spin_plus_max],
+                                [c.spin_minus_min, c.spin_minus_max]])
+        self.reference = np.array([GW_signal.chirp, GW_signal.ratio,
+                                   GW_signal.chiPlus, GW_signal.chiMinus])
+
+    def in_prior(self, sample):
+        """Whether a sample lies inside the (uniform) prior."""
+        if np.any(sample <= self.bounds[:, 0]) or np.any(sample > self.bounds[:, 1]):
+            return False
+        chi1, chi2 = get_comp_params(sample)[2:]
+        return c.chi1_min <= chi1 <= c.chi1_max and c.chi2_min <= chi2 <= c.chi2_max
+
+    def log_likelihood(self, sample):
+        template_p = get_template(get_comp_params(sample), self.dictionary)
+        log_like = 0.
+        for segment in self.segments:
+            overlap, sigmasq = segment.inner_products(segment.template_fft(template_p))
+            log_like += marginalized_loglike(overlap, sigmasq, self.scales, self.log_weights)
+        return log_like
+
+    def __call__(self, sample):
+        if not self.in_prior(sample):
+            return -np.inf
+        return self.log_likelihood(sample)
+
+
+# likelihood held by each pool worker, so it is only built once per process
+_likelihood = None
+
+
+def _init_worker(event_name, dets, t_amount, time_window):
+    global _likelihood
+    from GW_class import GW_events
+    _likelihood = MarginalizedLikelihood(GW_events[event_name], dets, t_amount, time_window)
+
+
+def _evaluate(sample):
+    t0 = timer.perf_counter()
+    log_prob = _likelihood(sample)
+    return log_prob, timer.perf_counter() - t0
+
+
+def _save_checkpoint(filename, chain, log_prob, num_accepted, num_evals, eval_time, rng):
+    # write to a temporary file first so an interrupted save keeps the old checkpoint
+    tmp_filename = filename + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+        np.savez(f, chain=chain, log_prob=log_prob, num_accepted=num_accepted,
+                 num_evals=num_evals, eval_time=eval_time,
+                 rng_state=json.dumps(rng.bit_generator.state))
+    os.replace(tmp_filename, filename)
+
+
+def _load_checkpoint(filename, rng):
+    with np.load(filename) as checkpoint:
+        rng.bit_generator.state = json.loads(str(checkpoint['rng_state']))
+        return (checkpoint['chain'], checkpoint['log_prob'], checkpoint['num_accepted'],
+                int(checkpoint['num_evals']), float(checkpoint['eval_time']))
+
+
+def run_sampler(event_name, nwalkers=32, nsteps=500, burn_in=None, processes=None,
+                dets=('H1', 'L1'), t_amount=4, time_window=0.1,
+                checkpoint=None, checkpoint_every=10, seed=None, a=2.):
+    """Runs an affine-invariant ensemble sampler (Goodman & Weare stretch move)
+    over (Mc, q, chi+, chi-) for one bundled event. Each half of the ensemble is
+    evaluated in parallel across a process pool.
+
+    Args:
+        event_name (str): name of a bundled event (a key of GW_class.GW_events)
+        nwalkers (int): number of walkers (even, at least twice the dimension)
+        nsteps (int): total number of ensemble steps
+        burn_in (int, optional): steps discarded from the samples, defaults to
+            half of nsteps
+        processes (int, optional): size of the process pool, defaults to all cores
+        dets (list): detectors to include in the likelihood
+        t_amount (float): amount of time (s) around event to filter
+        time_window (float): half width (s) of the time prior around the event
+        checkpoint (str, optional): file to checkpoint to, and resume from if it
+            already exists (it must have the same nwalkers and at most nsteps)
+        checkpoint_every (int): number of steps between checkpoints
+        seed (int, optional): seed for the random number generator
+        a (float): scale parameter of the stretch move
+
+    Returns:
+        dict: posterior samples, chain, log posterior, acceptance fraction and
+            timing/scaling information
+    """
+    if nwalkers % 2 or nwalkers < 2 * num_sampled:
+        raise ValueError('nwalkers must be even and at least %d' % (2 * num_sampled))
+    processes = processes or os.cpu_count()
+    burn_in = nsteps // 2 if burn_in is None else burn_in
+    rng = np.random.default_rng(seed)
+
+    # serial cost of one likelihood, measured in this process before the pool starts
+    _init_worker(event_name, dets, t_amount, time_window)
+    likelihood = _likelihood
+    num_calibration = min(nwalkers, 8)
+    calibration = likelihood.reference + 1e-3 * rng.standard_normal((num_calibration, num_sampled))
+    t0 = timer.perf_counter()
+    for sample in calibration:
+        likelihood.log_likelihood(sample)
+    serial_cost = (timer.perf_counter() - t0) / num_calibration
+
+    if checkpoint is not None and os.path.exists(checkpoint):
+        chain, log_prob, num_accepted, num_evals, eval_time = _load_checkpoint(checkpoint, rng)
+        start = chain.shape[0]
+        if chain.shape[1:] != (nwalkers, num_sampled):
+            raise ValueError(f'checkpoint {checkpoint} has {chain.shape[1]} walkers, not {nwalkers}; '
+                             'remove it or run with the same nwalkers')
+        if start > nsteps:
+            raise ValueError(f'checkpoint {checkpoint} already has {start} steps, more than '
+                             f'nsteps = {nsteps}')
+        chain = np.concatenate([chain, np.zeros((nsteps - start, nwalkers, num_sampled))])
+        log_prob = np.concatenate([log_prob, np.zeros((nsteps - start, nwalkers))])
+    else:
+        chain = np.zeros((nsteps, nwalkers, num_sampled))
+        log_prob = np.zeros((nsteps, nwalkers))
+        num_accepted = np.zeros(nwalkers)
+        num_evals, eval_time, start = 0, 0., 0
+
+    pool = Pool(processes, initializer=_init_worker,
+                initargs=(event_name, dets, t_amount, time_window)) if processes > 1 else None
+    pool_map = pool.map if pool is not None else lambda f, x: list(map(f, x))
+
+    wall_time = 0.
+    try:
+        if start == 0:
+            # start the walkers in a small ball around the reference parameters
+            positions = likelihood.reference + 1e-2 * rng.standard_normal((nwalkers, num_sampled))
+            positions = np.clip(positions, likelihood.bounds[:, 0] + 1e-6, likelihood.bounds[:, 1])
+            results = pool_map(_evaluate, positions)
+            current_log_prob = np.array([r[0] for r in results])
+        else:
+            positions = chain[start - 1].copy()
+            current_log_prob = log_prob[start - 1].copy()
+
+        half = nwalkers // 2
+        halves = [np.arange(half), np.arange(half, nwalkers)]
+        for step in range(start, nsteps):
+            t0 = timer.perf_counter()
+            for active, others in (halves, halves[::-1]):
+                # propose along the line to a random walker of the other half
+                z = ((a - 1.) * rng.random(half) + 1.)**2 / a
+                partners = positions[rng.choice(others, size=half)]
+                proposals = partners + z[:, None] * (positions[active] - partners)
+                results = pool_map(_evaluate, proposals)
+                new_log_prob = np.array([r[0] for r in results])
+                num_evals += half
+                eval_time += sum(r[1] for r in results)
+
+                log_accept = (num_sampled - 1) * np.log(z) + new_log_prob - current_log_prob[active]
+                accepted = np.log(rng.random(half)) < log_accept
+                positions[active[accepted]] = proposals[accepted]
+                current_log_prob[active[accepted]] = new_log_prob[accepted]
+                num_accepted[active[accepted]] += 1
+            wall_time += timer.perf_counter() - t0
+
+            chain[step] = positions
+            log_prob[step] = current_log_prob
+            if checkpoint is not None and ((step + 1) % checkpoint_every == 0 or step + 1 == nsteps):
+                _save_checkpoint(checkpoint, chain[:step + 1], log_prob[:step + 1],
+                                 num_accepted, num_evals, eval_time, rng)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    # throughput of this run compared with the serial cost of one likelihood (not
+    # defined if a finished checkpoint was loaded, so nothing was run)
+    run_evals = (nsteps - start) * nwalkers
+    throughput = run_evals / wall_time if run_evals > 0 and wall_time > 0 else np.nan
+    speedup = throughput * serial_cost
+    timing = {'serial_cost': serial_cost,
+              'worker_cost': eval_time / num_evals if num_evals else np.nan,
+              'throughput': throughput,
+              'processes': processes,
+              'speedup': speedup,
+              'efficiency': speedup / processes}
+
+    return {'samples': chain[burn_in:].reshape(-1, num_sampled),
+            'chain': chain, 'log_prob': log_prob,
+            'acceptance': num_accepted / max(nsteps, 1),
+            'timing': timing}
+
+
+def print_timing(event_name, timing):
+    print(f"{event_name}: {timing['serial_cost'] * 1e3:.2f} ms per likelihood (serial), "
+          f"{timing['worker_cost'] * 1e3:.2f} ms in workers, "
+          f"{timing['throughput']:.1f} likelihoods/s on {timing['processes']} processes "
+          f"(speedup {timing['speedup']:.2f}, efficiency {timing['efficiency']:.0%})")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('events', nargs='*', help='bundled events to sample (default: all)')
+    parser.add_argument('--nwalkers', type=int, default=32)
+    parser.add_argument('--nsteps', type=int, default=500)
+    parser.add_argument('--burn-in', type=int, default=None)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--dets', nargs='+', default=['H1', 'L1'])
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--outdir', default='posteriors')
+    args = parser.parse_args()
+
+    from GW_class import GW_events
+    os.makedirs(args.outdir, exist_ok=True)
+    for event_name in args.events or list(GW_events):
+        result = run_sampler(event_name, nwalkers=args.nwalkers, nsteps=args.nsteps,
+                             burn_in=args.burn_in, processes=args.processes, dets=args.dets,
+                             checkpoint=os.path.join(args.outdir, f'{event_name}_checkpoint.npz'),
+                             seed=args.seed)
+        np.savez(os.path.join(args.outdir, f'{event_name}_posterior.npz'),
+                 samples=result['samples'], param_names=param_names,
+                 acceptance=result['acceptance'], timing=json.dumps(result['timing']))
+        print_timing(event_name, result['timing'])
@@ -0,0 +1,172 @@
+'''Search the bundled events over a template bank in two stages: a coarse pass at
+a decimated sample rate over a short segment, then a full-rate matched filter
+of only the loudest candidates.'''
+
+
+import argparse
+import time as timer
+
+import numpy as np
+from matched_filter import DataSegment, auto_segment_length, batch_matched_filter
+from signal_processing import decimate_event
+from template import coarse_waveform, get_template, support_rate, waveform
+from template_bank import bank_comp_params, load_bank, place_bank
+
+
+def network_snr(SNRmax):
+    """Network SNR of matched filter SNRs with one detector per column."""
+    return np.sqrt(np.sum(SNRmax**2, axis=-1))
+
+
+def select_candidates(network, num_refine=16, snr_threshold=None, relative_threshold=0.9):
+    """Indexes of the templates passed on to the second stage, loudest first: at
+    most num_refine, with a finite network SNR of at least snr_threshold and at
+    least relative_threshold times the loudest (none if no template has a
+    finite network SNR).
+    """
+    valid = np.flatnonzero(np.isfinite(network))
+    order = valid[np.argsort(network[valid])[::-1][:num_refine]]
+    if not len(order):
+        return order
+    keep = network[order] >= relative_threshold * network[order[0]]
+    if snr_threshold is not None:
+        keep &= network[order] >= snr_threshold
+    return order[keep]
+
+
+def hierarchical_search(GW_signal, bank, dets=('H1', 'L1'), coarse_fs=1024, coarse_t_amount='auto',
+                        fine_t_amount=4, lag_window=0.1, num_refine=16, snr_threshold=None,
+                        relative_threshold=0.9, chunk_size=64, coarse_templates=True):
+    """Filters an event with every template of a bank at a decimated sample rate
+    over a short segment, then refilters the loudest candidates at the full
+    sample rate over a longer one. The first-stage templates are generated
+    directly for the coarse rate (see template.coarse_waveform), which roughly
+    halves their cost; their SNRs are within ~2% of those of the exact ones.
+
+    Args:
+        GW_signal (GWSignals): event to search
+        bank (ndarray): template bank, either with dtype template_bank.bank_dtype
+            or as component parameters (m1, m2, chi1, chi2), one per row
+        dets (list): detectors to filter
+        coarse_fs (int): sample rate of the first stage
+        coarse_t_amount (float or str): amount of time (s) around event filtered
+            in the first stage, or 'auto' to pick it with auto_segment_length
+        fine_t_amount (float): amount of time (s) around event filtered in the
+            second stage
+        lag_window (float, optional): only search for the SNR peak within
+            lag_window (s) of the event time, in both stages (the lag window is
+            centred on the lag that puts the template merger at the event time)
+        num_refine (int): largest number of candidates refiltered at full rate
+        snr_threshold (float, optional): smallest first-stage network SNR of a
+            candidate
+        relative_threshold (float): smallest first-stage network SNR of a
+            candidate, relative to the loudest template
+        chunk_size (int): number of templates filtered together
+        coarse_templates (bool): if False, the first stage uses exact templates
+            decimated to the coarse rate
+
+    Returns:
+        dict: first-stage network SNR of every template, the candidates and
+            their second-stage results, the loudest template and the timing of
+            each stage
+    """
+    param_array = bank_comp_params(bank) if bank.dtype.names else np.atleast_2d(bank)
+    if not param_array.size:
+        raise ValueError('the template bank is empty')
+    full_dictionary = GW_signal.full_dictionary
+
+    # first stage: the whole bank at the coarse rate
+    t0 = timer.perf_counter()
+    if GW_signal.dictionary['fs'] == coarse_fs:
+        coarse_dictionary = GW_signal.dictionary
+    else:
+        coarse_dictionary = decimate_event(full_dictionary, coarse_fs)
+    coarse_segments = {}
+    for det in dets:
+        t_amount = coarse_t_amount
+        if t_amount == 'auto':
+            time = coarse_dictionary['time']
+            t_amount = auto_segment_length(get_template(GW_signal.comp_params, coarse_dictionary),
+                                           coarse_dictionary['large_data_psds'][det], coarse_fs,
+                                           center=np.searchsorted(time, coarse_dictionary['time_center']),
+                                           max_length=len(time) / coarse_fs)
+        coarse_segments[det] = DataSegment(coarse_dictionary, det, t_amount, lag_window)
+    # waveform frequency that lands at the coarse Nyquist frequency in the templates
+    generator = coarse_waveform(0.5 * coarse_fs * support_rate / full_dictionary['fs']) \
+        if coarse_templates else waveform
+    coarse_SNR = batch_matched_filter(param_array, GW_signal, dets, chunk_size=chunk_size,
+                                      segments=coarse_segments, dictionary=coarse_dictionary,
+                                      generator=generator)[0]
+    coarse_network = network_snr(coarse_SNR)
+    coarse_time = timer.perf_counter() - t0
+
+    # second stage: the candidates at full rate
+    t0 = timer.perf_counter()
+    candidates = select_candidates(coarse_network, num_refine, snr_threshold, relative_threshold)
+    fine_segments = {det: DataSegment(full_dictionary, det, fine_t_amount, lag_window)
+                     for det in dets}
+    SNRmax, phase, offset, d_eff = batch_matched_filter(param_array[candidates], GW_signal, dets,
+                                                        chunk_size=chunk_size,
+                                                        segments=fine_segments,
+                                                        dictionary=full_dictionary)
+    network = network_snr(SNRmax)
+    fine_time = timer.perf_counter() - t0
+
+    best = np.argmax(network) if len(candidates) else None
+    return {'coarse_network_snr': coarse_network,
+            'candidates': candidates,
+            'SNR': SNRmax, 'phase': phase, 'offset': offset, 'd_eff': d_eff,
+            'network_snr': network,
+            'best_params': None if best is None else param_array[candidates[best]],
+            'best_network_snr': None if best is None else network[best],
+            'timing': {'coarse': coarse_time, 'fine': fine_time,
+                       'coarse_per_template': coarse_time / len(param_array),
+                       'fine_per_template': fine_time / max(len(candidates), 1)}}
+
+
+def print_report(event_name, result):
+    timing = result['timing']
+    if result['best_params'] is None:
+        print(f"{event_name}: no candidates passed the first stage")
+    else:
+        m1, m2, chi1, chi2 = result['best_params']
+        print(f"{event_name}: network SNR {result['best_network_snr']:.2f} for "
+              f"m1 = {m1:.1f}, m2 = {m2:.1f}, chi1 = {chi1:.2f}, chi2 = {chi2:.2f}")
+    print(f"    first stage: {len(result['coarse_network_snr'])} templates in {timing['coarse']:.2f} s "
+          f"({timing['coarse_per_template'] * 1e3:.2f} ms each), "
+          f"second stage: {len(result['candidates'])} candidates in {timing['fine']:.2f} s "
+          f"({timing['fine_per_template'] * 1e3:.2f} ms each)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('events', nargs='*', help='bundled events to search (default: all)')
+    parser.add_argument('--bank', default=None,
+                        help='bank file from template_bank.py (default: place one per event)')
+    parser.add_argument('--min-match', type=float, default=0.9,
+                        help='minimal match of the banks placed per event')
+    parser.add_argument('--coarse-fs', type=int, default=1024)
+    parser.add_argument('--coarse-t-amount', type=lambda v: v if v == 'auto' else float(v),
+                        default='auto')
+    parser.add_argument('--fine-t-amount', type=float, default=4)
+    parser.add_argument('--num-refine', type=int, default=16)
+    parser.add_argument('--snr-threshold', type=float, default=None)
+    parser.add_argument('--relative-threshold', type=float, default=0.9)
+    parser.add_argument('--exact-coarse-templates', action='store_true',
+                        help='decimate exact templates for the first stage')
+    args = parser.parse_args()
+
+    from GW_class import GW_events
+    for event_name in args.events or list(GW_events):
+        GW_signal = GW_events[event_name]
+        if args.bank is not None:
+            bank = load_bank(args.bank)
+        else:
+            bank = place_bank(GW_signal, min_match=args.min_match, max_rejections=200)[0]
+        result = hierarchical_search(GW_signal, bank, coarse_fs=args.coarse_fs,
+                                     coarse_t_amount=args.coarse_t_amount,
+                                     fine_t_amount=args.fine_t_amount,
+                                     num_refine=args.num_refine, snr_threshold=args.snr_threshold,
+                                     relative_threshold=args.relative_threshold,
+                                     coarse_templates=not args.exact_coarse_templates)
+        print_report(event_name, result)
@@ -1,9 +1,15 @@
 '''Signal processing functions.'''
 
 
+from functools import lru_cache
+
 import numpy as np
-from scipy.signal import butter, filtfilt
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy.signal import butter, firwin, sosfiltfilt, sosfreqz, resample_poly
 from scipy.signal.windows import tukey
+from fft_backend import rfft, irfft
+from psd import as_psd
+from product_cache import product_cache
 
 
 def whiten(strain, interp_psd, dt, phase_shift=0, time_shift=0):
@@ -11,9 +17,11 @@ def whiten(strain, interp_psd, dt, phase_shift=0, time_shift=0):
     shift and time shift.
 
     Args:
-        strain (ndarray): strain data
-        interp_psd (interpolating function): function to take in freqs and output
-            the average power at that freq
+        strain (ndarray): strain data, or a 2D array of series (e.g. one
+            detector per row)
+        interp_psd (PSD or interpolating function): function to take in freqs and
+            output the average power at that freq, or a list of them with one
+            per row of strain
         dt (float): sample time interval of data
         phase_shift (float, optional): phase shift to apply to whitened data
         time_shift (float, optional): time shift to apply to whitened data (s)
@@ -21,35 +29,280 @@ def whiten(strain, interp_psd, dt, phase_shift=0, time_shift=0):
     Returns:
         ndarray: array of whitened strain data
     """
-    Nt = len(strain)
+    Nt = np.shape(strain)[-1]
     # take the fourier transform of the data
     freqs = np.fft.rfftfreq(Nt, dt)
 
     # whitening: transform to freq domain, divide by square root of psd, then
     # transform back, taking care to get normalization right.
-    hf = np.fft.rfft(strain)
+    hf = rfft(strain)
 
     # apply time and phase shift
     hf = hf * np.exp(-1.j * 2 * np.pi * time_shift * freqs - 1.j * phase_shift)
     norm = 1./np.sqrt(1./(dt*2))
-    white_hf = hf / np.sqrt(interp_psd(freqs)) * norm
-    white_ht = np.fft.irfft(white_hf, n=Nt)
+    if isinstance(interp_psd, (list, tuple)):
+        asd = np.stack([as_psd(psd).asd(Nt, dt) for psd in interp_psd])
+    else:
+        asd = as_psd(interp_psd).asd(Nt, dt)
+    white_hf = hf / asd * norm
+    white_ht = irfft(white_hf, n=Nt)
     return white_ht
 
 
-def bandpass(strain, fband, fs):
-    """Bandpasses strain data using a butterworth filter.
+def cached_whiten(strain, interp_psd, dt):
+    """whiten() through the product cache.
+
+    Returns:
+        ndarray: array of whitened strain data
+        ProductKey: key of the whitened data in the cache
+    """
+    if isinstance(interp_psd, (list, tuple)):
+        psds = [as_psd(psd) for psd in interp_psd]
+    else:
+        psds = as_psd(interp_psd)
+    return product_cache.fetch('whiten', lambda: whiten(strain, psds, dt),
+                               inputs=(strain, psds), params={'dt': dt})
+
+
+@lru_cache(maxsize=None)
+def _butter_bandpass(order, f_low, f_high, fs):
+    return butter(order, [f_low*2./fs, f_high*2./fs], btype='band', output='sos')
+
+
+def butter_bandpass(fband, fs, order=4):
+    """Butterworth bandpass filter in second-order sections, designed once for
+    each (order, fband, fs) and cached.
 
     Args:
-        strain (ndarray): strain data to bandpass
         fband (ndarray): low and high-pass filter values to use
         fs (float): sample rate of data
+        order (int, optional): order of the filter
+
+    Returns:
+        ndarray: second-order sections of the filter (shared between calls, so
+            not to be modified)
+    """
+    return _butter_bandpass(int(order), float(fband[0]), float(fband[1]), float(fs))
+
+
+def bandpass(strain, fband, fs, order=4, axis=-1):
+    """Bandpasses strain data using a zero-phase butterworth filter.
+
+    Args:
+        strain (ndarray): strain data to bandpass, or a 2D array of series
+            (e.g. one detector or template per row)
+        fband (ndarray): low and high-pass filter values to use
+        fs (float): sample rate of data
+        order (int, optional): order of the filter (applied forwards and backwards)
+        axis (int, optional): time axis of strain
 
     Returns:
         ndarray: array of bandpassed strain data
     """
-    bb, ab = butter(4, [fband[0]*2./fs, fband[1]*2./fs], btype='band')
     normalization = np.sqrt((fband[1]-fband[0])/(fs/2))
-    strain_bp = filtfilt(bb, ab, strain) / normalization
+    strain_bp = sosfiltfilt(butter_bandpass(fband, fs, order), strain, axis=axis) / normalization
     return strain_bp
 
+
+def cached_bandpass(strain, fband, fs, order=4, key=None):
+    """bandpass() through the product cache.
+
+    Args:
+        key (ProductKey, optional): key of strain if it is a cached product,
+            which saves hashing it
+
+    Returns:
+        ndarray: bandpassed strain data
+        ProductKey: key of the bandpassed data in the cache
+    """
+    return product_cache.fetch('bandpass', lambda: bandpass(strain, fband, fs, order),
+                               inputs=(strain if key is None else key,),
+                               params={'fband': fband, 'fs': fs, 'order': order})
+
+
+@lru_cache(maxsize=32)
+def bandpass_response(fband, fs, n, order=4):
+    """Frequency response of bandpass on the rfft grid of n samples: the squared
+    magnitude of the butterworth filter (as it is applied forwards and
+    backwards), with the normalization of bandpass. Cached per grid.
+
+    Args:
+        fband (tuple): low and high-pass filter values to use
+        fs (float): sample rate of data
+        n (int): number of samples transformed
+        order (int, optional): order of the filter
+
+    Returns:
+        ndarray: response at each frequency of np.fft.rfftfreq(n, 1/fs)
+    """
+    freqs = np.fft.rfftfreq(n, 1. / fs)
+    _, response = sosfreqz(butter_bandpass(fband, fs, order), worN=freqs, fs=fs)
+    return np.abs(response)**2 / np.sqrt((fband[1]-fband[0])/(fs/2))
+
+
+def whiten_bandpass(strain_fft, interp_psd, dt, fband, n, phase_shift=0, time_shift=0):
+    """Whitens, bandpasses and shifts data in a single pass over its rfft, the
+    same as bandpass(whiten(...)) away from the ends of the data.
+
+    Args:
+        strain_fft (ndarray): rfft of the strain data
+        interp_psd (PSD or interpolating function): function to take in freqs and
+            output the average power at that freq
+        dt (float): sample time interval of data
+        fband (list): low and high-pass filter values to use
+        n (int): number of samples of the strain data
+        phase_shift (float, optional): phase shift to apply to whitened data
+        time_shift (float, optional): time shift to apply to whitened data (s)
+
+    Returns:
+        ndarray: array of whitened and bandpassed strain data
+    """
+    freqs = np.fft.rfftfreq(n, dt)
+    norm = 1./np.sqrt(1./(dt*2))
+    operator = np.exp(-1.j * 2 * np.pi * time_shift * freqs - 1.j * phase_shift) * \
+        norm / as_psd(interp_psd).asd(n, dt) * bandpass_response(tuple(fband), 1. / dt, n)
+    return irfft(strain_fft * operator, n=n)
+
+
+def decimate(strain, factor, axis=-1):
+    """Band-limits strain data to the new Nyquist frequency and keeps every
+    factor-th sample, with a zero-phase polyphase FIR filter so that sample k of
+    the output lines up with sample k * factor of the input.
+
+    Args:
+        strain (ndarray): strain data to decimate
+        factor (int): decimation factor
+        axis (int, optional): axis to decimate along
+
+    Returns:
+        ndarray: decimated strain data
+    """
+    if factor == 1:
+        return strain
+    return resample_poly(strain, 1, factor, axis=axis,
+                         window=decimation_filter(factor).astype(strain.dtype, copy=False))
+
+
+@lru_cache(maxsize=None)
+def decimation_filter(factor):
+    # the anti-aliasing filter resample_poly designs for a decimation by factor,
+    # designed once rather than for every template
+    return firwin(20 * factor + 1, 1. / factor, window=('kaiser', 5.0))
+
+
+def decimate_event(total_data, fs_analysis, fband=(35.0, 350.0)):
+    """Decimates the data of an event to a lower sample rate, once per event, and
+    re-derives the whitened and bandpassed data at that rate. The psds are kept
+    as they are, since they are only evaluated below the new Nyquist frequency.
+
+    Args:
+        total_data (dict): dict containing original and whitenbp strain data
+        fs_analysis (int): sample rate to decimate to (must divide the original)
+        fband (list): low and high-pass filter values used for the bandpassed data
+
+    Returns:
+        dict: dict of the same shape as total_data at the new sample rate, with
+            the decimation factor stored under 'decimation' and fband under 'fband'
+    """
+    factor = int(round(total_data['fs'] / fs_analysis))
+    if factor < 1 or factor * fs_analysis != total_data['fs']:
+        raise ValueError('fs_analysis must divide the sample rate of the data')
+    if fband[1] >= fs_analysis / 2:
+        raise ValueError('fband must lie below the Nyquist frequency of fs_analysis')
+
+    dt = total_data['dt'] * factor
+    decimated_data = {'time': total_data['time'][::factor],
+                      'time_center': total_data['time_center'],
+                      'dt': dt, 'fs': fs_analysis,
+                      'large_data_psds': total_data['large_data_psds'],
+                      'decimation': factor * total_data.get('decimation', 1),
+                      'fband': tuple(fband)}
+    for det in ('H1', 'L1'):
+        strain = decimate(total_data[det]['strain'], factor)
+        strain_whiten, key = cached_whiten(strain, total_data['large_data_psds'][det], dt)
+        strain_whitenbp = cached_bandpass(strain_whiten, fband, fs_analysis, key=key)[0]
+        decimated_data[det] = {'strain': strain, 'strain_whiten': strain_whiten,
+                               'strain_whitenbp': strain_whitenbp}
+    return decimated_data
+
+
+def _median_bias(num_segments):
+    # ratio of the median to the mean of num_segments chi-squared periodograms
+    # with two degrees of freedom
+    ii = 2 * np.arange(1, (num_segments - 1) // 2 + 1)
+    return 1 + np.sum(1. / (ii + 1) - 1. / ii)
+
+
+def welch_psd(strain, fs, segment_duration=4., overlap=0.5, average='mean', window=None,
+              batch_size=64):
+    """One-sided Welch estimate of the psd (as matplotlib.mlab.psd with no
+    detrending). The overlapping segments are a strided view of the data, and
+    are windowed and transformed batch_size at a time, over all series at once.
+
+    Args:
+        strain (ndarray): strain data, or a 2D array of series (e.g. one
+            detector per row)
+        fs (float): sample rate of data
+        segment_duration (float, optional): length (s) of each segment
+        overlap (float, optional): fraction of each segment overlapping the next
+        average (str, optional): 'mean' or 'median' (corrected for its bias) of
+            the periodograms of the segments
+        window (ndarray, optional): window applied to each segment, defaults to
+            a Tukey window with alpha = 1/4
+        batch_size (int, optional): number of segments transformed together
+
+    Returns:
+        ndarray: frequencies of the psd
+        ndarray: psd of each series
+    """
+    strain = np.asarray(strain, dtype=float)
+    nfft = int(segment_duration * fs)
+    hop = nfft - int(overlap * nfft)
+    window = tukey(nfft, alpha=1./4) if window is None else np.asarray(window)
+    if strain.shape[-1] < nfft:
+        raise ValueError('strain is shorter than one segment')
+    segments = sliding_window_view(strain, nfft, axis=-1)[..., ::hop, :]
+    num_segments = segments.shape[-2]
+
+    periodograms = np.empty(segments.shape[:-1] + (nfft // 2 + 1,))
+    for first in range(0, num_segments, batch_size):
+        batch = slice(first, first + batch_size)
+        periodograms[..., batch, :] = np.abs(rfft(segments[..., batch, :] * window, axis=-1))**2
+
+    if average == 'mean':
+        psd = periodograms.mean(axis=-2)
+    elif average == 'median':
+        psd = np.median(periodograms, axis=-2) / _median_bias(num_segments)
+    else:
+        raise ValueError(f'unknown average {average!r}')
+
+    # one-sided: every frequency but zero and Nyquist counts twice
+    psd *= 2. / (fs * np.sum(window**2))
+    psd[..., 0] /= 2
+    if nfft % 2 == 0:
+        psd[..., -1] /= 2
+    return np.fft.rfftfreq(nfft, 1. / fs), psd
+
+
+def inverse_spectrum_length(interp_psd, fraction=0.99):
+    """Length of the time-domain kernel of the inverse psd, i.e. how far the
+    division by the psd in the matched filter spreads each sample of data.
+
+    Args:
+        interp_psd (interpolating function): interpolated psd, with the
+            frequencies and powers it was built from as .x and .y
+        fraction (float, optional): fraction of the kernel energy to contain
+
+    Returns:
+        float: two-sided length (s) containing the given fraction of the energy
+    """
+    freqs = interp_psd.x
+    kernel = irfft(1. / interp_psd.y)
+    dt = 1. / (2 * freqs[-1])
+
+    # energy within +-k samples of zero lag (the kernel wraps around)
+    energy = kernel**2
+    half = len(kernel) // 2
+    enclosed = energy[0] + np.cumsum(energy[1:half + 1] + energy[-1:-half - 1:-1])
+    k = np.searchsorted(enclosed, fraction * energy.sum()) + 1
+    return 2 * k * dt
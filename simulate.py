@@ -0,0 +1,141 @@
+'''Simulated events: Gaussian noise colored by a psd, drawn in the frequency
+domain, with an IMRPhenomD signal injected at a chosen network SNR. Many
+independent realizations can be drawn at once for injection studies.'''
+
+
+import numpy as np
+from fft_backend import rfft, irfft
+from psd import as_psd
+from signal_processing import whiten, bandpass
+from template import get_template
+
+
+def noise_fft(interp_psd, fs, n, size=(), rng=None, dtype=np.float64):
+    """Transform (as rfft) of stationary Gaussian noise with a given one-sided
+    psd, with no power at zero frequency.
+
+    Args:
+        interp_psd (PSD or interpolating function): psd of the noise
+        fs (float): sample rate of the noise
+        n (int): number of samples of the noise
+        size (tuple): shape of the batch of independent realizations
+        rng (Generator, optional): random number generator
+        dtype (dtype): float64 or float32, precision of the noise
+
+    Returns:
+        ndarray: transforms, shape size + (n // 2 + 1,)
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    size = (size,) if np.isscalar(size) else tuple(size)
+    num_freqs = n // 2 + 1
+    # E|X_k|^2 = n fs S(f_k) / 2, split between the real and imaginary parts
+    scale = np.sqrt(as_psd(interp_psd).rfft_grid(n, 1. / fs) * n * fs / 4).astype(dtype)
+    scale[0] = 0.
+    if n % 2 == 0:
+        # the Nyquist term is real, so it gets all of the power
+        scale[-1] *= np.sqrt(2)
+    noise = np.empty(size + (num_freqs,), dtype=np.result_type(dtype, np.complex64))
+    noise.real = rng.standard_normal(size + (num_freqs,), dtype=dtype)
+    noise.imag = rng.standard_normal(size + (num_freqs,), dtype=dtype)
+    if n % 2 == 0:
+        noise.imag[..., -1] = 0.
+    noise *= scale
+    return noise
+
+
+def colored_noise(interp_psd, fs, n, size=(), seed=None, dtype=np.float64):
+    """Stationary Gaussian noise with a given one-sided psd (see noise_fft).
+
+    Returns:
+        ndarray: noise, shape size + (n,)
+    """
+    return irfft(noise_fft(interp_psd, fs, n, size, np.random.default_rng(seed), dtype),
+                 n=n, axis=-1)
+
+
+def optimal_snr(signal, interp_psd, fs):
+    """SNR of a signal in noise with a given psd, with the normalization of the
+    matched filter (sigma)."""
+    n = np.shape(signal)[-1]
+    signal_fft = rfft(signal) / fs
+    inverse_psd = as_psd(interp_psd).inverse(n, 1. / fs)[1:]
+    return np.sqrt(4 * fs / n * np.sum(np.abs(signal_fft[..., 1:])**2 * inverse_psd, axis=-1))
+
+
+def injection_signal(comp_params, fs, n):
+    """Template (as get_template) centered in n samples, with the merger at the
+    middle sample."""
+    template = get_template(np.asarray(comp_params, dtype=float), {'dt': 1. / fs, 'fs': fs})
+    start = len(template) // 2 - n // 2
+    if start >= 0:
+        return template[start:start + n]
+    signal = np.zeros(n)
+    signal[-start:-start + len(template)] = template
+    return signal
+
+
+def simulate_strain(comp_params, psds, snr=20., fs=4096, duration=32., dets=('H1', 'L1'),
+                    size=(), seed=None, phase=0., time_shift=0., dtype=np.float64):
+    """Strain of simulated events: independent noise in each detector with a
+    signal injected at the same time in all of them, scaled to a network SNR.
+
+    Args:
+        comp_params (ndarray): component parameters (m1, m2, chi1, chi2) of the
+            signal (None for noise only)
+        psds (dict): psd of each detector
+        snr (float): optimal network SNR of the signal
+        fs (float): sample rate of the data
+        duration (float): length (s) of the data
+        dets (list): detectors to simulate
+        size (tuple): shape of the batch of independent realizations
+        seed (int, optional): seed of the noise
+        phase (float): phase (rad) of the signal
+        time_shift (float): time (s) of the merger after the middle of the data
+        dtype (dtype): float64 or float32, precision of the strain
+
+    Returns:
+        ndarray: strain, shape size + (len(dets), duration * fs)
+    """
+    rng = np.random.default_rng(seed)
+    n = int(duration * fs)
+    size = (size,) if np.isscalar(size) else tuple(size)
+    strain_fft = np.stack([noise_fft(psds[det], fs, n, size, rng, dtype) for det in dets], axis=-2)
+
+    if comp_params is not None:
+        signal = injection_signal(comp_params, fs, n)
+        sigma = np.sqrt(sum(optimal_snr(signal, psds[det], fs)**2 for det in dets))
+        freqs = np.fft.rfftfreq(n, 1. / fs)
+        # the shifts are applied to the transform, where they are exact
+        signal_fft = rfft(signal) * (snr / sigma) * \
+            np.exp(-2.j * np.pi * freqs * time_shift - 1.j * phase)
+        strain_fft += signal_fft.astype(strain_fft.dtype)
+    return irfft(strain_fft, n=n, axis=-1)
+
+
+def simulate_event(comp_params, psds, snr=20., fs=4096, duration=32., time_center=0., seed=None,
+                   phase=0., time_shift=0., fband=(35.0, 350.0), dtype=np.float64):
+    """Simulated event, as a dictionary of the same shape as those of the
+    bundled events (see simulate_strain for the arguments).
+
+    Args:
+        time_center (float): time of the middle of the data
+        fband (list): low and high-pass filter values used for the bandpassed data
+
+    Returns:
+        dict: dict containing original and whitenbp strain data
+    """
+    dets = ('H1', 'L1')
+    psds = {det: as_psd(psds[det]) for det in dets}
+    strain = simulate_strain(comp_params, psds, snr, fs, duration, dets, seed=seed, phase=phase,
+                             time_shift=time_shift, dtype=dtype)
+    dt = 1. / fs
+    strain_whiten = whiten(strain, [psds[det] for det in dets], dt).astype(dtype, copy=False)
+    strain_whitenbp = bandpass(strain_whiten, fband, fs).astype(dtype, copy=False)
+    n = strain.shape[-1]
+    total_data = {'time': time_center + (np.arange(n) - n // 2) * dt,
+                  'time_center': time_center, 'dt': dt, 'fs': fs, 'large_data_psds': psds,
+                  'fband': tuple(fband)}
+    for i, det in enumerate(dets):
+        total_data[det] = {'strain': strain[i], 'strain_whiten': strain_whiten[i],
+                           'strain_whitenbp': strain_whitenbp[i]}
+    return total_data
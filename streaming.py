@@ -0,0 +1,329 @@
+'''Matched filter a long strain file block by block (overlap-save), whitening
+with a psd that is kept up to date from the data already read, and yield the
+SNR triggers found.'''
+
+
+import argparse
+import time as timer
+import warnings
+from collections import deque
+
+import h5py
+import numpy as np
+from scipy.signal.windows import tukey
+from fft_backend import rfft, irfft, ifft, next_fast_len
+from template import get_template
+
+
+class RollingPSD:
+    """Welch estimate of the psd over the most recent stretch of a stream of
+    data: periodograms of tukey-windowed segments overlapping by half, averaged
+    over the last num_segments of them.
+
+    Args:
+        fs (float): sample rate of the data
+        segment_duration (float): length (s) of each periodogram
+        psd_duration (float): length (s) of data averaged over
+    """
+
+    def __init__(self, fs, segment_duration=4., psd_duration=256.):
+        self.fs = fs
+        self.segment_length = int(segment_duration * fs)
+        self.hop = self.segment_length // 2
+        self.window = tukey(self.segment_length, alpha=1./4)
+        self.norm = 2. / (fs * np.sum(self.window**2))
+        self.freqs = np.fft.rfftfreq(self.segment_length, 1. / fs)
+        num_segments = max(int(psd_duration / segment_duration * 2) - 1, 1)
+        self.periodograms = deque(maxlen=num_segments)
+        self.buffer = np.zeros(0)
+
+    def update(self, strain):
+        """Adds the next (contiguous) samples of the stream."""
+        self.buffer = np.concatenate([self.buffer, strain])
+        num_new = (len(self.buffer) - self.segment_length) // self.hop + 1
+        if num_new <= 0:
+            return
+        starts = np.arange(num_new) * self.hop
+        segments = self.buffer[starts[:, None] + np.arange(self.segment_length)]
+        for periodogram in self.norm * np.abs(rfft(segments * self.window, axis=-1))**2:
+            self.add(periodogram)
+        self.buffer = self.buffer[num_new * self.hop:]
+
+    def add(self, periodogram):
+        self.periodograms.append(periodogram)
+
+    def estimate(self):
+        """Current estimate of the psd at self.freqs."""
+        return np.mean(self.periodograms, axis=0)
+
+    def reset(self):
+        """Forgets the data after a gap in the stream (keeping the periodograms)."""
+        self.buffer = np.zeros(0)
+
+    def __call__(self, freqs):
+        # psd at the given frequencies, interpolated linearly like interp1d
+        return np.interp(freqs, self.freqs, self.estimate())
+
+
+class StreamingFilter:
+    """Overlap-save matched filter of a set of templates over a stream of data.
+    The inverse asd is truncated to kernel_duration in the time domain, so that
+    the inverse psd (its square) spans twice that and the whole filter has a
+    finite length, and the SNR at the lags kept from each block is that of a
+    filter over the whole stream: exactly for the in-phase part, and closely
+    for the quadrature part, whose filter (a Hilbert transform) has slowly
+    decaying tails rather than a finite length.
+
+    Args:
+        param_array (ndarray): component parameters (m1, m2, chi1, chi2) of the
+            templates, one set per row
+        fs (float): sample rate of the data
+        block_duration (float): length (s) of each block transformed
+        kernel_duration (float): length (s) the inverse asd is truncated to
+        f_low (float): frequency (Hz) below which the data is ignored
+        psd_duration (float): length (s) of data the psd is averaged over
+        chunk_size (int): number of templates filtered together
+        psd (RollingPSD, optional): psd estimate to whiten with, defaults to a
+            RollingPSD over psd_duration which is updated by triggers()
+        step_duration (float, optional): if given, use the shortest block which
+            keeps at least step_duration (s) of lags instead of block_duration
+    """
+
+    def __init__(self, param_array, fs, block_duration=64., kernel_duration=2., f_low=20.,
+                 psd_duration=256., chunk_size=16, psd=None, step_duration=None):
+        param_array = np.atleast_2d(param_array)
+        self.param_array = param_array
+        self.fs = fs
+        self.f_low = f_low
+        self.chunk_size = chunk_size
+
+        # template supports (from first to last nonzero sample), and the sample
+        # of each at which its amplitude peaks
+        dictionary = {'dt': 1. / fs, 'fs': fs}
+        supports = []
+        for params in param_array:
+            template_p = get_template(params, dictionary)
+            nonzero = np.flatnonzero(template_p)
+            supports.append(template_p[nonzero[0]:nonzero[-1] + 1])
+        self.template_length = max(len(support) for support in supports)
+        self.kernel_length = 2 * int(kernel_duration * fs / 2)
+        self.peak_offsets = np.array([np.argmax(np.abs(support)) for support in supports])
+
+        # overlap-save: each block keeps the lags which do not wrap around, those
+        # at least kernel_length (the half-width of the inverse psd) from its
+        # start and template_length + kernel_length from its end
+        self.lag_start = self.kernel_length
+        if step_duration is not None:
+            block_duration = (self.template_length + 2 * self.kernel_length) / fs + step_duration
+        self.block_length = next_fast_len(int(block_duration * fs), real=True)
+        self.step = self.block_length - self.template_length - 2 * self.kernel_length
+        if self.step <= 0:
+            raise ValueError('block_duration is too short for the templates and kernel_duration')
+        self.freqs = np.fft.rfftfreq(self.block_length, 1. / fs)
+        self.df = self.freqs[1]
+        self.template_ffts = np.zeros((len(supports), self.freqs.size), dtype=complex)
+        for i, support in enumerate(supports):
+            self.template_ffts[i] = rfft(support, n=self.block_length) / fs
+
+        self.psd = RollingPSD(fs, psd_duration=psd_duration) if psd is None else psd
+        self.data_time = 0.
+        self.wall_time = 0.
+
+    @property
+    def throughput(self):
+        """Seconds of data filtered per second of wall-clock time."""
+        return self.data_time / self.wall_time if self.wall_time > 0 else np.nan
+
+    def inverse_psd(self):
+        """Inverse of the current psd on the block frequency grid: the square of
+        the inverse asd truncated to kernel_length in the time domain (so it
+        spans 2 * kernel_length), zeroed below f_low.
+        """
+        inverse_asd = np.zeros(self.freqs.size)
+        band = self.freqs >= self.f_low
+        inverse_asd[band] = 1. / np.sqrt(self.psd(self.freqs[band]))
+        kernel = irfft(inverse_asd, n=self.block_length)
+        half = self.kernel_length // 2
+        taper = tukey(self.kernel_length, alpha=1./4)
+        truncated = np.zeros(self.block_length)
+        truncated[:half] = kernel[:half] * taper[half:]
+        truncated[-half:] = kernel[-half:] * taper[:half]
+        return np.abs(rfft(truncated))**2
+
+    def filter_block(self, block):
+        """Complex SNR of every template at the lags of a block which are kept.
+
+        Args:
+            block (ndarray): block_length samples of data
+
+        Returns:
+            ndarray: complex SNR, shape (number of templates, step); lag k
+                corresponds to the template starting at sample
+                lag_start + k of the block
+        """
+        inverse_psd = self.inverse_psd()
+        data_fft = rfft(block) / self.fs
+        start = self.lag_start
+        snr = np.zeros((len(self.template_ffts), self.step), dtype=complex)
+        for first in range(0, len(self.template_ffts), self.chunk_size):
+            chunk = slice(first, first + self.chunk_size)
+            template_ffts = self.template_ffts[chunk]
+            sigmasq = 4 * self.df * np.sum(np.abs(template_ffts)**2 * inverse_psd, axis=-1)
+            # ifft over the full grid with only non-negative frequencies filled in
+            overlap = 4 * self.fs * ifft(data_fft * template_ffts.conjugate() * inverse_psd,
+                                         n=self.block_length, axis=-1)
+            snr[chunk] = overlap[:, start:start + self.step] / np.sqrt(sigmasq)[:, None]
+        return snr
+
+    def triggers(self, strain_blocks, threshold=6., cluster_window=1.):
+        """Filters a stream of blocks and yields the loudest SNR above threshold
+        in each cluster_window (s) for each template.
+
+        Args:
+            strain_blocks (iterable): (start time, block) pairs, with blocks of
+                block_length samples starting step samples apart (or less, as
+                the last block of read_blocks: lags already filtered are skipped)
+            threshold (float): smallest SNR of a trigger
+            cluster_window (float): length (s) of the windows triggers are
+                clustered over
+
+        Yields:
+            dict: time (of the template peak), SNR, phase and template index
+        """
+        cluster_length = int(cluster_window * self.fs)
+        previous_end, previous_lag_end = None, None
+        for start_time, block in strain_blocks:
+            t0 = timer.perf_counter()
+            if not np.all(np.isfinite(block)):
+                self.psd.reset()
+                previous_end, previous_lag_end = None, None
+                self.wall_time += timer.perf_counter() - t0
+                continue
+            # only the samples not already seen go into the psd
+            end = start_time + self.block_length / self.fs
+            new = self.block_length if previous_end is None else \
+                int(round((end - previous_end) * self.fs))
+            self.psd.update(block[-new:])
+            previous_end = end
+
+            snr = self.filter_block(block)
+            lag_time = start_time + self.lag_start / self.fs
+            skip = 0 if previous_lag_end is None else \
+                min(max(int(round((previous_lag_end - lag_time) * self.fs)), 0), self.step)
+            previous_lag_end = lag_time + self.step / self.fs
+            found = self.cluster(snr[:, skip:], lag_time + skip / self.fs, threshold, cluster_length)
+            self.data_time += (self.step - skip) / self.fs
+            self.wall_time += timer.perf_counter() - t0
+            yield from found
+
+    def cluster(self, snr, lag_time, threshold, cluster_length):
+        """Loudest SNR above threshold of each template in each window of
+        cluster_length lags.
+
+        Args:
+            snr (ndarray): complex SNR, one template per row
+            lag_time (float): time of the first sample of the template at lag 0
+            threshold (float): smallest SNR of a trigger
+            cluster_length (int): number of lags clustered together
+
+        Returns:
+            list: triggers (time of the template peak, SNR, phase and template
+                index), in order of time
+        """
+        num_lags = snr.shape[-1]
+        num_clusters = -(-num_lags // cluster_length)
+        abs_snr = np.zeros((len(snr), num_clusters * cluster_length))
+        abs_snr[:, :num_lags] = np.abs(snr)
+        lags = np.argmax(abs_snr.reshape(len(snr), num_clusters, cluster_length), axis=-1)
+        lags += np.arange(num_clusters) * cluster_length
+        templates, clusters = np.nonzero(np.take_along_axis(abs_snr, lags, axis=-1) >= threshold)
+        return [{'time': lag_time + (lag + self.peak_offsets[template]) / self.fs,
+                 'SNR': abs_snr[template, lag],
+                 'phase': -np.angle(snr[template, lag]),
+                 'template': template}
+                for template, lag in sorted(zip(templates, lags[templates, clusters]),
+                                            key=lambda pair: pair[1])]
+
+
+def read_blocks(filename, block_length, step, align_last=True):
+    """Reads a strain file one block at a time.
+
+    Args:
+        filename (str): strain file (with a strain/Strain dataset)
+        block_length (int): samples per block
+        step (int): samples between the starts of consecutive blocks
+        align_last (bool): if the blocks stop short of the end of the file,
+            read a last block ending with the file (starting less than step
+            after the one before it) if True, otherwise warn that the samples
+            after the last block are left out
+
+    Yields:
+        float: time of the first sample of the block
+        ndarray: block of strain
+    """
+    with h5py.File(filename, 'r') as hdf_file:
+        dataset = hdf_file['strain/Strain']
+        t_start = dataset.attrs['Xstart']
+        dt = dataset.attrs['Xspacing']
+        num_samples = len(dataset)
+        if num_samples < block_length:
+            warnings.warn(f'{filename} is shorter than one block ({num_samples} < {block_length} '
+                          'samples), so none of it is read')
+            return
+        last = (num_samples - block_length) // step * step
+        for start in range(0, last + 1, step):
+            yield t_start + start * dt, dataset[start:start + block_length]
+        remaining = num_samples - last - block_length
+        if remaining and align_last:
+            start = num_samples - block_length
+            yield t_start + start * dt, dataset[start:]
+        elif remaining:
+            warnings.warn(f'the last {remaining} samples of {filename} are left out '
+                          '(less than one block)')
+
+
+def stream_file(filename, param_array, threshold=6., cluster_window=1., **kwargs):
+    """Streams a strain file through a StreamingFilter, yielding its triggers.
+
+    Args:
+        filename (str): strain file (with a strain/Strain dataset)
+        param_array (ndarray): component parameters of the templates
+        threshold (float): smallest SNR of a trigger
+        cluster_window (float): length (s) of the windows triggers are
+            clustered over
+        **kwargs: passed on to StreamingFilter
+
+    Returns:
+        StreamingFilter: the filter, for its throughput once the triggers
+            have been consumed
+        generator: triggers (see StreamingFilter.triggers)
+    """
+    with h5py.File(filename, 'r') as hdf_file:
+        fs = 1. / hdf_file['strain/Strain'].attrs['Xspacing']
+    stream = StreamingFilter(param_array, fs, **kwargs)
+    blocks = read_blocks(filename, stream.block_length, stream.step)
+    return stream, stream.triggers(blocks, threshold, cluster_window)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('filename', help='strain file (e.g. H-H1_LOSC_4_V2-1126257414-4096.hdf5)')
+    parser.add_argument('--event', default='GW150914',
+                        help='bundled event whose reference parameters give the template')
+    parser.add_argument('--bank', default=None, help='bank file from template_bank.py')
+    parser.add_argument('--threshold', type=float, default=8.)
+    parser.add_argument('--block-duration', type=float, default=64.)
+    args = parser.parse_args()
+
+    if args.bank is not None:
+        from template_bank import bank_comp_params, load_bank
+        param_array = bank_comp_params(load_bank(args.bank))
+    else:
+        from GW_class import GW_events
+        param_array = GW_events[args.event].comp_params
+    stream, triggers = stream_file(args.filename, param_array, args.threshold,
+                                   block_duration=args.block_duration)
+    for trigger in triggers:
+        print(f"{trigger['time']:.4f}: SNR {trigger['SNR']:.2f} (template {trigger['template']})")
+    print(f'{stream.data_time:.0f} s of data in {stream.wall_time:.1f} s '
+          f'({stream.throughput:.0f} s of data per second)')
@@ -2,34 +2,41 @@
 
 
 import numpy as np
+from functools import lru_cache
 from IMRPhenomD.IMRPhenomD import AmpPhaseFDWaveform, IMRPhenomDGenerateh22FDAmpPhase
 import IMRPhenomD.IMRPhenomD_const as imrc
 from scipy.interpolate import interp1d
 import constants as c
 from scipy.signal import resample
 from scipy.signal.windows import tukey
+from fft_backend import irfft
+from signal_processing import decimate
+from product_cache import product_cache
 
 
 # gravitational waveform class for simulated waveforms
 class Waveform:
     
-    def __init__(self, freqs):
+    def __init__(self, freqs, freq_max=None):
         
         # frequency bins to generate frequency-domain waveform
         self.freqs = freqs
         
-        # initialize and store frequency-like objects
+        # initialize and store frequency-like objects (the waveform is zero
+        # between freqs[-1] and freq_max, the top of the full frequency grid)
         self.num_freqs = len(self.freqs)
         self.df = self.freqs[1] - self.freqs[0]
         self.freq_min = self.freqs[0]
-        self.freq_max = self.freqs[-1]
+        self.freq_max = self.freqs[-1] if freq_max is None else freq_max
         self.sampling_freq = 2 * self.freq_max
+        self.num_full_freqs = int(round(self.freq_max / self.df)) + 1
+        self.first_index = int(round(self.freq_min / self.df))
 
         # hyperbolic tangent window for iFFT, centered near f_min
         self.tanh_window = np.tanh(self.freqs - np.array([self.freq_min] * self.num_freqs))
 
         # time axis
-        self.waveform_TD_full_shape = (c.Nf - 1) * 2
+        self.waveform_TD_full_shape = (self.num_full_freqs - 1) * 2
         self.times_full = np.arange(0, self.waveform_TD_full_shape/self.sampling_freq, 1/self.sampling_freq) + c.window_min
         self.times = self.times_full[(self.times_full >= c.window_min) & (self.times_full <= c.window_max)]
         self.Nt = self.times.shape[0]
@@ -74,14 +81,14 @@ class Waveform:
         # apply hyperbolic tangent window
         windowed_waveform_FD = self.tanh_window * waveform_FD
         # pad with zeros down to DC component
-        full_FD_waveform = np.zeros(c.Nf, dtype='complex')
-        full_FD_waveform[-self.num_freqs:] = windowed_waveform_FD
+        full_FD_waveform = np.zeros(self.num_full_freqs, dtype='complex')
+        full_FD_waveform[self.first_index:self.first_index + self.num_freqs] = windowed_waveform_FD
         return full_FD_waveform
 
 
     # inverse FFT waveform to go into time-domain
     def iFFT_waveform(self, waveform_FD):
-        waveform_TD = np.fft.irfft(waveform_FD)
+        waveform_TD = irfft(waveform_FD)
         # set merger to t = 0
         waveform_TD = np.roll(waveform_TD, self.merger_index - np.argmax(waveform_TD))[:self.Nt]
         return waveform_TD
@@ -96,37 +103,109 @@ class Waveform:
 # instantiate waveform class for frequency bins (defined in constants.py)
 waveform = Waveform(c.freqs)
 
-
-def get_template(comp_params, data_dict):
-    dt = data_dict['dt']
-    fs = data_dict['fs']
-
-    fig_template = np.array([waveform.times, waveform.get_TD_waveform(comp_params, 0.0)]).T
-    times_interp = np.linspace(waveform.times[0], waveform.times[-1], 6000)
-    waveform_interp = interp1d(fig_template[:, 0], fig_template[:, 1])(times_interp)
-    fig_template = np.array([times_interp, waveform_interp]).T[-3440:]
-    fig_template = fig_template[:, 1]
+# times the time-domain waveform is interpolated onto before being cut to the
+# support of a template, and the number of samples of the support (after
+# downsampling by 4) from its merger (t = 0) to its end
+support_times = np.linspace(waveform.times[0], waveform.times[-1], 6000)[-3440:]
+support_merger = (len(support_times) - np.argmin(np.abs(support_times))) / 4
+
+# sample rate the support comes out at: it is used as if it were at the sample
+# rate of the data, so waveform frequencies appear support_rate / fs times lower
+support_rate = (len(support_times) - 1) / (support_times[-1] - support_times[0]) / 4
+
+
+@lru_cache()
+def coarse_waveform(f_high, f_low=30., df=1./4):
+    """Waveform generator for approximate templates, several times cheaper than
+    waveform: the frequency-domain waveform is only evaluated from f_low to
+    f_high (Hz), on a grid of spacing df, and is zero outside. It suits templates
+    filtered at a reduced sample rate, with f_high the waveform frequency that
+    lands at their Nyquist frequency, against psds that leave little weight
+    below f_low. Durations in band have to be well under 1 / df (under 2 s from
+    30 Hz down to chirp masses of 10).
+
+    Args:
+        f_high (float): highest frequency of the waveform (Hz)
+        f_low (float): lowest frequency of the waveform (Hz)
+        df (float): frequency spacing (Hz)
+
+    Returns:
+        Waveform: generator to pass to get_template
+    """
+    freqs = np.arange(np.ceil(f_low / df), np.floor(min(f_high, c.f_max) / df) + 1) * df
+    return Waveform(freqs, freq_max=c.f_max)
+
+
+def template_support(comp_params, generator=waveform):
+    # tapered template at 4096 Hz, before padding to the length of the data
+    # (through the product cache if templates are cached, and generated with
+    # the full frequency grid)
+    if generator is not waveform:
+        return _template_support(comp_params, generator)
+    if c.cache_templates:
+        return product_cache.fetch('template', lambda: _template_support(comp_params),
+                                   params={'comp_params': comp_params, 'f_min': c.f_min,
+                                           'f_max': c.f_max, 'Nf': c.Nf,
+                                           'window_min': c.window_min,
+                                           'window_max': c.window_max})[0]
+    return _template_support(comp_params)
+
+
+def _template_support(comp_params, generator=waveform):
+    fig_template = np.array([generator.times, generator.get_TD_waveform(comp_params, 0.0)]).T
+    fig_template = interp1d(fig_template[:, 0], fig_template[:, 1])(support_times)
 
     # Downsample this data to 4096 Hz
     fig_template = resample(fig_template, int(len(fig_template)/4) )
 
     # apply a Tukey window to taper the ends of the template
     taper_window = tukey(len(fig_template), alpha=.25)
-    fig_template_tapered = fig_template * taper_window
+    return fig_template * taper_window
+
 
-    # -- Plot template before and after tapering
-    template_time = np.arange(0.25, 0.25+len(fig_template_tapered)*dt,dt)
+def get_template(comp_params, data_dict, generator=waveform):
+    # events analysed at a decimated rate get the template built at the
+    # original rate, then decimated the same way as their data
+    factor = data_dict.get('decimation', 1)
+    fs = data_dict['fs'] * factor
+
+    fig_template_tapered = template_support(comp_params, generator)
 
     # Now we need to pad this with 0s to make it the same amount of time as the data
     halfdatalen = int(16*fs)
     begin_add = halfdatalen - len(fig_template_tapered)
 
-    # add last 2048 seconds
-    fig_template_tapered = np.append(fig_template_tapered, (halfdatalen * [0]))
-    # add beginning- almost 2048 seconds
-    fig_template_tapered = np.append((int(begin_add) * [0]), fig_template_tapered)
-
-    return fig_template_tapered
+    if factor == 1:
+        # add last 2048 seconds, and the beginning- almost 2048 seconds
+        template = np.zeros(2 * halfdatalen)
+        template[begin_add:halfdatalen] = fig_template_tapered
+        return template
+    # only the support of the template (and the length of the decimation
+    # filter around it) needs decimating, everything else stays zero
+    pad = 20 * factor
+    start = (begin_add - pad) // factor * factor
+    support = np.zeros(halfdatalen + pad - start)
+    support[begin_add - start:halfdatalen - start] = fig_template_tapered
+    decimated = decimate(support, factor)
+    template = np.zeros(2 * halfdatalen // factor)
+    template[start // factor:start // factor + len(decimated)] = decimated
+    return template
+
+
+def merger_time(data_dict):
+    """Time of the merger of the templates get_template builds for an event: the
+    support of every template ends at the middle sample of the data, with its
+    merger support_merger samples (at the original sample rate) before that.
+
+    Args:
+        data_dict (dict): dict containing the time and sample rate of the data
+
+    Returns:
+        float: time of the template merger, before any shift by the matched filter
+    """
+    time = data_dict['time']
+    fs = data_dict['fs'] * data_dict.get('decimation', 1)
+    return time[len(time) // 2] - support_merger / fs
 
 
 
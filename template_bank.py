@@ -0,0 +1,210 @@
+'''Place a template bank over (Mc, q, chi+, chi-) stochastically, at a target
+minimal match against the psd of an event.'''
+
+
+import argparse
+import json
+
+import numpy as np
+from scipy.spatial import cKDTree
+import constants as c
+from matched_filter import batch_match, match_waveforms
+from sampler import get_comp_params
+
+
+# one row of a bank file: sampled and component parameters, in single precision
+bank_dtype = np.dtype([('chirp', 'f4'), ('ratio', 'f4'), ('spin_plus', 'f4'), ('spin_minus', 'f4'),
+                       ('mass1', 'f4'), ('mass2', 'f4'), ('spin1z', 'f4'), ('spin2z', 'f4')])
+
+# finite-difference steps in (Mc, q, chi+, chi-) used to estimate the metric
+metric_steps = np.array([0.05, 0.01, 0.01, 0.01])
+
+# oversampling of the time maximization of the matches the metric is estimated
+# from: at the metric steps, the mismatches are small enough that the sample
+# grid of the time maximization would otherwise dominate them
+metric_oversample = 16
+
+
+def match_metric(center, GW_signal, det, steps=metric_steps, oversample=metric_oversample):
+    """Estimates the metric g of the match at a point of (Mc, q, chi+, chi-), such
+    that 1 - match ~ g_ij dx_i dx_j, by finite differences of the match (with
+    the time maximization oversampled and interpolated between samples).
+
+    Args:
+        center (ndarray): point (Mc, q, chi+, chi-) to estimate the metric at
+        GW_signal (GWSignals): event whose psd weights the match
+        det (str): detector whose psd is used
+        steps (ndarray, optional): step in each parameter
+        oversample (int, optional): oversampling of the time maximization
+
+    Returns:
+        ndarray: 4x4 metric
+    """
+    ndim = len(center)
+    params_center = get_comp_params(center)
+    # displacements along each axis, then along each pair of axes
+    pairs = [(i, j) for i in range(ndim) for j in range(i + 1, ndim)]
+    displacements = [steps * np.eye(ndim)[i] for i in range(ndim)]
+    displacements += [steps * (np.eye(ndim)[i] + np.eye(ndim)[j]) for i, j in pairs]
+    mismatches = 1. - batch_match(params_center,
+                                  np.array([get_comp_params(center + d) for d in displacements]),
+                                  GW_signal, det, oversample=oversample, interpolate=True)
+
+    metric = np.diag(mismatches[:ndim] / steps**2)
+    for (i, j), mismatch in zip(pairs, mismatches[ndim:]):
+        cross = mismatch - mismatches[i] - mismatches[j]
+        metric[i, j] = metric[j, i] = cross / (2 * steps[i] * steps[j])
+    return metric
+
+
+def metric_transform(metric):
+    """Linear map to coordinates where the metric is (approximately) Euclidean.
+
+    Raises:
+        ValueError: if the metric is not positive-definite, as distances would
+            then not track the mismatch (the estimate is too noisy, e.g. the
+            steps are too small)
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(metric)
+    if eigenvalues.min() <= 0:
+        raise ValueError(f'metric is not positive-definite (eigenvalues {eigenvalues})')
+    return np.sqrt(eigenvalues)[:, None] * eigenvectors.T
+
+
+class BankIndex:
+    """Spatial index over the templates of a bank in metric coordinates: a KD-tree
+    that is rebuilt every rebuild_every templates, plus a brute-force search
+    over the templates added since.
+    """
+
+    def __init__(self, transform, rebuild_every=256):
+        self.transform = transform
+        self.rebuild_every = rebuild_every
+        self.points = []
+        self.tree = None
+        self.tree_size = 0
+
+    def add(self, sample):
+        self.points.append(self.transform @ sample)
+        if len(self.points) - self.tree_size >= self.rebuild_every:
+            self.tree = cKDTree(np.array(self.points))
+            self.tree_size = len(self.points)
+
+    def neighbors(self, sample, radius):
+        """Indexes of the templates within radius (metric distance) of sample."""
+        point = self.transform @ sample
+        indexes = [] if self.tree is None else self.tree.query_ball_point(point, radius)
+        recent = np.array(self.points[self.tree_size:]).reshape(-1, len(point))
+        close = np.flatnonzero(np.sum((recent - point)**2, axis=1) <= radius**2)
+        return np.concatenate([np.array(indexes, dtype=int), close + self.tree_size])
+
+
+def place_bank(GW_signal, det='H1', min_match=0.97, chirp_range=None, ratio_range=(1./18, c.ratio_max),
+               spin_range=(c.spin_plus_min, c.spin_plus_max), radius_factor=1.5,
+               max_rejections=2000, max_templates=None, seed=None):
+    """Places a bank stochastically: proposals are drawn uniformly over the
+    parameter ranges and kept if their match with every template already in the
+    bank is below min_match. Only the templates within radius_factor times the
+    metric radius of the target mismatch are matched against, found with a
+    KD-tree in the metric coordinates at the centre of the ranges, and those
+    matches are evaluated in one batch, against whitened waveforms of the
+    templates kept alongside the bank.
+
+    Args:
+        GW_signal (GWSignals): event whose psd weights the match
+        det (str): detector whose psd is used
+        min_match (float): target minimal match of the bank
+        chirp_range (tuple, optional): chirp mass range, defaults to the slider
+            range around the reference chirp mass
+        ratio_range (tuple): mass ratio range (IMRPhenomD is calibrated to 1/18)
+        spin_range (tuple): range of chi+ and chi-
+        radius_factor (float): safety factor on the metric radius, as the
+            metric is only an approximation away from the centre
+        max_rejections (int): stop after this many proposals in a row are rejected
+        max_templates (int, optional): stop once the bank has this many templates
+        seed (int, optional): seed for the random number generator
+
+    Returns:
+        ndarray: bank, with dtype bank_dtype
+        dict: metadata of the placement
+    """
+    rng = np.random.default_rng(seed)
+    if chirp_range is None:
+        chirp_range = (max(GW_signal.chirp - 10., 1.), GW_signal.chirp + 10.)
+    bounds = np.array([chirp_range, ratio_range, spin_range, spin_range])
+    center = bounds.mean(axis=1)
+
+    metric = match_metric(center, GW_signal, det)
+    index = BankIndex(metric_transform(metric))
+    radius = radius_factor * np.sqrt(1. - min_match)
+
+    # whitened waveforms of the templates in the bank, in single precision
+    samples, comp_params, waveforms = [], [], []
+    rejections, num_proposals, num_matches = 0, 0, 0
+    while rejections < max_rejections and (max_templates is None or len(samples) < max_templates):
+        sample = bounds[:, 0] + (bounds[:, 1] - bounds[:, 0]) * rng.random(len(bounds))
+        params = get_comp_params(sample)
+        if not (c.chi1_min <= params[2] <= c.chi1_max and c.chi2_min <= params[3] <= c.chi2_max):
+            continue
+        num_proposals += 1
+
+        neighbors = index.neighbors(sample, radius)
+        if len(neighbors):
+            num_matches += len(neighbors)
+            neighbor_waveforms = np.array([waveforms[i] for i in neighbors])
+            if np.max(batch_match(params, None, GW_signal, det,
+                                  waveforms=neighbor_waveforms)) >= min_match:
+                rejections += 1
+                continue
+        samples.append(sample)
+        comp_params.append(params)
+        waveforms.append(match_waveforms(params, GW_signal, det, np.complex64)[0])
+        index.add(sample)
+        rejections = 0
+
+    bank = np.zeros(len(samples), dtype=bank_dtype)
+    for name, column in zip(bank_dtype.names, np.hstack([samples, comp_params]).T):
+        bank[name] = column
+    metadata = {'det': det, 'min_match': min_match, 'bounds': bounds.tolist(),
+                'metric': metric.tolist(), 'num_proposals': num_proposals,
+                'matches_per_proposal': num_matches / max(num_proposals, 1)}
+    return bank, metadata
+
+
+def save_bank(filename, bank, metadata=None):
+    """Saves a bank as a .npy file (and its metadata as a .json file next to it)."""
+    np.save(filename, bank)
+    if metadata is not None:
+        with open(filename.replace('.npy', '') + '.json', 'w') as f:
+            json.dump(metadata, f, indent=2)
+
+
+def load_bank(filename):
+    """Memory-maps a bank saved with save_bank, read-only."""
+    return np.load(filename, mmap_mode='r')
+
+
+def bank_comp_params(bank):
+    """Component parameters (m1, m2, chi1, chi2) of a bank, one template per row."""
+    return np.stack([bank['mass1'], bank['mass2'], bank['spin1z'], bank['spin2z']], axis=1).astype(float)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('event', help='bundled event whose psd weights the match')
+    parser.add_argument('--det', default='H1')
+    parser.add_argument('--min-match', type=float, default=0.97)
+    parser.add_argument('--max-rejections', type=int, default=2000)
+    parser.add_argument('--max-templates', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--output', default=None, help='bank file (default: <event>_bank.npy)')
+    args = parser.parse_args()
+
+    from GW_class import GW_events
+    bank, metadata = place_bank(GW_events[args.event], args.det, args.min_match,
+                                max_rejections=args.max_rejections,
+                                max_templates=args.max_templates, seed=args.seed)
+    metadata['event'] = args.event
+    save_bank(args.output or f'{args.event}_bank.npy', bank, metadata)
+    print(f"{args.event}: {len(bank)} templates from {metadata['num_proposals']} proposals, "
+          f"{metadata['matches_per_proposal']:.1f} matches per proposal")
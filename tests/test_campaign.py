@@ -0,0 +1,70 @@
+import os
+import threading
+import time
+
+import numpy as np
+from campaign import (claim_unit, create_campaign, load_results, pending_units, run_unit, summarize,
+                      unit_claims)
+from test_matched_filter import design_psd
+
+
+def test_claims_are_exclusive(tmp_path):
+    os.makedirs(tmp_path / 'units')
+    claim = claim_unit(str(tmp_path), 3, claim_timeout=60.)
+    assert claim is not None
+    assert claim_unit(str(tmp_path), 3, claim_timeout=60.) is None
+    assert claim_unit(str(tmp_path), 4, claim_timeout=60.) is not None
+
+
+def test_one_worker_takes_over_a_stale_claim(tmp_path):
+    os.makedirs(tmp_path / 'units')
+    stale = claim_unit(str(tmp_path), 0, claim_timeout=60.)
+    os.utime(stale, (time.time() - 120., time.time() - 120.))
+
+    barrier = threading.Barrier(8)
+    claims = []
+
+    def worker():
+        barrier.wait()
+        claims.append(claim_unit(str(tmp_path), 0, claim_timeout=60.))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    owners = [claim for claim in claims if claim is not None]
+    assert len(owners) == 1
+
+    # the worker of the stale claim releasing it leaves the new claim in place
+    os.remove(stale)
+    assert unit_claims(str(tmp_path), 0) == [1]
+    assert claim_unit(str(tmp_path), 0, claim_timeout=60.) is None
+
+
+def test_tiny_campaign_recovers_its_injections(tmp_path):
+    directory = str(tmp_path)
+    settings = create_campaign(directory, 3, unit_size=2, num_coarse=16, maxiter=60,
+                               domain=[[30., 40.], [25., 35.], [-0.3, 0.3], [-0.3, 0.3]])
+    # an existing campaign is resumed as it was created
+    assert create_campaign(directory, 10, unit_size=5) == settings
+    psds = {'H1': design_psd(), 'L1': design_psd()}
+    assert pending_units(directory, settings) == [0, 1]
+    assert [run_unit(directory, settings, unit, psds)[:2] for unit in (0, 1)] == [(0, 2), (1, 1)]
+    assert pending_units(directory, settings) == []
+
+    results = load_results(directory)
+    np.testing.assert_array_equal(results['index'], [0, 1, 2])
+    summary = summarize(results, settings['snr'])
+    assert summary['num_injections'] == 3
+    assert np.all(np.abs(summary['snr_true_fraction'] - 1.) < 0.2)
+    assert np.all(summary['fitting_factor'] > 0.98)
+    assert np.all(np.abs(results['recovered'][:, :2] - results['injected'][:, :2]) < 10.)
+
+    # every injection has its own seeds, so a unit run again gives the same results
+    run_unit(directory, settings, 1, psds)
+    again = load_results(directory)
+    np.testing.assert_array_equal(again['injected'], results['injected'])
+    np.testing.assert_allclose(again['snr_true'], results['snr_true'], rtol=1e-8)
+    # up to rounding differences between fft plans, which the refinement may follow
+    np.testing.assert_allclose(again['snr_recovered'], results['snr_recovered'], rtol=1e-3)
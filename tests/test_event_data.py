@@ -0,0 +1,46 @@
+import pickle
+import tracemalloc
+
+import numpy as np
+from event_store import load_event, save_event
+from GW_class import EventData
+from test_matched_filter import simulated_event
+
+
+def test_event_data_holds_under_half_of_a_pickled_event(tmp_path):
+    filename = tmp_path / 'event.pkl'
+    with open(filename, 'wb') as f:
+        pickle.dump(simulated_event(), f)
+
+    tracemalloc.start()
+    try:
+        with open(filename, 'rb') as f:
+            total_data = pickle.load(f)
+        dictionary_bytes = tracemalloc.get_traced_memory()[0]
+        event = EventData.from_dict(total_data)
+        del total_data
+        event.derived('strain_whitenbp')
+        event_bytes = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    assert event_bytes < 0.5 * dictionary_bytes
+    assert event.nbytes < 0.5 * dictionary_bytes
+
+
+def test_stored_event_round_trip(tmp_path):
+    total_data = simulated_event()
+    save_event(total_data, str(tmp_path))
+    event = EventData.from_dict(load_event(str(tmp_path)))
+
+    # the stored strain is mapped as it is, not copied
+    assert not event.strain.flags.owndata and not event.strain.flags.writeable
+    np.testing.assert_array_equal(event.time, total_data['time'])
+    assert (event.time_center, event.dt, event.fs) == \
+        (total_data['time_center'], total_data['dt'], total_data['fs'])
+    for i, det in enumerate(event.dets):
+        for name in ('strain', 'strain_whiten', 'strain_whitenbp'):
+            expected = total_data[det][name]
+            np.testing.assert_allclose(event[det][name], expected, rtol=0,
+                                       atol=1e-6 * np.max(np.abs(expected)))
+        freqs = np.linspace(20., 1000., 50)
+        np.testing.assert_array_equal(event.psds[det](freqs), total_data['large_data_psds'][det](freqs))
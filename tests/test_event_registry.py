@@ -0,0 +1,78 @@
+import threading
+
+import pytest
+from GW_class import EventRegistry
+
+
+class FakeSignal:
+    """Stands in for a GWSignals, counting the loads of its data."""
+
+    def __init__(self, name, error=None, release=None):
+        self.name = name
+        self.error = error
+        self.release = release
+        self.loads = 0
+
+    def load_data(self):
+        self.loads += 1
+        if self.release is not None:
+            self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return {'name': self.name}
+
+
+def test_least_recently_used_is_unloaded_first():
+    registry = EventRegistry(max_resident=2, prefetch_next=False)
+    a, b, c = FakeSignal('a'), FakeSignal('b'), FakeSignal('c')
+    assert registry.get(a) == {'name': 'a'}
+    registry.get(b)
+    registry.get(a)
+    registry.get(c)
+    assert list(registry.resident) == [a, c]
+    registry.get(b)
+    assert list(registry.resident) == [c, b]
+    assert (a.loads, b.loads, c.loads) == (1, 2, 1)
+
+
+def test_prefetch_loads_next_event_once():
+    registry = EventRegistry(max_resident=2, prefetch_next=True)
+    a, b = FakeSignal('a'), FakeSignal('b')
+    registry.register(a)
+    registry.register(b)
+    registry.get(a)
+    assert registry.get(b) == {'name': 'b'}
+    assert b.loads == 1
+    assert list(registry.resident) == [a, b]
+
+
+def test_prefetch_counts_towards_max_resident():
+    registry = EventRegistry(max_resident=2, prefetch_next=False)
+    release = threading.Event()
+    a, b, c = FakeSignal('a'), FakeSignal('b'), FakeSignal('c', release=release)
+    registry.get(a)
+    registry.get(b)
+    registry.prefetch(c)
+    # a is unloaded to make room for c, b (the most recently used) is kept
+    assert list(registry.resident) == [b]
+    assert c in registry.pending
+    # no room for another prefetch without unloading b
+    d = FakeSignal('d')
+    registry.prefetch(d)
+    assert d not in registry.pending and d.loads == 0
+    release.set()
+    registry.get(c)
+    assert list(registry.resident) == [b, c] and not registry.pending
+
+
+def test_failed_load_is_retried():
+    registry = EventRegistry(max_resident=2, prefetch_next=False)
+    signal = FakeSignal('a', error=OSError('missing file'))
+    for loads in (1, 2):
+        with pytest.raises(OSError):
+            registry.get(signal)
+        assert signal.loads == loads
+        assert signal not in registry.pending
+    signal.error = None
+    assert registry.get(signal) == {'name': 'a'}
+    assert signal.loads == 3
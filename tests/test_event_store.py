@@ -0,0 +1,50 @@
+import json
+import os
+import pickle
+
+import numpy as np
+import pytest
+from event_store import convert_pickle, load_event, save_event
+from test_matched_filter import simulated_event
+
+
+def test_rewritten_event_round_trips(tmp_path):
+    total_data = simulated_event()
+    total_data['decimation'] = 2
+    filename = str(tmp_path / 'GW000000_data_dict.pkl')
+    with open(filename, 'wb') as f:
+        pickle.dump(total_data, f)
+    path = str(tmp_path / 'GW000000')
+    convert_pickle(filename, path)
+    previous = load_event(path)
+
+    # rewritten in double precision under the mapped previous version
+    save_event(total_data, path, dtype=np.float64)
+    loaded = load_event(path)
+    assert len([name for name in os.listdir(path) if name.startswith('data-')]) == 1
+    for key in ('time_center', 'dt', 'fs', 'fband', 'decimation'):
+        assert loaded[key] == total_data[key]
+    np.testing.assert_array_equal(loaded['time'], total_data['time'])
+    for det in ('H1', 'L1'):
+        for name in ('strain', 'strain_whiten', 'strain_whitenbp'):
+            expected = total_data[det][name]
+            assert isinstance(loaded[det][name], np.memmap)
+            np.testing.assert_array_equal(loaded[det][name], expected)
+            # the previous version stays readable where it is mapped
+            np.testing.assert_allclose(previous[det][name], expected, rtol=0,
+                                       atol=1e-6 * np.max(np.abs(expected)))
+        psd, expected_psd = loaded['large_data_psds'][det], total_data['large_data_psds'][det]
+        assert (psd.f0, psd.df) == (expected_psd.f0, expected_psd.df)
+        np.testing.assert_array_equal(psd.values, expected_psd.values)
+
+
+def test_other_format_versions_are_refused(tmp_path):
+    path = str(tmp_path)
+    save_event(simulated_event(), path)
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    meta['format_version'] -= 1
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    with pytest.raises(ValueError, match='format version'):
+        load_event(path)
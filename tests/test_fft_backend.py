@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+import fft_backend
+
+
+def test_pyfftw_plans_leave_input_and_ignore_overwrite_x():
+    pyfftw = pytest.importorskip('pyfftw')
+    backend = fft_backend.get_backend()
+    fft_backend.set_backend('pyfftw')
+    fft_backend.clear_plans()
+    try:
+        rng = np.random.default_rng(0)
+        for shape in ((1024,), (3, 1024)):
+            real = pyfftw.empty_aligned(shape, dtype=np.float64)
+            real[:] = rng.standard_normal(shape)
+            spectrum = pyfftw.empty_aligned(shape[:-1] + (513,), dtype=np.complex128)
+            spectrum[:] = np.fft.rfft(real)
+            for kind, x, expected in (('rfft', real, np.fft.rfft(real)),
+                                      ('irfft', spectrum, np.fft.irfft(spectrum)),
+                                      ('fft', spectrum, np.fft.fft(spectrum)),
+                                      ('ifft', spectrum, np.fft.ifft(spectrum))):
+                original = x.copy()
+                for overwrite_x in (False, True):
+                    result = getattr(fft_backend, kind)(x, overwrite_x=overwrite_x)
+                    np.testing.assert_allclose(result, expected, rtol=0, atol=1e-10)
+                    np.testing.assert_array_equal(x, original)
+        # one plan per transform and shape, whatever overwrite_x
+        assert len(fft_backend._plans) == 8
+    finally:
+        fft_backend.clear_plans()
+        fft_backend.set_backend(backend)
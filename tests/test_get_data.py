@@ -0,0 +1,41 @@
+import h5py
+import numpy as np
+import pytest
+
+# get_data downloads data files with wget
+pytest.importorskip('wget')
+import get_data
+from get_data import load_strain, read_strain
+
+
+def write_strain(filename, strain, t_start, dt):
+    with h5py.File(filename, 'w') as hdf_file:
+        dataset = hdf_file.create_dataset('strain/Strain', data=strain)
+        dataset.attrs['Xstart'] = t_start
+        dataset.attrs['Xspacing'] = dt
+
+
+def test_windowed_read_matches_full_read(tmp_path, monkeypatch):
+    # windows spanning several read chunks, and chunks not dividing them
+    monkeypatch.setattr(get_data, 'read_chunk_length', 1000)
+    t_start, dt = 1126257414., 1. / 4096
+    rng = np.random.default_rng(0)
+    strains = {det: rng.standard_normal(64 * 4096) for det in ('H1', 'L1')}
+    write_strain(str(tmp_path / 'H-H1_test-64.hdf5'), strains['H1'], t_start, dt)
+    write_strain(str(tmp_path / 'L-L1_test-64.hdf5'), strains['L1'], t_start, dt)
+
+    full_strain, full_time, full_dt = read_strain(str(tmp_path / 'H-H1_test-64.hdf5'))
+    np.testing.assert_array_equal(full_strain, strains['H1'])
+    assert full_dt == dt
+    for start_time, end_time in ((t_start + 16., t_start + 48.), (t_start + 10.3, t_start + 10.3001),
+                                 (t_start - 5., t_start + 1.), (t_start + 63.5, t_start + 70.),
+                                 (None, t_start + 2.), (t_start + 80., t_start + 90.)):
+        strain_H1, strain_L1, time, _ = load_strain(str(tmp_path / 'test-64.hdf5'), start_time, end_time)
+        # the samples the time mask of the full read selected
+        keep = np.ones(len(full_time), dtype=bool)
+        if start_time is not None:
+            keep &= full_time >= start_time
+        keep &= full_time < end_time
+        np.testing.assert_array_equal(time, full_time[keep])
+        np.testing.assert_array_equal(strain_H1, strains['H1'][keep])
+        np.testing.assert_array_equal(strain_L1, strains['L1'][keep])
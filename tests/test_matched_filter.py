@@ -0,0 +1,156 @@
+import numpy as np
+from pycbc.filter import match as pycbc_match
+from pycbc.psd import aLIGOZeroDetHighPower
+from pycbc.types import FrequencySeries
+import constants as c
+from fft_backend import rfft
+from matched_filter import (DataSegment, batch_match, batch_matched_filter, calculate_matched_filter,
+                            compare_decimated, compare_segment_length, distance_table, get_shifted_data,
+                            marginalized_loglike, match, matched_filter, segment_window)
+from GW_class import GWSignals
+from psd import PSD
+from simulate import simulate_event
+from template import get_template, merger_time, waveform
+
+
+comp_params = np.array([36., 29., 0.3, -0.1])
+
+
+def design_psd(df=1. / 16):
+    # advanced LIGO design psd, held flat below 10 Hz
+    psd = aLIGOZeroDetHighPower(int(2048 / df) + 1, df, 10.).numpy()
+    psd[:int(10 / df)] = psd[int(10 / df)]
+    return PSD(0., df, np.where(psd > 0, psd, psd.max()))
+
+
+def simulated_event(time_shift=0., snr=20., seed=1, params=comp_params):
+    # simulated event with its merger time_shift (s) after the template merger,
+    # and time_center on the merger as for the bundled events
+    psd = design_psd()
+    total_data = simulate_event(params, {'H1': psd, 'L1': psd}, snr=snr, seed=seed,
+                                time_shift=time_shift)
+    total_data['time_center'] = merger_time(total_data) + time_shift
+    return total_data
+
+
+def test_lag_window_finds_off_centre_event():
+    # the bundled events have their merger up to 0.8 s from the middle of the data
+    for time_shift in (-0.8, 0.5):
+        total_data = simulated_event(time_shift)
+        template_p = get_template(comp_params, total_data)
+        peaks = []
+        for t_amount, lag_window in ((32, None), (4, None), (4, 0.1), (4, 0.01)):
+            segment = DataSegment(total_data, 'H1', t_amount, lag_window)
+            peaks.append(segment.peak(segment.template_fft(template_p)))
+        SNR, _, _, _, phase, offset = peaks[0]
+        assert abs(offset / total_data['fs'] - time_shift) <= 1. / total_data['fs']
+        for peak in peaks[2:]:
+            np.testing.assert_allclose(peak, peaks[1], rtol=1e-12)
+        assert abs(peaks[1][0] / SNR - 1) < 1e-3
+
+
+def test_marginalized_likelihood_peaks_at_injection():
+    total_data = simulated_event()
+    noise_data = simulated_event(snr=0.)
+    scales, log_weights = distance_table()
+
+    def log_like(params, data=total_data):
+        segment = DataSegment(data, 'H1', 4, 0.1)
+        overlap, sigmasq = segment.inner_products(segment.template_fft(get_template(params, data)))
+        return marginalized_loglike(overlap, sigmasq, scales, log_weights)
+
+    factors = [0.8, 0.9, 0.95, 1., 1.05, 1.1, 1.25]
+    values = [log_like(comp_params * [f, f, 1., 1.]) for f in factors]
+    assert factors[np.argmax(values)] in (0.95, 1., 1.05)
+    # SNR 14 in H1: about SNR^2 / 2 less the Occam factors of the marginalization
+    assert values[3] > 50.
+    assert values[3] - max(values[0], values[-1]) > 10.
+    assert abs(log_like(comp_params, noise_data)) < 2.
+
+
+def test_auto_segment_length_matches_full_data():
+    # time_center 0.8 s before the middle of the data is the geometry of GW191109
+    for time_shift in (-0.8, 0., 0.5):
+        GW_signal = GWSignals((36., 29., 0., 0.), simulated_event(time_shift))
+        for det in ('H1', 'L1'):
+            diff = compare_segment_length(comp_params, GW_signal, det)
+            assert diff['t_amount'] < 32
+            assert abs(diff['SNR']) < 1e-3 and abs(diff['amp']) < 1e-3
+            assert abs(diff['phase']) < 1e-3
+            assert abs(diff['time']) < 1. / GW_signal.dictionary['fs']
+
+
+def test_calculate_matched_filter_matches_separate_transforms():
+    # the default path reuses the template fft of the matched filter for the
+    # display fit, where the template used to be transformed again
+    total_data = simulated_event()
+    template_p = get_template(comp_params * [1.02, 1.02, 1., 1.], total_data)
+    fit, _, _, SNR, amp, phase = calculate_matched_filter(template_p, total_data, 'H1')
+
+    window = segment_window(total_data['time'], total_data['time_center'], 4, total_data['fs'])
+    template = template_p[window]
+    expected = matched_filter(template, total_data['H1']['strain'][window], total_data['time'][window],
+                              total_data['large_data_psds']['H1'], total_data['fs'])
+    filter_data = {'d_eff': expected[2], 'phase': expected[4], 'offset': expected[5]}
+    expected_fit = get_shifted_data(template, [35.0, 350.0], filter_data,
+                                    total_data['large_data_psds']['H1'], total_data['dt'],
+                                    template_fft=rfft(template))
+    np.testing.assert_allclose([SNR, amp, phase], [expected[0], 1 / expected[2], expected[4]], rtol=1e-10)
+    assert np.max(np.abs(fit - expected_fit)) < 1e-8 * np.max(np.abs(expected_fit))
+
+
+def test_batch_matched_filter_matches_matched_filter():
+    GW_signal = GWSignals((36., 29., 0., 0.), simulated_event(0.3))
+    total_data = GW_signal.dictionary
+    param_array = comp_params * np.array([[1., 1., 1., 1.], [0.9, 0.95, 1., 1.], [1.1, 1.05, 0., 0.],
+                                          [0.8, 0.8, 1., 1.], [1.2, 0.9, -1., 1.]])
+    # chunks of two templates, the last one left over
+    SNR, phase, offset, d_eff = batch_matched_filter(param_array, GW_signal, chunk_size=2)
+    assert SNR.shape == (len(param_array), 2)
+
+    window = segment_window(total_data['time'], total_data['time_center'], 4, total_data['fs'])
+    for i, params in enumerate(param_array):
+        template = get_template(params, total_data)[window]
+        for j, det in enumerate(('H1', 'L1')):
+            expected = matched_filter(template, total_data[det]['strain'][window],
+                                      total_data['time'][window], total_data['large_data_psds'][det],
+                                      total_data['fs'])
+            np.testing.assert_allclose([SNR[i, j], d_eff[i, j]], [expected[0], expected[2]], rtol=1e-10)
+            assert abs(np.angle(np.exp(1.j * (phase[i, j] - expected[4])))) < 1e-8
+            assert offset[i, j] == expected[5]
+
+
+def test_decimated_matched_filter_matches_full_rate():
+    for fs_analysis in (2048, 1024):
+        GW_signal = GWSignals((36., 29., 0., 0.), simulated_event(0.3), fs_analysis=fs_analysis)
+        assert GW_signal.dictionary['fs'] == fs_analysis
+        for det in ('H1', 'L1'):
+            diff = compare_decimated(comp_params, GW_signal, det)
+            assert abs(diff['SNR']) < 5e-3 and abs(diff['amp']) < 5e-3
+            # the peak can move by a sample of the decimated rate, and the phase with it
+            assert abs(diff['time']) <= 1. / fs_analysis
+            assert abs(diff['phase']) < 0.2
+
+
+def test_batch_match_matches_pycbc():
+    GW_signal = GWSignals((36., 29., 0., 0.), simulated_event())
+    param_array = comp_params * np.array([[1., 1., 1., 1.], [0.98, 1., 1., 1.], [1.05, 0.97, 1., 1.],
+                                          [0.9, 0.9, 0., 0.], [1.2, 1.1, -1., 1.]])
+    matches = batch_match(comp_params, param_array, GW_signal, 'H1', chunk_size=2)
+    assert matches[0] == 1.
+
+    inverse_psd = GW_signal.get_inverse_psd('H1')
+    psd = FrequencySeries(np.where(inverse_psd > 0, 1. / np.where(inverse_psd > 0, inverse_psd, 1.), 0.),
+                          delta_f=waveform.df)
+
+    def frequency_series(params):
+        return FrequencySeries(waveform.get_FD_waveform(params, 0.), delta_f=waveform.df)
+
+    expected = [pycbc_match(frequency_series(comp_params), frequency_series(params), psd=psd,
+                            low_frequency_cutoff=c.f_min)[0] for params in param_array]
+    np.testing.assert_allclose(matches, np.minimum(expected, 1.), rtol=1e-10)
+    for params, value in zip(param_array, matches):
+        np.testing.assert_allclose(match(params, comp_params, GW_signal, 'H1'), value, rtol=1e-10)
+    # maximizing between samples only raises the match
+    finer = batch_match(comp_params, param_array, GW_signal, 'H1', oversample=4, interpolate=True)
+    assert np.all(finer >= matches) and np.all(finer <= 1.)
@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import pytest
+import product_cache
+from product_cache import ProductCache, product_key
+
+
+def test_bumping_a_product_version_recomputes_only_that_kind(tmp_path, monkeypatch):
+    cache = ProductCache(str(tmp_path), max_bytes=None)
+    strain = np.arange(16.)
+    calls = []
+
+    def compute(kind):
+        calls.append(kind)
+        return strain * len(calls)
+
+    psd_key = cache.fetch('welch_psd', lambda: compute('welch_psd'), inputs=(strain,))[1]
+    whiten_key = cache.fetch('whiten', lambda: compute('whiten'), inputs=(strain,))[1]
+    cache.fetch('welch_psd', lambda: compute('welch_psd'), inputs=(strain,))
+    assert calls == ['welch_psd', 'whiten']
+
+    monkeypatch.setitem(product_cache.product_versions, 'welch_psd',
+                        product_cache.product_versions['welch_psd'] + 1)
+    assert product_key('welch_psd', (strain,)) != psd_key
+    assert product_key('whiten', (strain,)) == whiten_key
+    product, key = cache.fetch('welch_psd', lambda: compute('welch_psd'), inputs=(strain,))
+    cache.fetch('whiten', lambda: compute('whiten'), inputs=(strain,))
+    assert calls == ['welch_psd', 'whiten', 'welch_psd']
+    np.testing.assert_array_equal(product, 3 * strain)
+    assert cache.index()[key]['version'] == product_cache.product_versions['welch_psd']
+
+
+def test_fetch_computes_each_product_once(tmp_path):
+    cache = ProductCache(str(tmp_path), max_bytes=None)
+    strain = np.arange(1000.)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return strain**2
+
+    product, key = cache.fetch('square', compute, inputs=(strain,), params={'power': 2})
+    cached, cached_key = cache.fetch('square', compute, inputs=(strain,), params={'power': 2})
+    assert cached_key == key and len(calls) == 1 and (cache.hits, cache.misses) == (1, 1)
+    np.testing.assert_array_equal(cached, strain**2)
+    assert isinstance(cached, np.memmap) and not cached.flags.writeable
+    # other parameters, inputs or input keys are other products
+    assert cache.fetch('square', compute, inputs=(strain,), params={'power': 3})[1] != key
+    assert cache.fetch('square', compute, inputs=(strain + 1,), params={'power': 2})[1] != key
+    assert cache.fetch('square', compute, inputs=(key,), params={'power': 2})[1] != key
+    assert len(calls) == 4 and cache.index()[key]['params'] == {'power': 2}
+
+    cache.clear('square')
+    assert cache.index() == {} and cache.get(key) is None
+
+
+def test_least_recently_used_products_are_evicted(tmp_path):
+    cache = ProductCache(str(tmp_path), max_bytes=None)
+    keys = [cache.fetch('product', lambda: np.full(1000, i, dtype=float), params={'i': i})[1]
+            for i in range(4)]
+    # used in the order 1, 0, 3, 2
+    for age, key in enumerate([keys[1], keys[0], keys[3], keys[2]]):
+        os.utime(cache.path(key), (1e9 + age, 1e9 + age))
+    size = os.path.getsize(cache.path(keys[0]))
+    cache.evict(2 * size)
+    assert [cache.get(key) is not None for key in keys] == [False, False, True, True]
+
+    # put keeps the cache under max_bytes
+    bounded = ProductCache(str(tmp_path / 'bounded'), max_bytes=2 * size)
+    for i in range(5):
+        bounded.fetch('product', lambda: np.full(1000, i, dtype=float), params={'i': i})
+    assert len(bounded.index()) == 2
+
+
+def test_unwritable_or_disabled_cache_computes_products(tmp_path):
+    assert ProductCache(None).fetch('product', lambda: np.ones(3))[1] is None
+    blocker = tmp_path / 'file'
+    blocker.write_text('')
+    cache = ProductCache(str(blocker / 'cache'))
+    with pytest.warns(UserWarning, match='cannot be cached'):
+        product, key = cache.fetch('product', lambda: np.ones(3))
+    np.testing.assert_array_equal(product, np.ones(3))
+    assert cache.write_errors == 1
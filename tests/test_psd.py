@@ -0,0 +1,59 @@
+import pickle
+
+import numpy as np
+from scipy.interpolate import interp1d
+from psd import PSD, as_psd
+from signal_processing import whiten
+from test_signal_processing import baseline_whiten
+
+
+def interp_psd(df=0.25, fs=4096):
+    # psd as the pickled events hold it: an interp1d over a uniform grid
+    freqs = np.arange(0., fs / 2 + df / 2, df)
+    values = 1e-46 * (1. + (50. / np.maximum(freqs, 5.))**8 + (freqs / 500.)**2)
+    values *= 1. + 0.1 * np.random.default_rng(0).random(freqs.size)
+    return interp1d(freqs, values)
+
+
+def test_psd_matches_interp1d():
+    baseline = interp_psd()
+    psd = as_psd(baseline)
+    assert psd.df == 0.25
+    freqs = np.concatenate([np.random.default_rng(1).uniform(0., 2048., 10000),
+                            baseline.x[:100], [0., 2048.]])
+    np.testing.assert_allclose(psd(freqs), baseline(freqs), rtol=1e-12, atol=0)
+
+
+def test_psd_grids_match_interp1d():
+    baseline = interp_psd()
+    psd = as_psd(baseline)
+    n, dt = 4096 * 8, 1. / 4096
+    freqs = np.fft.rfftfreq(n, dt)
+    np.testing.assert_allclose(psd.rfft_grid(n, dt), baseline(freqs), rtol=1e-12, atol=0)
+    np.testing.assert_allclose(psd.asd(n, dt), np.sqrt(baseline(freqs)), rtol=1e-12, atol=0)
+    np.testing.assert_allclose(psd.inverse(n, dt), 1. / baseline(freqs), rtol=1e-12, atol=0)
+    assert not psd.asd(n, dt).flags.writeable
+
+
+def test_non_uniform_psd_is_resampled():
+    freqs = np.array([0., 1., 3., 6., 10.])
+    baseline = interp1d(freqs, freqs**2)
+    psd = as_psd(baseline)
+    assert psd.df == 1.
+    np.testing.assert_allclose(psd(np.arange(11.)), baseline(np.arange(11.)), rtol=1e-12)
+
+
+def test_whiten_with_psd_matches_interp1d():
+    baseline = interp_psd()
+    strain = np.random.default_rng(2).standard_normal(4096 * 8)
+    expected = baseline_whiten(strain, baseline, 1. / 4096)
+    whitened = whiten(strain, as_psd(baseline), 1. / 4096)
+    assert np.max(np.abs(whitened - expected)) < 1e-10 * np.max(np.abs(expected))
+
+
+def test_psd_pickles_as_its_fields():
+    psd = as_psd(interp_psd())
+    psd.asd(1024, 1. / 4096)
+    loaded = pickle.loads(pickle.dumps(psd))
+    assert isinstance(loaded, PSD) and loaded._cache == {}
+    np.testing.assert_array_equal(loaded.values, psd.values)
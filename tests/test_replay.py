@@ -0,0 +1,43 @@
+import h5py
+import numpy as np
+from replay import RealtimeReplay, RingBuffer
+from simulate import injection_signal, simulate_strain
+from test_matched_filter import comp_params, design_psd
+
+
+def test_ring_buffer_keeps_the_latest_samples():
+    stream = np.arange(100.)
+    buffer = RingBuffer(16)
+    seen = 0
+    # chunks shorter than, as long as and longer than the buffer
+    for size in (5, 7, 16, 3, 40, 1, 28):
+        buffer.extend(stream[seen:seen + size])
+        seen += size
+        num = min(seen, 16)
+        assert buffer.count == num
+        np.testing.assert_array_equal(buffer.latest(num), stream[seen - num:seen])
+    assert buffer.full
+
+
+def test_replay_triggers_on_injection(tmp_path):
+    fs, duration, time_shift = 4096, 64., 14.3
+    strain = simulate_strain(comp_params, {'H1': design_psd()}, snr=20., fs=fs, duration=duration,
+                             dets=('H1',), seed=3, time_shift=time_shift)[0]
+    filename = str(tmp_path / 'H-H1_simulated-0-64.hdf5')
+    t_start = 1e9
+    with h5py.File(filename, 'w') as hdf_file:
+        dataset = hdf_file.create_dataset('strain/Strain', data=strain)
+        dataset.attrs['Xstart'] = t_start
+        dataset.attrs['Xspacing'] = 1. / fs
+
+    # time of the peak of the injected signal
+    n = len(strain)
+    peak_time = t_start + (np.argmax(np.abs(injection_signal(comp_params, fs, n))) +
+                           time_shift * fs) / fs
+
+    pipeline = RealtimeReplay(comp_params, fs, threshold=8.)
+    triggers = [trigger for result in pipeline.replay(filename) for trigger in result['triggers']]
+    assert len(triggers) == 1
+    assert abs(triggers[0]['time'] - peak_time) <= 1. / fs
+    assert 15. < triggers[0]['SNR'] < 25.
+    assert len(pipeline.latencies) == duration
@@ -0,0 +1,20 @@
+import numpy as np
+from pycbc.conversions import chi_a, chi_eff, mchirp_from_mass1_mass2
+from GW_class import GWSignals, GW_events
+from sampler import run_sampler
+from test_matched_filter import comp_params, simulated_event
+
+
+def test_short_chain_moves_to_injection(monkeypatch):
+    # walkers start around reference parameters 3 Msun heavier in each mass
+    # than the injection, and have to find it
+    m1, m2, chi1, chi2 = comp_params
+    ref_params = (m1 + 3., m2 + 3., chi_eff(m1, m2, chi1, chi2), chi_a(m1, m2, chi1, chi2))
+    monkeypatch.setitem(GW_events, 'simulated', GWSignals(ref_params, simulated_event()))
+    result = run_sampler('simulated', nwalkers=16, nsteps=200, burn_in=100, processes=1, seed=0)
+
+    chirp = result['samples'][:, 0]
+    assert abs(np.mean(chirp) - mchirp_from_mass1_mass2(m1, m2)) < 1.
+    # the prior on the chirp mass is 20 Msun wide
+    assert np.std(chirp) < 2.
+    assert np.mean(result['log_prob'][-1]) > 50.
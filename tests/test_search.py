@@ -0,0 +1,21 @@
+import numpy as np
+from GW_class import GWSignals
+from sampler import get_comp_params
+from search import hierarchical_search
+from test_matched_filter import comp_params, simulated_event
+
+
+def test_coarse_templates_rank_like_exact_ones():
+    # event 0.8 s before the middle of the data, as GW191109
+    GW_signal = GWSignals((36., 29., 0., 0.), simulated_event(-0.8))
+    rng = np.random.default_rng(0)
+    samples = np.column_stack([rng.uniform(18., 38., 40), rng.uniform(0.3, 1., 40),
+                               rng.uniform(-0.5, 0.5, 40), np.zeros(40)])
+    bank = np.vstack([comp_params, [get_comp_params(sample) for sample in samples]])
+
+    coarse = hierarchical_search(GW_signal, bank)
+    exact = hierarchical_search(GW_signal, bank, coarse_templates=False)
+    np.testing.assert_allclose(coarse['coarse_network_snr'], exact['coarse_network_snr'], rtol=2e-2)
+    np.testing.assert_array_equal(coarse['best_params'], exact['best_params'])
+    # the injection (network SNR 20) is found in the lag window
+    assert coarse['best_network_snr'] > 19.
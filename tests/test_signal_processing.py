@@ -0,0 +1,90 @@
+import matplotlib.mlab as mlab
+import numpy as np
+from scipy.interpolate import interp1d
+from scipy.signal import butter, filtfilt, welch
+from scipy.signal.windows import tukey
+from signal_processing import bandpass, butter_bandpass, welch_psd, whiten_bandpass
+
+
+fs = 4096
+fband = (35.0, 350.0)
+
+
+def noise(shape, seed=0):
+    return np.random.default_rng(seed).standard_normal(shape)
+
+
+def smooth_psd():
+    # psd rising steeply below 50 Hz, as an interp1d like the pickled psds
+    freqs = np.linspace(0., fs / 2, fs // 4 + 1)
+    return interp1d(freqs, 1e-46 * (1. + (50. / np.maximum(freqs, 5.))**8 + (freqs / 500.)**2))
+
+
+def baseline_whiten(strain, interp_psd, dt, phase_shift=0, time_shift=0):
+    # whiten as it was before the fft backend and the PSD type
+    Nt = len(strain)
+    freqs = np.fft.rfftfreq(Nt, dt)
+    hf = np.fft.rfft(strain)
+    hf = hf * np.exp(-1.j * 2 * np.pi * time_shift * freqs - 1.j * phase_shift)
+    norm = 1./np.sqrt(1./(dt*2))
+    return np.fft.irfft(hf / np.sqrt(interp_psd(freqs)) * norm, n=Nt)
+
+
+def baseline_bandpass(strain, fband, fs):
+    # bandpass as it was before second-order sections (transfer function form)
+    bb, ab = butter(4, [fband[0]*2./fs, fband[1]*2./fs], btype='band')
+    normalization = np.sqrt((fband[1]-fband[0])/(fs/2))
+    return filtfilt(bb, ab, strain) / normalization
+
+
+def test_bandpass_matches_transfer_function_form():
+    strain = noise(8 * fs)
+    expected = baseline_bandpass(strain, fband, fs)
+    assert np.max(np.abs(bandpass(strain, fband, fs) - expected)) < 1e-6 * np.max(np.abs(expected))
+
+
+def test_bandpass_filters_each_row():
+    strain = noise((2, 8 * fs))
+    filtered = bandpass(strain, fband, fs)
+    for row, filtered_row in zip(strain, filtered):
+        np.testing.assert_allclose(filtered_row, bandpass(row, fband, fs), rtol=0, atol=1e-12)
+
+
+def test_butter_bandpass_is_designed_once():
+    assert butter_bandpass(fband, fs) is butter_bandpass([35, 350], fs)
+
+
+def test_whiten_bandpass_matches_bandpass_of_whiten():
+    # the fused operator differs from filtering in the time domain only near the
+    # ends of the data, where filtfilt pads
+    interp_psd = smooth_psd()
+    n, dt = 16 * fs, 1. / fs
+    strain = noise(n)
+    for phase_shift, time_shift in ((0., 0.), (0.7, 0.25)):
+        expected = baseline_bandpass(baseline_whiten(strain, interp_psd, dt, phase_shift, time_shift),
+                                     fband, fs)
+        fused = whiten_bandpass(np.fft.rfft(strain), interp_psd, dt, fband, n, phase_shift, time_shift)
+        middle = slice(2 * fs, n - 2 * fs)
+        error = np.max(np.abs(fused[middle] - expected[middle]))
+        assert error < 1e-6 * np.max(np.abs(expected[middle]))
+
+
+def test_welch_psd_matches_mlab():
+    # the estimate get_full_psds made with mlab.psd, for both detectors at once
+    strain = noise((2, 64 * fs))
+    nfft = 4 * fs
+    freqs, psd = welch_psd(strain, fs)
+    for row, psd_row in zip(strain, psd):
+        expected, expected_freqs = mlab.psd(row, Fs=fs, NFFT=nfft, window=tukey(nfft, alpha=1./4),
+                                            noverlap=nfft // 2)
+        np.testing.assert_allclose(freqs, expected_freqs)
+        np.testing.assert_allclose(psd_row, expected, rtol=1e-10, atol=0)
+
+
+def test_welch_psd_median_matches_scipy():
+    strain = noise(64 * fs, seed=1)
+    nfft = 4 * fs
+    _, psd = welch_psd(strain, fs, average='median')
+    _, expected = welch(strain, fs, window=tukey(nfft, alpha=1./4), nperseg=nfft,
+                        noverlap=nfft // 2, detrend=False, average='median')
+    np.testing.assert_allclose(psd, expected, rtol=1e-10, atol=0)
@@ -0,0 +1,41 @@
+import numpy as np
+from simulate import simulate_strain
+from streaming import StreamingFilter
+from test_matched_filter import comp_params, design_psd
+
+
+def whole_stream_snr(stream_filter, strain):
+    # complex SNR of the filter of stream_filter (its inverse psd, of finite
+    # length in time, and its templates) applied to the whole stream at once
+    n, fs = len(strain), stream_filter.fs
+    inverse_psd = stream_filter.inverse_psd()
+    kernel = np.fft.irfft(inverse_psd, n=stream_filter.block_length)
+    length = stream_filter.kernel_length
+    whole_kernel = np.zeros(n)
+    whole_kernel[:length], whole_kernel[-length:] = kernel[:length], kernel[-length:]
+    supports = np.fft.irfft(stream_filter.template_ffts, n=stream_filter.block_length)
+    template_ffts = np.fft.rfft(supports[:, :stream_filter.template_length], n=n)
+    sigmasq = 4 * stream_filter.df * np.sum(np.abs(stream_filter.template_ffts)**2 * inverse_psd, axis=-1)
+    overlap = 4 * fs * np.fft.ifft(np.fft.rfft(strain) / fs * template_ffts.conjugate() *
+                                   np.fft.rfft(whole_kernel), n=n, axis=-1)
+    return overlap / np.sqrt(sigmasq)[:, None]
+
+
+def test_overlap_save_matches_whole_stream_filter():
+    fs, psd = 4096, design_psd()
+    param_array = comp_params * np.array([[1., 1., 1., 1.], [1.1, 1.05, 1., 1.]])
+    stream_filter = StreamingFilter(param_array, fs, block_duration=8., kernel_duration=1., psd=psd)
+    strain = simulate_strain(comp_params, {'H1': psd}, snr=20., fs=fs, duration=64., dets=('H1',),
+                             seed=2, time_shift=3.)[0]
+
+    blocks = []
+    for start in range(0, len(strain) - stream_filter.block_length + 1, stream_filter.step):
+        blocks.append(stream_filter.filter_block(strain[start:start + stream_filter.block_length]))
+    snr = np.concatenate(blocks, axis=-1)
+    lags = slice(stream_filter.lag_start, stream_filter.lag_start + snr.shape[-1])
+    expected = whole_stream_snr(stream_filter, strain)[:, lags]
+
+    # lags at block edges included, up to the quadrature part's infinite tails
+    assert np.max(np.abs(snr - expected)) < 5e-4 * np.mean(np.abs(expected))
+    np.testing.assert_array_equal(np.argmax(np.abs(snr), axis=-1), np.argmax(np.abs(expected), axis=-1))
+    assert np.max(np.abs(snr)) > 15.
@@ -0,0 +1,29 @@
+import numpy as np
+from GW_class import GWSignals
+from matched_filter import batch_match, match_waveforms
+from sampler import get_comp_params
+from template_bank import bank_comp_params, load_bank, place_bank, save_bank
+from test_matched_filter import simulated_event
+
+
+def test_bank_covers_its_ranges_at_min_match(tmp_path):
+    GW_signal = GWSignals((36., 29., 0., 0.), simulated_event())
+    bounds = np.array([(27., 29.), (0.5, 1.), (-0.2, 0.2), (-0.2, 0.2)])
+    bank, metadata = place_bank(GW_signal, min_match=0.97, chirp_range=bounds[0], ratio_range=bounds[1],
+                                spin_range=bounds[2], max_rejections=300, seed=0)
+    assert len(bank) > 1
+
+    filename = str(tmp_path / 'bank.npy')
+    save_bank(filename, bank, metadata)
+    np.testing.assert_array_equal(load_bank(filename), bank)
+
+    # the largest match of random points with the bank, maximized finely over time
+    waveforms = match_waveforms(bank_comp_params(bank), GW_signal, 'H1')
+    rng = np.random.default_rng(1)
+    samples = bounds[:, 0] + (bounds[:, 1] - bounds[:, 0]) * rng.random((100, 4))
+    fitting_factors = np.array([np.max(batch_match(get_comp_params(sample), None, GW_signal, 'H1',
+                                                   oversample=16, interpolate=True, waveforms=waveforms))
+                                for sample in samples])
+    # a stochastic bank leaves only rare holes
+    assert np.mean(fitting_factors >= 0.97) >= 0.95
+    assert np.min(fitting_factors) > 0.95
@@ -0,0 +1,36 @@
+import numpy as np
+from GW_class import GWSignals
+from test_matched_filter import simulated_event
+from timeslides import estimate_background, slide_statistics
+
+
+def test_slide_statistics_maximizes_over_windows():
+    rng = np.random.default_rng(0)
+    rho_H, rho_L = np.abs(rng.standard_normal((2, 1000)))
+    shifts, coinc_samples, window_samples = np.array([5, 40, 300]), 3, 64
+    stats = slide_statistics(rho_H, rho_L, shifts, coinc_samples, window_samples, chunk_size=2)
+
+    expected = []
+    for shift in shifts:
+        rho_L_shifted = np.roll(rho_L, -shift)
+        network = [np.sqrt(rho_H[i]**2 + np.max(rho_L_shifted[np.arange(i - coinc_samples,
+                                                                         i + coinc_samples + 1) % 1000]**2))
+                   for i in range(1000)]
+        expected += [max(network[start:start + window_samples])
+                     for start in range(0, 1000 - window_samples + 1, window_samples)]
+    np.testing.assert_allclose(stats, expected, rtol=1e-6)
+
+
+def test_noise_foreground_ranks_within_background():
+    # the foreground and each background value are maxima over windows of the
+    # same length, so in noise alone the foreground is not always the quietest
+    for seed in (1, 2, 3):
+        result = estimate_background(GWSignals((36., 29., 0., 0.), simulated_event(snr=0., seed=seed)))
+        fraction_louder = result['num_louder'] / len(result['background'])
+        assert 0.01 < fraction_louder < 0.99
+        assert result['fap'] < 0.99
+        np.testing.assert_allclose(result['background_time'], 0.2 * len(result['background']), rtol=1e-2)
+
+    result = estimate_background(GWSignals((36., 29., 0., 0.), simulated_event(seed=1)))
+    assert result['num_louder'] == 0
+    assert result['foreground'] > 2 * result['background'][-1]
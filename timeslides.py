@@ -0,0 +1,247 @@
+'''Estimate how often noise alone produces the network SNR of an event, by time
+sliding the H1 and L1 SNR series against each other.'''
+
+
+import argparse
+import time as timer
+from multiprocessing import Pool
+
+import numpy as np
+from scipy.ndimage import maximum_filter1d
+from matched_filter import DataSegment
+from signal_processing import decimate
+from template import get_template
+
+
+# seconds in a year, for false-alarm rates
+year = 365.25 * 24 * 3600.
+
+
+def snr_series(segment, template_fft):
+    """SNR of the template at every lag of a data segment."""
+    overlap, sigmasq = segment.inner_products(template_fft)
+    return np.abs(overlap) / np.sqrt(sigmasq)
+
+
+def valid_samples(segment, duration):
+    """Lags of a segment which are unaffected by the Tukey taper and by
+    wrap-around of a template lasting duration (s).
+    """
+    flat = np.flatnonzero(segment.dwindow == 1.)
+    pad = int(np.ceil(duration * segment.fs))
+    return slice(flat[0] + pad, flat[-1] + 1 - pad)
+
+
+def slide_statistics(rho_H, rho_L, shifts, coinc_samples, window_samples, chunk_size=32):
+    """Network SNR sqrt(rho_H^2 + rho_L^2) for each relative shift of the two
+    series, maximized over L1 lags within coinc_samples of each H1 lag and over
+    consecutive windows of window_samples H1 lags (the samples left over after
+    the last whole window are dropped). Shifts are circular, and are evaluated
+    chunk_size at a time.
+
+    Args:
+        rho_H (ndarray): H1 SNR series
+        rho_L (ndarray): L1 SNR series (same length)
+        shifts (ndarray): shifts of L1 relative to H1 (samples)
+        coinc_samples (int): coincidence window (samples)
+        window_samples (int): length of the windows maximized over (samples),
+            that of the on-source window of the foreground
+        chunk_size (int, optional): number of shifts evaluated together
+
+    Returns:
+        ndarray: network SNR for each window of each shift
+    """
+    N = len(rho_H)
+    num_windows = N // window_samples
+    rho_L_max = maximum_filter1d(rho_L, size=2 * coinc_samples + 1, mode='wrap')
+    rho_H_sq = (rho_H**2).astype(np.float32)[:num_windows * window_samples]
+    rho_L_sq = (rho_L_max**2).astype(np.float32)
+    index = np.arange(num_windows * window_samples)
+    stats = np.zeros((len(shifts), num_windows))
+    for start in range(0, len(shifts), chunk_size):
+        chunk = shifts[start:start + chunk_size]
+        shifted = rho_L_sq[(index[None, :] + chunk[:, None]) % N]
+        stats[start:start + chunk_size] = np.max(
+            (rho_H_sq + shifted).reshape(len(chunk), num_windows, window_samples), axis=2)
+    return np.sqrt(stats.ravel())
+
+
+def get_shifts(num_samples, step, num_slides=None, zero_lag=False):
+    """Shifts (samples) in multiples of step, as many as fit in num_samples."""
+    max_slides = num_samples // step - 1
+    num_slides = max_slides if num_slides is None else min(num_slides, max_slides)
+    return np.arange(0 if zero_lag else 1, num_slides + 1) * step
+
+
+# off-source data and settings held by each pool worker
+_off_source = {}
+
+
+def _init_worker(off_source):
+    _off_source.update(off_source)
+
+
+def _chunk_background(start):
+    # background statistics (including zero lag) for one off-source chunk
+    d = _off_source
+    chunk = slice(start, start + d['chunk_length'])
+    strain = {'H1': d['strain_H1'][chunk], 'L1': d['strain_L1'][chunk]}
+    if not all(np.all(np.isfinite(strain[det])) for det in strain):
+        return np.zeros(0)
+    time = d['time'][chunk][::d['decimation']]
+    chunk_data = {'time': time, 'time_center': time[len(time) // 2], 'dt': d['dt'], 'fs': d['fs'],
+                  'large_data_psds': d['large_data_psds']}
+    for det in strain:
+        chunk_data[det] = {'strain': decimate(strain[det], d['decimation'])}
+    rho = [snr_series(DataSegment(chunk_data, det, len(time) / d['fs']), d['template_fft'])[d['valid']]
+           for det in ('H1', 'L1')]
+    return slide_statistics(rho[0], rho[1], d['shifts'], d['coinc_samples'], d['window_samples'])
+
+
+def estimate_background(GW_signal, large_data_filename=None, params=None, processes=None,
+                        coinc_window=0.015, slide_step=0.05, num_slides=None,
+                        time_window=0.1, mask_window=0.5):
+    """Estimates the background of the network SNR for an event with time slides
+    of the on-source data (with the event masked out) and, if the 4096 s data
+    files are given, with every slide (and zero lag) of the off-source 32 s
+    chunks of those files, filtered across a process pool.
+
+    Args:
+        GW_signal (GWSignals): event to estimate the background for
+        large_data_filename (str, optional): filename of the 4096 s strain data,
+            without the added 'H-<det>_' (as for get_data.get_full_psds)
+        params (ndarray, optional): component parameters of the template,
+            defaults to the reference parameters of the event
+        processes (int, optional): size of the process pool for the off-source
+            chunks, defaults to all cores
+        coinc_window (float): largest time difference (s) between H1 and L1
+            peaks in a coincidence
+        slide_step (float): spacing (s) of the time slides, larger than twice
+            coinc_window so that no slide is physical
+        num_slides (int, optional): largest number of slides per segment
+        time_window (float): half width (s) of the on-source window around the
+            event used for the foreground, and of the windows each background
+            value is the largest network SNR of
+        mask_window (float): half width (s) of the data around the event left
+            out of the on-source slides
+
+    Returns:
+        dict: foreground network SNR, background network SNRs, background time
+            (s), false-alarm rate (per year), false-alarm probability and timing
+    """
+    if slide_step <= 2 * coinc_window:
+        raise ValueError('slide_step must be larger than twice coinc_window')
+    dictionary = GW_signal.dictionary
+    time_center = dictionary['time_center']
+    fs = dictionary['fs']
+    params = GW_signal.comp_params if params is None else params
+    template_p = get_template(params, dictionary)
+    nonzero = np.flatnonzero(template_p)
+    duration = (nonzero[-1] - nonzero[0] + 1) / fs
+    coinc_samples = int(round(coinc_window * fs))
+    step = int(round(slide_step * fs))
+
+    # H1 and L1 SNR series over the whole on-source stretch of data, with the
+    # template transformed once for both
+    t0 = timer.perf_counter()
+    segments = [GW_signal.get_segment(det, len(dictionary['time']) / fs) for det in ('H1', 'L1')]
+    template_fft = segments[0].template_fft(template_p)
+    rho_H, rho_L = (snr_series(segment, template_fft) for segment in segments)
+    time = segments[0].time
+
+    # foreground: zero-lag network SNR near the event
+    near = np.abs(time - time_center) <= time_window
+    window_samples = np.count_nonzero(near)
+    rho_L_max = maximum_filter1d(rho_L, size=2 * coinc_samples + 1, mode='wrap')
+    foreground = np.sqrt(np.max(rho_H[near]**2 + rho_L_max[near]**2))
+
+    # on-source background: slides with the event masked out of both detectors
+    valid = valid_samples(segments[0], duration)
+    masked = np.abs(time - time_center) <= mask_window
+    rho_H_bg, rho_L_bg = np.where(masked, 0., rho_H)[valid], np.where(masked, 0., rho_L)[valid]
+    shifts = get_shifts(len(rho_H_bg), step, num_slides)
+    background = [slide_statistics(rho_H_bg, rho_L_bg, shifts, coinc_samples, window_samples)]
+    on_source_time = timer.perf_counter() - t0
+
+    # off-source background: every 32 s chunk of the long files away from the event
+    off_source_time = 0.
+    if large_data_filename is not None:
+        from get_data import load_strain
+        t0 = timer.perf_counter()
+        strain_H1, strain_L1, long_time, long_dt = load_strain(large_data_filename)
+        decimation = dictionary.get('decimation', 1)
+        chunk_length = len(dictionary['time']) * decimation
+        starts = np.arange(0, len(long_time) - chunk_length + 1, chunk_length)
+        far_from_event = np.abs(long_time[starts + chunk_length // 2] - time_center) > \
+            0.5 * chunk_length * long_dt + mask_window
+        starts = starts[far_from_event]
+        chunk_shifts = get_shifts(valid.stop - valid.start, step, num_slides, zero_lag=True)
+        off_source = {'strain_H1': strain_H1, 'strain_L1': strain_L1, 'time': long_time,
+                      'chunk_length': chunk_length, 'decimation': decimation,
+                      'dt': dictionary['dt'], 'fs': fs,
+                      'large_data_psds': dictionary['large_data_psds'],
+                      'template_fft': template_fft, 'valid': valid,
+                      'shifts': chunk_shifts, 'coinc_samples': coinc_samples,
+                      'window_samples': window_samples}
+        with Pool(processes, initializer=_init_worker, initargs=(off_source,)) as pool:
+            chunk_stats = pool.map(_chunk_background, starts)
+        background += chunk_stats
+        off_source_time = timer.perf_counter() - t0
+
+    # each background value covers as much data as the foreground window
+    background = np.sort(np.concatenate(background))
+    background_time = len(background) * window_samples / fs
+    return {'foreground': foreground, 'background': background,
+            'background_time': background_time,
+            **significance(foreground, background, background_time, window_samples / fs),
+            'timing': {'on_source': on_source_time, 'off_source': off_source_time}}
+
+
+def significance(foreground, background, background_time, on_source_time):
+    """False-alarm rate and probability of a foreground network SNR.
+
+    Args:
+        foreground (float): network SNR of the event
+        background (ndarray): background network SNRs
+        background_time (float): amount of background analysed (s)
+        on_source_time (float): length of the on-source window (s)
+
+    Returns:
+        dict: number of louder background values, false-alarm rate (per
+            year, an upper limit if nothing is louder) and false-alarm probability
+    """
+    num_louder = int(np.sum(background >= foreground))
+    far = max(num_louder, 1) / background_time
+    return {'num_louder': num_louder, 'far': far * year,
+            'fap': 1. - np.exp(-far * on_source_time)}
+
+
+def print_report(event_name, result):
+    limit = '<' if result['num_louder'] == 0 else ''
+    print(f"{event_name}: network SNR {result['foreground']:.2f}, "
+          f"{len(result['background'])} background values over {result['background_time']:.0f} s, "
+          f"{result['num_louder']} louder, FAR {limit}{result['far']:.3g}/yr, "
+          f"FAP {limit}{result['fap']:.3g} "
+          f"({result['timing']['on_source']:.1f} s on-source, "
+          f"{result['timing']['off_source']:.1f} s off-source)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('events', nargs='*', help='bundled events to analyse (default: all)')
+    parser.add_argument('--off-source', default=None,
+                        help="4096 s data file (without 'H-<det>_'), for a single event")
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--slide-step', type=float, default=0.05)
+    parser.add_argument('--num-slides', type=int, default=None)
+    args = parser.parse_args()
+
+    from GW_class import GW_events
+    event_names = args.events or list(GW_events)
+    if args.off_source is not None and len(event_names) != 1:
+        parser.error('--off-source needs exactly one event')
+    for event_name in event_names:
+        result = estimate_background(GW_events[event_name], args.off_source,
+                                     processes=args.processes, slide_step=args.slide_step,
+                                     num_slides=args.num_slides)
+        print_report(event_name, result)